@@ -0,0 +1,202 @@
+from common.logger import Logger
+from common.fetch_response import FetchResponse
+from common.plan_response import PlanResponse
+from common.apply_response import ApplyResponse
+from common.blob_store import BlobStore
+from common.state_store import StateStore
+from fake_transport import FakeTransport
+import argparse, json, os, platform, resource, subprocess, sys, tempfile, time
+
+DATA_MODS = ['ls', 'lsl', 'df', 'docker']
+MODS = ['mkdir', 'wget', 'compose', 'cloudflared', 'gitwiki']
+
+# ================================================================
+# SYNTHETIC CONFIG
+# ================================================================
+def data_config(size:int) -> dict:
+  config = {mod: {} for mod in DATA_MODS}
+  for idx in range(size):
+    mod = DATA_MODS[idx % len(DATA_MODS)]
+    config[mod]['d{}'.format(idx)] = {'path': '/srv/d{}'.format(idx)} if mod in ('ls', 'lsl') else {}
+  return config
+
+def mods_config(size:int) -> dict:
+  """Spreads resources over every mod, where every mkdir depends on the one before, in chains of 5
+  """
+  config = {mod: {} for mod in MODS}
+  last = None
+  for idx in range(size):
+    mod = MODS[idx % len(MODS)]
+    name = 'r{}'.format(idx)
+    if mod == 'mkdir':
+      param = {'path': '/srv/r{}'.format(idx)}
+      if last is not None and idx % 25 != 0:
+        param['depends_on'] = 'mkdir.' + last
+      last = name
+    elif mod == 'wget':
+      param = {'path': '/srv', 'output': 'r{}.tar.gz'.format(idx), 'url': 'https://example.com/r{}.tar.gz'.format(idx)}
+    elif mod == 'compose':
+      param = {'path': '/srv/r{}/docker-compose.yml'.format(idx)}
+    elif mod == 'cloudflared':
+      param = {'name': 'tunnel{}'.format(idx), 'token': 't{}'.format(idx)}
+    else:
+      param = {'volume': 'wiki', 'folder': 'r{}'.format(idx), 'repo': 'https://example.com/r{}.git'.format(idx)}
+    config[mod][name] = param
+  return config
+
+# ================================================================
+# PHASES
+# ================================================================
+def measure(results:list, size:int, phase:str, counter, task):
+  """Runs a phase and appends its wall time, commands and bytes of counter, and the peak RSS so far
+  """
+  commands, sent, received = counter.commands, counter.bytes_sent, counter.bytes_received
+  start = time.perf_counter()
+  ret = task()
+  wall = time.perf_counter() - start
+  commands = counter.commands - commands
+  results.append({
+    'size': size,
+    'phase': phase,
+    'wall': round(wall, 6),
+    'commands': commands,
+    'commands_per_sec': round(commands / wall, 1) if wall > 0 else 0.0,
+    'bytes_sent': counter.bytes_sent - sent,
+    'bytes_received': counter.bytes_received - received,
+    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  })
+  return ret
+
+def run_size(args, size:int) -> list:
+  """Runs fetch, plan, apply and a plan without changes for one size, in a temporary folder
+  """
+  logger = Logger('benchmark')
+  server = None
+  if args.transport == 'ssh':
+    from stand_in_server import StandInServer
+    from common.my_ssh import MySSH
+    server = StandInServer(latency=args.latency, output_size=args.output_size).start()
+    transport = MySSH()
+    transport.connect(server.host, 'bench', 'bench', port=server.port)
+    counter = server
+  else:
+    transport = FakeTransport(latency=args.latency, output_size=args.output_size)
+    transport.connect()
+    counter = transport
+  results = []
+  options = {'channels': args.channels, 'batch': args.batch, 'tail': args.tail}
+  with tempfile.TemporaryDirectory() as path:
+    blobs = BlobStore(logger, path)
+    store = StateStore(logger, path)
+    state = store.load({'viki': {'data': {}, 'mods': {}}})
+
+    def fetch():
+      response = FetchResponse(logger, transport, data_config(size), {}, log_dir=os.path.join(path, 'logs', 'data'), blobs=blobs, **options)
+      response.fetch()
+      state['viki']['data'] = response.state
+
+    def plan(mods:dict):
+      return PlanResponse(logger, transport, mods_config(size), mods)
+
+    def apply(plan_response):
+      response = ApplyResponse(logger, transport, plan_response.delta_insert, plan_response.delta_remove, state['viki']['mods'], {}, log_dir=os.path.join(path, 'logs', 'mods'), blobs=blobs, store=store, replace=plan_response.delta_replace, **options)
+      response.apply_insert()
+      state['viki']['mods'] = response.state
+      store.write(state)
+
+    measure(results, size, 'fetch', counter, fetch)
+    plan_response = measure(results, size, 'plan', counter, lambda: plan(state['viki']['mods']))
+    measure(results, size, 'apply', counter, lambda: apply(plan_response))
+    # A plan of a state loaded from its shards, where nothing changed
+    measure(results, size, 'replan', counter, lambda: plan(StateStore(logger, path).load({})['viki']['mods']))
+  transport.close()
+  if server is not None:
+    server.stop()
+  return results
+
+# ================================================================
+# REPORT
+# ================================================================
+def git_commit() -> str:
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def compare(results:dict, baseline:dict, threshold:float) -> list:
+  """Returns a message for each phase whose wall time grew by more than threshold, e.g. 0.2 for 20%
+  """
+  base = {(row['size'], row['phase']): row for row in baseline['results']}
+  regressions = []
+  for key in ['transport', 'latency', 'output_size', 'channels', 'batch']:
+    if results['meta'].get(key) != baseline['meta'].get(key):
+      sys.stderr.write('WARNING {} is {} but {} in the baseline\n'.format(key, results['meta'].get(key), baseline['meta'].get(key)))
+  for row in results['results']:
+    key = (row['size'], row['phase'])
+    if key in base and base[key]['wall'] > 0 and row['wall'] > base[key]['wall'] * (1 + threshold):
+      regressions.append('{} {}: {:.3f}s vs {:.3f}s ({:+.0%})'.format(
+        row['phase'], row['size'], row['wall'], base[key]['wall'], row['wall'] / base[key]['wall'] - 1))
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(prog='benchmark', description='Benchmarks fetch, plan and apply against a stand-in host')
+  parser.add_argument('-s', '--sizes', type=str, default='10,1000,10000', help='comma separated numbers of resources')
+  parser.add_argument('--transport', choices=['fake', 'ssh'], default='fake', help='an in-process fake transport, or a local stand-in SSH server')
+  parser.add_argument('--latency', type=float, default=0.0, help='seconds that each command takes on the stand-in host')
+  parser.add_argument('--output-size', type=int, default=256, help='number of output bytes of each command')
+  parser.add_argument('-c', '--channels', type=int, default=1, help='maximum number of resources to run in parallel on one connection')
+  parser.add_argument('-b', '--batch', action='store_true', help='run the resources as batch scripts')
+  parser.add_argument('-t', '--tail', type=int, default=4096, help='number of output characters kept in memory for each resource')
+  parser.add_argument('-o', '--out', type=str, default=None, help='write the results to a JSON file instead of stdout')
+  parser.add_argument('--compare', type=str, default=None, help='a JSON file of earlier results, where a slower phase exits with 1')
+  parser.add_argument('--threshold', type=float, default=0.2, help='allowed growth of wall time for --compare, defaults to 0.2')
+  parser.add_argument('--size', type=int, default=None, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.size is not None:
+    # A child process for one size, so that peak RSS is not shared between sizes
+    json.dump(run_size(args, args.size), sys.stdout)
+    return
+
+  rows = []
+  for size in [int(size) for size in args.sizes.split(',') if size != '']:
+    child = [sys.executable, os.path.abspath(__file__), '--size', str(size), '--transport', args.transport,
+      '--latency', str(args.latency), '--output-size', str(args.output_size), '--channels', str(args.channels),
+      '--tail', str(args.tail)] + (['--batch'] if args.batch else [])
+    proc = subprocess.run(child, capture_output=True, text=True)
+    if proc.returncode != 0:
+      sys.stderr.write(proc.stderr)
+      sys.exit(proc.returncode)
+    rows.extend(json.loads(proc.stdout.splitlines()[-1]))
+  results = {
+    'meta': {
+      'commit': git_commit(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'transport': args.transport,
+      'latency': args.latency,
+      'output_size': args.output_size,
+      'channels': args.channels,
+      'batch': args.batch,
+      'created': time.time()
+    },
+    'results': rows
+  }
+  text = json.dumps(results, indent=2)
+  if args.out is not None:
+    with open(args.out, 'w') as fp:
+      fp.write(text + '\n')
+  else:
+    print(text)
+  for row in rows:
+    sys.stderr.write('{size:>6} {phase:<7} {wall:>9.3f}s {commands:>6} cmds {commands_per_sec:>10.1f}/s {peak_rss_kb:>8} KB\n'.format(**row))
+  if args.compare is not None:
+    with open(args.compare) as fp:
+      regressions = compare(results, json.load(fp), args.threshold)
+    for msg in regressions:
+      sys.stderr.write('REGRESSION {}\n'.format(msg))
+    if regressions != []:
+      sys.exit(1)
+
+if __name__ == "__main__":
+  main()
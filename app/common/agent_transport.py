@@ -0,0 +1,165 @@
+from common.remote_script import ensure_script, script_command, script_path, upload_command
+from common.transport import Transport
+from common.tracer import TRACER
+import base64, itertools, json, threading
+
+class AgentCall():
+  __slots__ = ('sink', 'stderr_sink', 'done', 'status')
+
+  def __init__(self, sink, stderr_sink=None):
+    self.sink = sink
+    self.stderr_sink = stderr_sink
+    self.done = threading.Event()
+    self.status = -1
+
+class AgentTransport(Transport):
+  def __init__(self, ssh, python:str='python3'):
+    """Runs commands through viki_agent on one channel of a MySSH, instead of a session for each command
+      :param ssh: The MySSH that uploads and starts the agent, and runs the commands when the agent did not start
+      :type ssh: MySSH
+      :param python: The interpreter of the agent on the host, defaults to python3
+      :type python: string
+    """
+    self.ssh = ssh
+    self.python = python
+    self.path = script_path('viki_agent', 'agent')
+    self.session = None
+    self.reason = None
+    self.broken = False
+    self.ids = itertools.count(1)
+    self.calls = {}
+    self.lock = threading.Lock()
+    self.send_lock = threading.Lock()
+
+  def connect(self, hostname:str, username:str, password:str, port:int=22) -> bool:
+    if not self.ssh.connected() and not self.ssh.connect(hostname, username, password, port=port):
+      return False
+    self.start()
+    return True
+
+  def connected(self) -> bool:
+    return self.ssh.connected()
+
+  def alive(self) -> bool:
+    # An agent that sent an answer that is not valid may have left the connection in a bad state
+    return not self.broken and self.ssh.alive()
+
+  def set_verbosity(self, verbose:bool):
+    self.ssh.set_verbosity(verbose)
+
+  def open_sftp(self):
+    return self.ssh.open_sftp()
+
+  def close(self):
+    if self.session is not None:
+      self.session.close()
+      self.session = None
+    self.ssh.close()
+
+  def start(self) -> bool:
+    """Starts the agent, and uploads it first when the host does not have this version
+      :returns: True if the agent runs, or False with the reason in self.reason
+    """
+    with TRACER.span('agent_start'):
+      status = ensure_script('viki_agent', 'agent', self.__launch, self.__upload)[0]
+    if status != 0:
+      self.session = None
+      self.reason = 'agent exited with status {}'.format(status)
+      return False
+    threading.Thread(target=self.__read, daemon=True).start()
+    return True
+
+  def __launch(self, path:str) -> tuple:
+    """Starts the agent on a channel without a PTY and waits for its first line
+      :returns: A tuple of (status, None), where status is 0 when it runs, or the exit status of the start command
+    """
+    session = self.ssh.transport.open_session()
+    session.exec_command(script_command(path, self.python + ' -u'))
+    session.settimeout(30)
+    self.rfile = session.makefile('rb', 65536)
+    try:
+      line = self.rfile.readline()
+    except OSError:
+      line = b''
+    session.settimeout(None)
+    try:
+      hello = json.loads(line) if line != b'' else None
+    except ValueError:
+      hello = None
+    if not isinstance(hello, dict) or not 'agent' in hello:
+      status = session.recv_exit_status() if line == b'' else -1
+      session.close()
+      return status, None
+    self.session = session
+    return 0, None
+
+  def __upload(self, path:str, source:bytes) -> int:
+    session = self.ssh.transport.open_session()
+    session.exec_command(upload_command(path))
+    session.sendall(source)
+    session.shutdown_write()
+    return session.recv_exit_status()
+
+  def __read(self):
+    """Passes each answer of the agent to its call, until the channel closes or an answer is not valid
+    """
+    session = self.session
+    error = 'agent exited'
+    try:
+      for line in self.rfile:
+        message = json.loads(line)
+        call = self.calls.get(message.get('id'))
+        if call is None:
+          continue
+        if 'out' in message:
+          call.sink(base64.b64decode(message['out']))
+        elif 'err' in message:
+          call.stderr_sink(base64.b64decode(message['err']))
+        elif 'status' in message:
+          call.status = message['status']
+          with self.lock:
+            self.calls.pop(message['id'], None)
+          call.done.set()
+    except (ValueError, AttributeError, TypeError, OSError, EOFError) as e:
+      # A truncated or garbled answer leaves the calls out of step with the agent, so the agent is dropped
+      error = 'agent answer not valid, {}'.format(e)
+      self.reason = error
+      self.broken = True
+      session.close()
+    # The calls that are left fail and the next commands run on sessions
+    with self.lock:
+      self.session = None
+      calls = list(self.calls.values())
+      self.calls = {}
+    for call in calls:
+      call.sink(('\nERROR: {}\n'.format(error)).encode('utf-8'))
+      call.done.set()
+
+  def run_stream(self, cmd:str, sink, input_data:str=None, timeout:int=180, pty:bool=False, stderr_sink=None) -> int:
+    call = AgentCall(sink, stderr_sink)
+    # The call is added with the session in one step, so that it is failed by __read if the agent exits
+    with self.lock:
+      session = self.session
+      if session is not None and not pty:
+        id = next(self.ids)
+        self.calls[id] = call
+    # The agent runs commands without a terminal, so a mod that needs one runs in a session
+    if session is None or pty:
+      return self.ssh.run_stream(cmd, sink, input_data, timeout, pty, stderr_sink)
+    line = json.dumps({'id': id, 'cmd': cmd, 'input': input_data, 'timeout': timeout, 'stderr': stderr_sink is not None}) + '\n'
+    with TRACER.span('exec'):
+      try:
+        with self.send_lock:
+          session.sendall(line.encode('utf-8'))
+      except OSError:
+        with self.lock:
+          self.calls.pop(id, None)
+        sink(b'ERROR: agent channel closed\n')
+        return -1
+      # The agent kills the command after timeout, so the grace period only covers a lost channel
+      if not call.done.wait(timeout + 30):
+        with self.lock:
+          self.calls.pop(id, None)
+        sink(('\nERROR: timeout after %d seconds\n' % (timeout)).encode('utf-8'))
+        return -1
+    return call.status
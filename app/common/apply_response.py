@@ -1,57 +1,200 @@
 from abc import ABC
 from common.base_response import BaseResponse
-from common.ssh_command import MODS_COMMAND, ssh_command
+from common.ssh_command import MODS_TEMPLATE, SYNC_PARAMS, resource_fingerprint, sudo_command
+from common.scheduler import Scheduler
+from common.tracer import TRACER
 
 class ApplyResponse(BaseResponse, ABC):
-  def __init__(self, logger, ssh, insert:dict, remove:dict, state:dict, vars:dict):
+  def __init__(self, logger, ssh, insert:dict, remove:dict, state:dict, vars:dict, channels:int=1, batch:bool=False, log_dir:str=None, tail:int=4096, blobs=None, commands:dict=None, store=None, replace:dict=None, root:str='.', drift:dict=None, timeout:int=180):
     self.log = logger
-    self.log.fn = self.__class__.__name__ + '.' + self.__init__.__name__
     self.sudo_password = None
     if 'sudo_password' in vars and vars['sudo_password'] != '':
       self.sudo_password = vars['sudo_password']
     self.ssh = ssh
+    self.channels = channels
+    self.batch = batch
+    self.log_dir = log_dir
+    self.tail = tail
+    self.timeout = timeout
+    self.blobs = blobs
+    self.commands = commands
+    self.store = store
     self.delta_insert = insert
     self.delta_remove = remove
+    self.delta_replace = replace if replace is not None else {}
     self.state = state
+    self.root = root
+    self.drift = drift if drift is not None else {}
+    # The (mod, name) of each resource that was added, destroyed, or failed or skipped
+    self.inserted = set()
+    self.removed = set()
+    self.failed = set()
 
-  def apply_insert(self):
-    self.log.fn = self.__class__.__name__ + '.' + self.apply_insert.__name__
-    state = {}
-    for mod, names in self.delta_insert.items():
-      state[mod] = {}
-      cmd = MODS_COMMAND[mod]
-      for name, param in names.items():
-        self.log.info('{}'.format(ssh_command(cmd['insert'], param)))
-        exec = ssh_command(cmd['insert'], param, self.sudo_password)
-        if exec[:4] == "sudo":
-          status, output = self.ssh.run(exec, self.sudo_password)
-        else:
-          status, output = self.ssh.run(exec, None)
-
-        if status == 0:
-          if not mod in self.state:
-            self.state[mod] = {}
-          self.state[mod][name] = param
-          self.state[mod][name]['output'] = output
-          self.log.info('{} : {}'.format(name, self.state[mod][name]))
-        else:
-          self.log.error('mod {} returned status code {}.'.format(mod, status))
-
-  def apply_remove(self):
-    self.log.fn = self.__class__.__name__ + '.' + self.apply_remove.__name__
+  def apply_insert(self, failed:set=None):
+    """Adds the resources of delta_insert
+      :param failed: The replaced resources whose destroy failed, which are skipped with their dependents
+      :type failed: set
+    """
+    scheduler = Scheduler(self.log, self.delta_insert, self.state)
+    failed = set(failed) if failed is not None else set()
+    for level in scheduler.levels(self.delta_insert):
+      self.__insert_level(level, scheduler, failed)
+    self.failed |= failed
+
+  def __insert_level(self, level:list, scheduler, failed:set):
+    jobs = []
+    for mod, name in level:
+      param = self.delta_insert[mod][name]
+      if (mod, name) in failed:
+        self.log.error('{}.{} skipped as its destroy for replace failed.'.format(mod, name))
+        continue
+      if scheduler.blocked((mod, name), failed):
+        self.log.error('{}.{} skipped as a resource in depends_on failed.'.format(mod, name))
+        failed.add((mod, name))
+        continue
+      if self.commands is not None:
+        # Run the command rendered by the saved plan
+        command = self.commands['insert'][mod][name]
+      else:
+        command = MODS_TEMPLATE[mod]['insert'].render(param)
+      self.log.info('{}', command)
+      param['fingerprint'] = resource_fingerprint(mod, param)
+      jobs.append((mod, name, param, sudo_command(command, self.sudo_password)))
+    resources = [(mod, name) for mod, name, param, exec in jobs]
+    sinks = self.output_sinks(resources)
+    errors = self.error_sinks(resources)
+
+    def done(idx:int, status:int, output:str):
+      # Journal each resource as it finishes, so that a crash does not lose it
+      mod, name, param, exec = jobs[idx]
+      if status == 0:
+        self.drift.get(mod, {}).pop(name, None)
+        self.store_output(param, output, sinks[idx], errors[idx])
+        # A synced resource is journaled after its files
+        if self.store is not None and not mod in SYNC_PARAMS:
+          self.store.set(['viki', 'mods', mod, name], param)
+
+    results = self.run_commands([exec for mod, name, param, exec in jobs], sinks, done, resources, errors)
+    synced = [idx for idx, (mod, name, param, exec) in enumerate(jobs) if mod in SYNC_PARAMS and results[idx][0] == 0]
+    if synced != []:
+      self.__sync_files(jobs, synced, results)
+    for idx, ((mod, name, param, exec), (status, output)) in enumerate(zip(jobs, results)):
+      if status == 0:
+        if not mod in self.state:
+          self.state[mod] = {}
+        self.state[mod][name] = param
+        self.inserted.add((mod, name))
+        self.log.info('{} : {}', name, self.summary(self.state[mod][name]))
+      else:
+        failed.add((mod, name))
+        self.log.error('mod {} returned status code {}.'.format(mod, status))
+    if self.store is not None:
+      self.store.checkpoint()
+
+  def summary(self, param:dict) -> dict:
+    """Returns the params of a resource without the files of a synced resource, which FileSync summarizes
+    """
+    return {key: val for key, val in param.items() if key != 'files'}
+
+  def __sync_files(self, jobs:list, synced:list, results:list):
+    """Pushes the files of the synced resources whose insert command created dest, and replaces their results
+      :param synced: The indices of the synced resources in jobs
+      :type synced: list
+    """
+    from common.file_sync import FileSync
+    sync = FileSync(self.log, self.ssh, self.root)
+    resources = []
+    for idx in synced:
+      mod, name, param, exec = jobs[idx]
+      # The files of the last sync, which an updated resource still has in its state
+      previous = self.state[mod][name].get('files') if mod in self.state and name in self.state[mod] else None
+      resources.append(('{}.{}'.format(mod, name), param, previous))
+    with TRACER.span('sync', resources=len(resources)):
+      pushed = sync.push(resources)
+    for idx, (status, message, files) in zip(synced, pushed):
+      mod, name, param, exec = jobs[idx]
+      if status == 0:
+        param['files'] = files
+        if self.store is not None:
+          self.store.set(['viki', 'mods', mod, name], param)
+      results[idx] = (status, message)
+
+  def __unsync_files(self, jobs:list, failed:set) -> list:
+    """Deletes the files in the state of the synced resources, before their remove command removes dest if it is empty
+      :param failed: The resources that failed, which gets the synced resources whose files were not deleted
+      :type failed: set
+      :returns: The jobs of the resources that are not synced or whose files were deleted
+    """
+    synced = [(mod, name) for mod, name, exec in jobs if mod in SYNC_PARAMS]
+    if synced == []:
+      return jobs
+    from common.file_sync import FileSync
+    sync = FileSync(self.log, self.ssh, self.root)
+    with TRACER.span('sync', resources=len(synced)):
+      deleted = sync.remove([('{}.{}'.format(mod, name), self.state[mod][name]) for mod, name in synced])
+    for (mod, name), (status, message) in zip(synced, deleted):
+      if status != 0:
+        failed.add((mod, name))
+        self.log.error('{}.{} not destroyed: {}'.format(mod, name, message))
+    return [(mod, name, exec) for mod, name, exec in jobs if not (mod, name) in failed]
+
+  def apply_remove(self, replace:bool=False) -> set:
+    """Destroys the resources of delta_remove, either only the replaced ones or only the others
+      :param replace: Destroy the replaced resources, which runs before apply_insert, defaults to False
+      :type replace: bool
+      :returns: The set of (mod, name) that failed or were skipped
+    """
+    delta = {}
     for mod, names in self.delta_remove.items():
-      cmd = MODS_COMMAND[mod]
-      for name in names.keys():
-        if name in self.state[mod]:
-          self.log.info('{}'.format(ssh_command(cmd['remove'], self.state[mod][name])))
-          exec = ssh_command(cmd['remove'], self.state[mod][name], self.sudo_password)
-          if exec[:4] == "sudo":
-            status, output = self.ssh.run(exec, self.sudo_password)
-          else:
-            status, output = self.ssh.run(exec, None)
-
-          if status == 0:
-            self.log.info('{} : {}'.format(name, self.state[mod][name]))
-            del self.state[mod][name]
-          else:
-            self.log.error('mod {} returned status code {}:{}.'.format(mod, status, output))
+      delta[mod] = {name: val for name, val in names.items() if (name in self.delta_replace.get(mod, {})) == replace}
+    scheduler = Scheduler(self.log, self.state)
+    failed = set()
+    for level in scheduler.levels(delta, reverse=True):
+      self.__remove_level(level, scheduler, failed)
+    self.failed |= failed
+    return failed
+
+  def __remove_level(self, level:list, scheduler, failed:set):
+    jobs = []
+    for mod, name in level:
+      if scheduler.blocked((mod, name), failed):
+        self.log.error('{}.{} skipped as a resource that depends on it failed.'.format(mod, name))
+        failed.add((mod, name))
+        continue
+      if name in self.drift.get(mod, {}) and name in self.state[mod]:
+        # refresh found the resource gone from the host, so only its state is removed
+        self.log.info('{}.{} drifted, removed from state without its remove command.', mod, name)
+        del self.state[mod][name]
+        del self.drift[mod][name]
+        self.removed.add((mod, name))
+        if self.store is not None:
+          self.store.delete(['viki', 'mods', mod, name])
+        continue
+      if self.commands is not None and name in self.commands['remove'][mod]:
+        command = self.commands['remove'][mod][name]
+      elif name in self.state[mod]:
+        command = MODS_TEMPLATE[mod]['remove'].render(self.state[mod][name])
+      else:
+        continue
+      self.log.info('{}', command)
+      jobs.append((mod, name, sudo_command(command, self.sudo_password)))
+    jobs = self.__unsync_files(jobs, failed)
+    sinks = self.output_sinks([(mod, name + '.remove') for mod, name, exec in jobs])
+    errors = self.error_sinks([(mod, name + '.remove') for mod, name, exec in jobs])
+
+    def done(idx:int, status:int, output:str):
+      mod, name, exec = jobs[idx]
+      if status == 0 and self.store is not None:
+        self.store.delete(['viki', 'mods', mod, name])
+
+    results = self.run_commands([exec for mod, name, exec in jobs], sinks, done, [(mod, name) for mod, name, exec in jobs], errors)
+    for (mod, name, exec), (status, output) in zip(jobs, results):
+      if status == 0:
+        self.log.info('{} : {}', name, self.summary(self.state[mod][name]))
+        del self.state[mod][name]
+        self.removed.add((mod, name))
+      else:
+        failed.add((mod, name))
+        self.log.error('mod {} returned status code {}:{}.'.format(mod, status, output))
+    if self.store is not None:
+      self.store.checkpoint()
@@ -1,28 +1,206 @@
 from abc import ABC, abstractmethod
-import json
+from concurrent.futures import ThreadPoolExecutor
+from common.batch_script import batch_marker, batch_scripts, batch_results
+from common.output_sink import OutputSink
+from common.facts import Facts
+from common.ssh_command import exec_profile, needs_sudo_input
+from common.tracer import TRACER
+import contextvars, hashlib, json, os, shlex
 
 class BaseResponse(ABC):
   def __init__(self, logger):
     self.log = logger
-    self.log.fn = self.__class__.__name__ + '.' + self.__init__.__name__
     self.ssh = None
+    self.sudo_password = None
+    self.channels = 1
+    self.batch = False
+    self.log_dir = None
+    self.tail = 4096
+    self.timeout = 180
+    self.blobs = None
     self.config: dict = {}
 
   def check_schema(self, config:dict, schema:dict) -> dict:
-    self.log.fn = self.__class__.__name__ + '.' + self.check_schema.__name__
     config_keys = set(config.keys())
     schema_keys = set(schema.keys())
     return config_keys - schema_keys
 
   def pretty_json(self, config:dict) -> str:
-    self.log.fn = self.__class__.__name__ + '.' + self.pretty_json.__name__
     return json.dumps(config, indent=4)
 
-  def check_which(self, config:dict):
-    self.log.fn = self.__class__.__name__ + '.' + self.check_which.__name__
-    for mod, names in self.config.items():
-      status, output = self.ssh.run('which ' + mod, None)
-      if status == 0:
-        self.log.info('mod {} returned status code {} and {}'.format(mod, status, output))
+  def check_params(self, config:dict, templates:dict, op:str=None):
+    """Checks the params of each resource against the placeholders of its command before any command runs
+      :param templates: DATA_TEMPLATE or MODS_TEMPLATE
+      :type templates: dict
+      :param op: The command of MODS_TEMPLATE, e.g. insert, defaults to None for DATA_TEMPLATE
+      :type op: string
+    """
+    for mod, names in config.items():
+      if not mod in templates:
+        continue
+      template = templates[mod] if op is None else templates[mod][op]
+      for name, param in names.items():
+        missing, unknown = template.check(param)
+        if unknown != []:
+          self.log.warning('Unknown parameters {} found in {}.{}.'.format(unknown, mod, name))
+        if missing != []:
+          msg = 'Missing parameters {} in {}.{}.'.format(missing, mod, name)
+          self.log.error(msg, ValueError(msg))
+
+  def check_which(self, config:dict, facts=None):
+    """Checks that each mod is installed with one remote call for every mod that is not cached
+      :param facts: A Facts of the host, defaults to None to probe every mod
+      :type facts: Facts
+    """
+    if facts is None:
+      facts = Facts({})
+    mods = list(config.keys())
+    stale = facts.stale('which', mods)
+    if stale != []:
+      script = ' '.join(shlex.quote(mod) for mod in stale)
+      status, output = self.ssh.run('for m in ' + script + '; do p=$(which "$m" 2>/dev/null); echo "$m $? $p"; done', None)
+      for line in output.splitlines():
+        fields = line.strip().split(' ', 2)
+        if len(fields) >= 2 and fields[0] in stale and fields[1].isdigit():
+          facts.set('which', fields[0], {'status': int(fields[1]), 'output': fields[2] if len(fields) > 2 else ''})
+    for mod in mods:
+      fact = facts.get('which', mod)
+      if fact is not None and fact['status'] == 0:
+        self.log.info('mod {} returned status code {} and {}', mod, fact['status'], fact['output'])
+      else:
+        self.log.error('mod {} returned status code {}.'.format(mod, fact['status'] if fact is not None else -1))
+
+  def output_sinks(self, resources:list, ext:str='.log', empty:bool=True) -> list:
+    """Creates a sink for each resource that streams its output to log_dir/<mod>/<name>.log
+      :param resources: A list of (mod, name) pairs
+      :type resources: list
+      :param ext: The extension of the log files, e.g. .err for stderr, defaults to .log
+      :type ext: string
+      :param empty: Create the log file of a resource without output, defaults to True
+      :type empty: bool
+      :returns: A list of OutputSink, which keep whole outputs in memory when log_dir is None
+    """
+    if self.log_dir is None:
+      return [OutputSink(None, tail=self.tail) for mod, name in resources]
+    return [OutputSink(os.path.join(self.log_dir, mod, name + ext), tail=self.tail, empty=empty) for mod, name in resources]
+
+  def error_sinks(self, resources:list) -> list:
+    """Creates a sink for each resource that streams its stderr to log_dir/<mod>/<name>.err, only when it has stderr
+    """
+    return self.output_sinks(resources, ext='.err', empty=False)
+
+  def store_output(self, param:dict, output:str, sink=None, error=None):
+    """Stores the output of a resource in the blob store, and only its digest and size in its state
+      :param output: The whole output, or only a tail of the output with a sink
+      :type output: string
+      :param sink: The OutputSink of the resource, which holds the bytes of the whole output, defaults to None
+      :type sink: OutputSink
+      :param error: The OutputSink of the stderr of the resource, which is stored when not empty, defaults to None
+      :type error: OutputSink
+    """
+    if sink is not None:
+      digest = self.__store_sink(sink)
+      size = sink.size
+    else:
+      data = output.encode('utf-8')
+      digest = self.blobs.put(data) if self.blobs is not None else hashlib.sha256(data).hexdigest()
+      size = len(data)
+    param['output_digest'] = digest
+    param['output_size'] = size
+    if error is not None and error.size > 0:
+      param['error_digest'] = self.__store_sink(error)
+      param['error_size'] = error.size
+    else:
+      param.pop('error_digest', None)
+      param.pop('error_size', None)
+
+  def __store_sink(self, sink) -> str:
+    digest = sink.digest()
+    if self.blobs is not None:
+      if sink.data is not None:
+        self.blobs.put(bytes(sink.data))
       else:
-        self.log.error('mod {} returned status code {}.'.format(mod, status))
+        self.blobs.put_file(sink.path, digest)
+    return digest
+
+  def run_commands(self, commands:list, sinks:list=None, done=None, resources:list=None, errors:list=None) -> list:
+    """Runs commands in order, on parallel channels of the one connection, or as batch scripts
+      :param commands: A list of commands returned by ssh_command
+      :type commands: list
+      :param sinks: A list of OutputSink for each command, defaults to None
+      :type sinks: list
+      :param done: A function called with (idx, status, output) as each command finishes, e.g. to journal it
+      :type done: function
+      :param resources: A list of (mod, name) for each command that tags its span and selects its exec_profile, defaults to None
+      :type resources: list
+      :param errors: A list of OutputSink for the stderr of each command, defaults to None to keep stderr in the output
+      :type errors: list
+      :returns: A list of (status, output) pairs in the order of commands, where output is the tail of a sink
+    """
+    if self.batch and len(commands) > 0:
+      with TRACER.span('batch', commands=len(commands)):
+        results = self.__run_batch(commands)
+      for idx, (status, output) in enumerate(results):
+        if sinks is not None:
+          sinks[idx].write(output.encode('utf-8'))
+          sinks[idx].close()
+          results[idx] = (status, sinks[idx].tail)
+        if errors is not None:
+          # A batch script keeps stderr in its output
+          errors[idx].close()
+        if done is not None:
+          done(idx, *results[idx])
+      return results
+    jobs = []
+    for idx, exec in enumerate(commands):
+      # The sudo password is written to stdin once, see sudo_command
+      input_data = self.sudo_password if needs_sudo_input(exec) else None
+      jobs.append((idx, exec, input_data))
+    if self.channels > 1:
+      with ThreadPoolExecutor(max_workers=self.channels) as pool:
+        # Each command runs in a copy of the context, so that spans keep the tags of the host
+        futures = [pool.submit(contextvars.copy_context().run, self.__run_command, *job, sinks, done, resources, errors) for job in jobs]
+        return [future.result() for future in futures]
+    return [self.__run_command(*job, sinks, done, resources, errors) for job in jobs]
+
+  def __run_command(self, idx:int, exec:str, input_data:str, sinks:list, done, resources:list=None, errors:list=None) -> tuple:
+    mod, name = resources[idx] if resources is not None else (None, None)
+    pty = exec_profile(mod)['pty']
+    # A terminal has one stream, so stderr is only separate without a PTY
+    error = errors[idx] if errors is not None and not pty else None
+    with TRACER.span('resource', mod=mod, name=name):
+      if sinks is None:
+        chunks = []
+        status = self.ssh.run_stream(exec, chunks.append, input_data, self.timeout, pty=pty, stderr_sink=error)
+        output = b''.join(chunks).decode('utf-8', errors='replace')
+      else:
+        status = self.ssh.run_stream(exec, sinks[idx], input_data, self.timeout, pty=pty, stderr_sink=error)
+        sinks[idx].close()
+        output = sinks[idx].tail
+    if error is not None:
+      error.close()
+      if status != 0 and error.tail != '':
+        self.log.warning('{}.{} returned status code {} with stderr: {}', mod, name, status, error.tail.strip())
+    if done is not None:
+      done(idx, status, output)
+    return status, output
+
+  def __run_batch(self, commands:list) -> list:
+    """Runs commands as remote scripts, which is one round trip unless the commands exceed BATCH_LIMIT
+    """
+    marker = batch_marker()
+    # Each command of a script is killed after self.timeout, and the script only after all of them
+    # as a last resort, e.g. for a host without pkill
+    scripts = batch_scripts(commands, marker, timeout=self.timeout)
+    self.log.info('batch {} commands into {} scripts.', len(commands), len(scripts))
+    jobs = [(exec, self.sudo_password if any(needs_sudo_input(commands[idx]) for idx in indices) else None) for exec, indices in scripts]
+    timeout = self.timeout * max(len(indices) for exec, indices in scripts) + 30
+    if self.channels > 1:
+      outputs = self.ssh.run_many(jobs, max_channels=self.channels, timeout=timeout)
+    else:
+      outputs = [self.ssh.run(exec, input_data, timeout) for exec, input_data in jobs]
+    results = [None] * len(commands)
+    for (exec, indices), (status, output) in zip(scripts, outputs):
+      for idx, result in zip(indices, batch_results(output, marker, indices)):
+        results[idx] = result
+    return results
@@ -0,0 +1,102 @@
+from common.ssh_command import needs_sudo_input
+import re, shlex, uuid
+
+BATCH_LIMIT = 65536
+
+def batch_marker() -> str:
+  '''
+  Create a random marker that does not appear in the output of commands.
+
+  @returns              The marker for batch_scripts and batch_results.
+  '''
+  return 'VIKI' + uuid.uuid4().hex
+
+# Kills a subshell and its children. The subshell is stopped first, so that it neither runs its next
+# command when a child dies nor leaves its children to init when it dies first
+KILL_FUNCTION = ('viki_kill() { kill -STOP "$1" 2>/dev/null; pkill -TERM -P "$1" 2>/dev/null; '
+  'kill -TERM "$1" 2>/dev/null; kill -CONT "$1" 2>/dev/null; }\n')
+
+def batch_scripts(commands: list, marker: str, limit: int = BATCH_LIMIT, timeout: int = None) -> list:
+  '''
+  Render many ssh commands into as few remote shell scripts as possible.
+
+  Each command runs in a subshell between a begin and an end line, where
+  the end line holds its exit status, e.g. for the commands ["ls ~"]:
+
+    printf '%s %d\n' VIKI...:begin 0
+    ( ls ~ ); s=$?; printf '\n%s %d %d\n' VIKI...:end 0 $s
+
+  With a timeout, each command runs in the background next to a watchdog
+  that kills it after timeout seconds, so that a hung command does not
+  hold up the commands after it, e.g. with a timeout of 180:
+
+    ( ls ~
+    ) & p=$!; ( sleep 180 >/dev/null 2>&1 && printf ... && viki_kill $p ) & w=$!
+    wait $p; s=$?; viki_kill $w; printf '\n%s %d %d\n' VIKI...:end 0 $s
+
+  A script is split when its length exceeds limit, as the remote shell
+  limits the length of one argument (128 KiB on Linux). A script with a
+  command of sudo_command reads the sudo password once, before its first
+  command, as each subshell would otherwise read it from stdin again.
+
+  @param commands       The ssh commands returned by ssh_command.
+  @param marker         The marker returned by batch_marker.
+  @param limit          The maximum length of a script. (Default: 64 KiB)
+  @param timeout        The seconds after which a command is killed, or
+                        None to wait for it. (Default: None)
+  @returns              A list of (command, indices) pairs, where command
+                        runs the script and indices are the positions in
+                        commands that it covers.
+  '''
+  scripts = []
+  lines = []
+  indices = []
+  size = 0
+  for idx, command in enumerate(commands):
+    if timeout is None:
+      run = "( {0}\n); s=$?".format(command)
+    else:
+      run = ("( {0}\n) & p=$!; ( sleep {1} >/dev/null 2>&1 && printf '\\nERROR: timeout after %d seconds\\n' {1} && viki_kill $p ) & w=$!\n"
+        "wait $p; s=$?; viki_kill $w").format(command, int(timeout))
+    line = "printf '%s %d\\n' {0}:begin {1}\n{2}; printf '\\n%s %d %d\\n' {0}:end {1} $s\n".format(marker, idx, run)
+    if len(lines) > 0 and size + len(line) > limit:
+      scripts.append((batch_script(commands, lines, indices, timeout), indices))
+      lines = []
+      indices = []
+      size = 0
+    lines.append(line)
+    indices.append(idx)
+    size += len(line)
+  if len(lines) > 0:
+    scripts.append((batch_script(commands, lines, indices, timeout), indices))
+  return scripts
+
+def batch_script(commands: list, lines: list, indices: list, timeout: int = None) -> str:
+  sudo = any(needs_sudo_input(commands[idx]) for idx in indices)
+  return 'sh -c ' + shlex.quote(('IFS= read -r VIKI_SUDO\n' if sudo else '') + (KILL_FUNCTION if timeout is not None else '') + ''.join(lines))
+
+def batch_results(output: str, marker: str, indices: list) -> list:
+  '''
+  Split the output of a script from batch_scripts into the results of
+  its commands.
+
+  @param output         The output of the script.
+  @param marker         The marker returned by batch_marker.
+  @param indices        The positions in commands covered by the script.
+  @returns              A list of (status, output) pairs in the order of
+                        indices, where status is -1 for a command that did
+                        not finish, e.g. after a timeout.
+  '''
+  found = {}
+  pattern = re.compile(
+    r'{0}:begin (\d+)\r?\n(.*?)\r?\n{0}:end \1 (\d+)\r?\n'.format(re.escape(marker)),
+    re.DOTALL)
+  for match in pattern.finditer(output):
+    found[int(match.group(1))] = (int(match.group(3)), match.group(2))
+  results = []
+  for idx in indices:
+    if idx in found:
+      results.append(found[idx])
+    else:
+      results.append((-1, 'ERROR: command did not finish in batch\n'))
+  return results
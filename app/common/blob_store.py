@@ -0,0 +1,88 @@
+import hashlib, os, threading, time, zlib
+
+# An unreferenced blob or temp file is only removed by gc after this many seconds, as an apply that runs
+# at the same time writes its blobs before its state references them
+GC_GRACE = 3600
+
+class BlobStore():
+  def __init__(self, logger, path:str, dir:str="blobs"):
+    """Stores outputs once by their sha256 digest, compressed with zlib, e.g. blobs/ab/ab12...ef
+      :param path: The path of the configuration and state files
+      :type path: string
+      :param dir: A folder name in path, defaults to blobs
+      :type dir: string
+    """
+    self.log = logger
+    self.dir = os.path.join(path, dir)
+
+  def file(self, digest:str) -> str:
+    return os.path.join(self.dir, digest[:2], digest)
+
+  def has(self, digest:str) -> bool:
+    return os.path.isfile(self.file(digest))
+
+  def put(self, data:bytes) -> str:
+    """Stores an output unless a blob with the same digest exists
+      :returns: The sha256 hex digest of data
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    if not self.has(digest):
+      self.__write(digest, [data])
+    return digest
+
+  def put_file(self, file:str, digest:str) -> str:
+    """Stores a log file, whose digest is already known from its OutputSink, unless the blob exists
+    """
+    if not self.has(digest):
+      with open(file, 'rb') as fp:
+        self.__write(digest, iter(lambda: fp.read(65536), b''))
+    return digest
+
+  def get(self, digest:str) -> bytes:
+    with open(self.file(digest), 'rb') as fp:
+      return zlib.decompress(fp.read())
+
+  def __write(self, digest:str, chunks):
+    file = self.file(digest)
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    # Hosts may store the same output at the same time, so each writer has its own temp file
+    tmp = '{}.{}.{}.tmp'.format(file, os.getpid(), threading.get_ident())
+    compress = zlib.compressobj(6)
+    with open(tmp, 'wb') as fp:
+      for chunk in chunks:
+        fp.write(compress.compress(chunk))
+      fp.write(compress.flush())
+    os.replace(tmp, file)
+
+  def gc(self, digests:set, grace:int=GC_GRACE) -> tuple:
+    """Removes the blobs whose digest is not in digests, and temp files left by a crash
+      :param digests: The digests that are referenced by every state
+      :type digests: set
+      :param grace: The seconds since its last change before a blob or temp file is removed, defaults to GC_GRACE
+      :type grace: int
+      :returns: A tuple of (number of blobs removed, number of bytes freed)
+    """
+    count = 0
+    size = 0
+    if not os.path.isdir(self.dir):
+      return count, size
+    before = time.time() - grace
+    for prefix in os.listdir(self.dir):
+      folder = os.path.join(self.dir, prefix)
+      if not os.path.isdir(folder):
+        continue
+      # Empty folders are kept, as a writer may be about to create its temp file in one
+      for name in os.listdir(folder):
+        if name in digests:
+          continue
+        file = os.path.join(folder, name)
+        try:
+          stat = os.stat(file)
+          if stat.st_mtime > before:
+            continue
+          os.remove(file)
+        except FileNotFoundError:
+          continue  # Renamed into place or removed by another gc
+        size += stat.st_size
+        count += 1
+    return count, size
@@ -0,0 +1,212 @@
+'''
+Sends a changed file as the blocks that the host already has and the bytes that it does not, as rsync does.
+
+The host splits its copy of a file into blocks and sends a weak and a strong checksum of each, the signature.
+viki rolls the weak checksum over the new file one byte at a time, and a block that matches both checksums is
+sent as a copy of the block instead of its bytes. The host then builds the new file from its old copy and the
+delta. This file only uses the standard library of Python 3, as viki uploads it to each host and runs:
+
+  signature     python3 block_delta.py signature <path> <block size>          writes the signature to stdout
+  patch         python3 block_delta.py patch <path> <delta> <new> <sha256>    writes <new> and removes <delta>
+'''
+import hashlib, math, os, struct, sys, zlib
+
+# The weak checksum is adler32, which zlib computes for a block and delta rolls by one byte
+ADLER_MOD = 65521
+STRONG_SIZE = 16
+# block size, file size and number of blocks, followed by the weak and strong checksum of each block
+HEADER = struct.Struct('>IQI')
+BLOCK = struct.Struct('>I%ds' % STRONG_SIZE)
+COPY = struct.Struct('>cII')
+LITERAL = struct.Struct('>cI')
+# A literal op holds at most this many bytes, so that neither side keeps a whole file in one op
+LITERAL_LIMIT = 1 << 20
+
+def block_size(size):
+  # About the square root of the size, as rsync does, which balances the signature against the delta
+  return min(1 << 17, max(2048, 1 << math.ceil(math.log2(max(1, math.isqrt(size))))))
+
+def strong(data):
+  return hashlib.blake2b(data, digest_size=STRONG_SIZE).digest()
+
+def signature(fp, size):
+  blocks = []
+  length = 0
+  while True:
+    data = fp.read(size)
+    if not data:
+      break
+    length += len(data)
+    blocks.append(BLOCK.pack(zlib.adler32(data), strong(data)))
+  return HEADER.pack(size, length, len(blocks)) + b''.join(blocks)
+
+def parse_signature(data):
+  '''
+  Parse the output of signature.
+
+  @returns              A tuple of (block size, file size, blocks), where blocks is a list of (weak, strong).
+  '''
+  if len(data) < HEADER.size:
+    raise ValueError('signature has {} bytes.'.format(len(data)))
+  size, length, count = HEADER.unpack_from(data)
+  if len(data) != HEADER.size + count * BLOCK.size:
+    raise ValueError('signature has {} bytes, expected {}.'.format(len(data), HEADER.size + count * BLOCK.size))
+  return size, length, [BLOCK.unpack_from(data, HEADER.size + idx * BLOCK.size) for idx in range(count)]
+
+def delta(fp, size, length, blocks, write):
+  '''
+  Write the ops that build a new file from a file with the signature blocks.
+
+  Consecutive blocks are sent as one copy op, e.g. an unchanged file is a single copy op. The new file is
+  read in chunks, and the bytes that match no block are sent once they reach LITERAL_LIMIT, so that only
+  about two chunks of the file are in memory.
+
+  @param fp             The new file, opened for reading.
+  @param size           The block size of the signature.
+  @param length         The size of the file of the signature.
+  @param blocks         The list of (weak, strong) returned by parse_signature.
+  @param write          A callable that takes the bytes of each op.
+  @returns              The number of literal bytes, i.e. the bytes that the host did not have.
+  '''
+  # The last block of the old file is shorter unless the size is a multiple of the block size, and it
+  # can only match the end of the new file
+  short = length % size
+  table = {}
+  for idx, (weak, digest) in enumerate(blocks[:-1] if short else blocks):
+    table.setdefault(weak, {}).setdefault(digest, idx)
+  chunk = max(LITERAL_LIMIT, 4 * size)
+  # The bytes of the new file from the first byte that is not sent yet, where start and pos index data
+  data = b''
+  eof = False
+  literal = 0
+  copy = None
+  start = pos = 0
+  weak = None
+  a = b = 0
+
+  def emit_literal(end):
+    nonlocal copy, literal
+    if start >= end:
+      return
+    if copy is not None:
+      write(COPY.pack(b'c', *copy))
+      copy = None
+    for offset in range(start, end, LITERAL_LIMIT):
+      part = data[offset:min(end, offset + LITERAL_LIMIT)]
+      write(LITERAL.pack(b'l', len(part)) + part)
+      literal += len(part)
+
+  def emit_copy(idx):
+    nonlocal copy
+    if copy is not None and copy[0] + copy[1] == idx:
+      copy = (copy[0], copy[1] + 1)
+      return
+    if copy is not None:
+      write(COPY.pack(b'c', *copy))
+    copy = (idx, 1)
+
+  write(struct.pack('>I', size))
+  while True:
+    if pos + size >= len(data) and not eof:
+      # The window and the byte after it are read first, and the bytes before start are dropped
+      if pos - start >= LITERAL_LIMIT:
+        emit_literal(pos)
+        start = pos
+      more = fp.read(chunk)
+      eof = more == b''
+      data = data[start:] + more
+      pos -= start
+      start = 0
+      continue
+    if pos + size > len(data):
+      break
+    if weak is None:
+      weak = zlib.adler32(data[pos:pos + size])
+      a = weak & 0xffff
+      b = weak >> 16
+    candidates = table.get(weak)
+    if candidates is not None:
+      idx = candidates.get(strong(data[pos:pos + size]))
+      if idx is not None:
+        emit_literal(pos)
+        emit_copy(idx)
+        pos += size
+        start = pos
+        weak = None
+        continue
+    if pos + size == len(data):
+      break
+    out = data[pos]
+    a = (a - out + data[pos + size]) % ADLER_MOD
+    b = (b - size * out + a - 1) % ADLER_MOD
+    weak = (b << 16) | a
+    pos += 1
+  n = len(data)
+  if short and n - start >= short:
+    end = data[n - short:]
+    if (zlib.adler32(end), strong(end)) == tuple(blocks[-1]):
+      emit_literal(n - short)
+      emit_copy(len(blocks) - 1)
+      start = n
+  emit_literal(n)
+  if copy is not None:
+    write(COPY.pack(b'c', *copy))
+  write(b'e')
+  return literal
+
+def patch(old, ops, new, size):
+  '''
+  Build a new file from an old file and the ops of delta.
+
+  @param old            The old file, opened for reading.
+  @param ops            The file of the ops, opened for reading.
+  @param new            The new file, opened for writing.
+  @param size           The block size of the signature.
+  @returns              The sha256 hex digest of the new file.
+  '''
+  digest = hashlib.sha256()
+  while True:
+    op = ops.read(1)
+    if op == b'c':
+      idx, count = struct.unpack('>II', ops.read(8))
+      old.seek(idx * size)
+      remaining = count * size
+      while remaining > 0:
+        data = old.read(min(remaining, LITERAL_LIMIT))
+        if not data:
+          break
+        new.write(data)
+        digest.update(data)
+        remaining -= len(data)
+    elif op == b'l':
+      length, = struct.unpack('>I', ops.read(4))
+      data = ops.read(length)
+      new.write(data)
+      digest.update(data)
+    elif op == b'e':
+      return digest.hexdigest()
+    else:
+      raise ValueError('delta ended without an end op.')
+
+def main(argv):
+  if len(argv) == 3 and argv[0] == 'signature':
+    with open(argv[1], 'rb') as fp:
+      sys.stdout.buffer.write(signature(fp, int(argv[2])))
+    return 0
+  if len(argv) == 5 and argv[0] == 'patch':
+    path, ops_path, new_path, expected = argv[1:]
+    with open(ops_path, 'rb') as ops:
+      size, = struct.unpack('>I', ops.read(4))
+      with open(path, 'rb') as old, open(new_path, 'wb') as new:
+        digest = patch(old, ops, new, size)
+    os.remove(ops_path)
+    if digest != expected:
+      os.remove(new_path)
+      sys.stderr.write('sha256 of {} is {}, expected {}\n'.format(new_path, digest, expected))
+      return 1
+    return 0
+  sys.stderr.write(__doc__)
+  return 2
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
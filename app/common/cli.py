@@ -1,4 +1,13 @@
-import argparse
+import argparse, sys
+
+class StartupProfileAction(argparse.Action):
+  def __call__(self, parser, namespace, values, option_string=None):
+    """Runs the rest of the command line again with python -X importtime and exits, like --help
+    """
+    from common.startup_profile import startup_profile
+    argv = [arg for arg in sys.argv[1:] if arg != option_string]
+    print(startup_profile(sys.argv[0], argv))
+    parser.exit()
 
 class Cli:
   def __init__(self, app:str, desc:str):
@@ -8,9 +17,24 @@ class Cli:
     self.subparser = self.parser.add_subparsers(dest='command')
     self.subparser.required = True
     self.__add_option_path()
+    self.__add_option_limit()
+    self.__add_option_workers()
+    self.__add_option_channels()
+    self.__add_option_batch()
+    self.__add_option_tail()
+    self.__add_option_timeout()
+    self.__add_option_facts()
+    self.__add_option_profile()
+    self.__add_option_verbose()
+    self.__add_option_startup_profile()
+    self.__add_option_daemon()
+    self.__add_option_agent()
     self.__add_command_fetch()
     self.__add_command_plan()
     self.__add_command_apply()
+    self.__add_command_refresh()
+    self.__add_command_gc()
+    self.__add_command_daemon()
 
   def __add_option_path(self):
     self.parser.add_argument(
@@ -21,6 +45,126 @@ class Cli:
       help='path to the configuration and state files'
     )
 
+  def __add_option_limit(self):
+    self.parser.add_argument(
+      '-l',
+      '--limit',
+      type=str,
+      default=None,
+      help='comma separated hosts or groups from the inventory, defaults to all hosts'
+    )
+
+  def __add_option_workers(self):
+    self.parser.add_argument(
+      '-w',
+      '--workers',
+      type=int,
+      default=8,
+      help='maximum number of hosts to run in parallel'
+    )
+
+  def __add_option_channels(self):
+    self.parser.add_argument(
+      '-c',
+      '--channels',
+      type=int,
+      default=4,
+      help='maximum number of commands to run in parallel on one connection, e.g. the resources of a depends_on level, which are independent, defaults to 4, and 1 runs one command at a time'
+    )
+
+  def __add_option_batch(self):
+    self.parser.add_argument(
+      '-b',
+      '--batch',
+      action='store_true',
+      help='run the resources of fetch and apply as one remote script per host'
+    )
+
+  def __add_option_tail(self):
+    self.parser.add_argument(
+      '-t',
+      '--tail',
+      type=int,
+      default=4096,
+      help='number of output characters kept in memory for each resource, where the full output is in the logs and blobs folders'
+    )
+
+  def __add_option_timeout(self):
+    self.parser.add_argument(
+      '--timeout',
+      type=int,
+      default=180,
+      help='number of seconds after which a resource command is killed, also inside a batch script'
+    )
+
+  def __add_option_facts(self):
+    self.parser.add_argument(
+      '--facts-ttl',
+      type=int,
+      default=3600,
+      help='number of seconds that facts of a host, e.g. installed mods, are cached in $XDG_CACHE_HOME/viki'
+    )
+    self.parser.add_argument(
+      '--refresh-facts',
+      action='store_true',
+      help='probe the facts of each host again regardless of the cache'
+    )
+
+  def __add_option_profile(self):
+    self.parser.add_argument(
+      '--profile',
+      action='store_true',
+      help='time connect, exec and state writes, and print the slowest resources at the end of a run'
+    )
+    self.parser.add_argument(
+      '--trace',
+      type=str,
+      default=None,
+      help='save the timing spans of a run to a Chrome trace file, e.g. trace.json'
+    )
+    self.parser.add_argument(
+      '--metrics',
+      type=str,
+      default=None,
+      help='save the timing spans of a run to a Prometheus textfile, e.g. viki.prom'
+    )
+
+  def __add_option_verbose(self):
+    self.parser.add_argument(
+      '-v',
+      '--verbose',
+      action='store_true',
+      help='log the SSH diagnostics of each command, e.g. bytes read and exit status'
+    )
+
+  def __add_option_startup_profile(self):
+    self.parser.add_argument(
+      '--startup-profile',
+      action=StartupProfileAction,
+      nargs=0,
+      help='run the command again with python -X importtime and print the slowest imports, e.g. --startup-profile plan --offline'
+    )
+
+  def __add_option_agent(self):
+    self.parser.add_argument(
+      '--agent',
+      action='store_true',
+      help='run the commands of each host through a Python agent on one SSH channel, like the host var transport: agent'
+    )
+
+  def __add_option_daemon(self):
+    self.parser.add_argument(
+      '--daemon',
+      action='store_true',
+      help='run the commands on the connections of a viki daemon, or connect directly when no daemon is running'
+    )
+    self.parser.add_argument(
+      '--socket',
+      type=str,
+      default=None,
+      help='path to the Unix socket of the viki daemon, defaults to $VIKI_SOCKET or ~/.viki/daemon.sock'
+    )
+
   def __add_command_fetch(self):
     self.subparser.add_parser(
       'fetch',
@@ -28,16 +172,69 @@ class Cli:
     )
 
   def __add_command_plan(self):
-    self.subparser.add_parser(
+    parser = self.subparser.add_parser(
       'plan',
       help='create a plan from configuration files'
     )
+    parser.add_argument(
+      '--offline',
+      action='store_true',
+      help='create the plan from the configuration and state files only, without connecting to any host'
+    )
+    parser.add_argument(
+      '-out',
+      '--out',
+      type=str,
+      default=None,
+      help='save the plan to a file, e.g. plan.vkplan, that apply runs without planning again'
+    )
 
   def __add_command_apply(self):
-    self.subparser.add_parser(
+    parser = self.subparser.add_parser(
       'apply',
       help='applies a plan from configuration files'
     )
+    parser.add_argument(
+      'plan_file',
+      nargs='?',
+      default=None,
+      help='a plan file saved by plan -out, which is applied without approval'
+    )
+
+  def __add_command_refresh(self):
+    self.subparser.add_parser(
+      'refresh',
+      help='check that the resources of the state still exist, and mark the missing ones for the next plan'
+    )
+
+  def __add_command_gc(self):
+    self.subparser.add_parser(
+      'gc',
+      help='remove the blobs of outputs that no state file of the inventory references'
+    )
+
+  def __add_command_daemon(self):
+    parser = self.subparser.add_parser(
+      'daemon',
+      help='keep the SSH connections of each host open for the runs with --daemon'
+    )
+    parser.add_argument(
+      '--idle',
+      type=int,
+      default=600,
+      help='number of seconds after which an unused connection is closed'
+    )
+    parser.add_argument(
+      '--check',
+      type=int,
+      default=30,
+      help='number of seconds after which a connection is checked before it is used again'
+    )
+    parser.add_argument(
+      '--status',
+      action='store_true',
+      help='print the connections of a running daemon instead of starting one'
+    )
 
   def args(self):
     return self.parser.parse_args()
\ No newline at end of file
@@ -1,75 +1,210 @@
 from glob import glob
-from pathlib import Path
-import json, os, yaml
+from common.blob_store import BlobStore
+from common.logger import flush
+from common.state_store import StateStore
+import hashlib, json, os
+
+CONFIG_CACHE_VERSION = 2
+FACTS_CACHE_VERSION = 1
+# Number of changed configuration files that are parsed in parallel processes
+CONFIG_PARALLEL = 16
+
+def load_yaml(file:str) -> dict:
+  """Parses the viki section of a configuration file with the libyaml loader if available
+  """
+  # Imported here, as the config cache skips parsing when no configuration file changed
+  import yaml
+  loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+  with open(file) as fp:
+    data = yaml.load(fp, Loader=loader)
+  if data is None or not 'viki' in data or data['viki'] is None:
+    return {}
+  return data['viki']
+
+def config_cache_file(path:str) -> str:
+  '''
+  Get the cache file of the configuration files in a path.
+
+  The cache is kept per user and outside the path, as the path is often a
+  repository that others commit to, e.g. in CI.
+
+  @param path           The path of the configuration files.
+  @returns              A file in $XDG_CACHE_HOME/viki, or ~/.cache/viki,
+                        named by the sha256 of the absolute path.
+  '''
+  return cache_file('config', path)
+
+def facts_cache_file(state_file:str) -> str:
+  '''
+  Get the cache file of the facts of a host, e.g. the which of each mod.
+
+  The facts are kept apart from the state, so that plan, which probes
+  them, does not write the state.
+
+  @param state_file     The state file of the host.
+  @returns              A file in $XDG_CACHE_HOME/viki, or ~/.cache/viki,
+                        named by the sha256 of the absolute state file.
+  '''
+  return cache_file('facts', state_file)
+
+def cache_file(kind:str, path:str) -> str:
+  base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+  digest = hashlib.sha256(os.path.abspath(path).encode('utf-8')).hexdigest()[:32]
+  return os.path.join(base, 'viki', kind + '-' + digest + '.json')
+
+def json_data(data) -> bool:
+  '''
+  Check that parsed YAML comes back unchanged from JSON, e.g. without dates or integer keys.
+  '''
+  try:
+    return json.loads(json.dumps(data)) == data
+  except (TypeError, ValueError):
+    return False
 
 class CliRequest():
   def __init__(self, logger, path="."):
     self.log = logger
-    self.log.fn = self.__class__.__name__ + '.' + self.__init__.__name__
     self.path = path
-    self.state = self.__load_state(state={
-      'viki': {
-        'data': {},
-        'mods': {}
-      }
-    })
-    self.log.info("load state file complete.")
     self.config = self.__load_config(config={
       'viki': {
         'data': {},
         'vars': {},
-        'mods': {}
+        'mods': {},
+        'hosts': {},
+        'groups': {}
       }
     })
     self.log.info("load config files complete.")
     self.vars = self.__load_os(self.config['vars'])
     self.mods = self.config['mods']
     self.data = self.config['data']
-    self.state_mods = self.state['viki']['mods']
+    self.hosts = self.config['hosts']
+    self.groups = self.config['groups']
 
-  def __load_state(self, state:dict, file="state.vk.json"):
-    """Loads a state file
-      :param file: A file name, defaults to state.vk.json
-      :type file: string
+  def state_file(self, host:str=None) -> str:
+    """Returns the state file name of a host
+      :param host: A host name from the inventory, defaults to None for a single server
+      :type host: string
     """
-    self.log.fn = self.__class__.__name__ + '.' + self.__load_state.__name__
-    state_file = Path(self.path + '/' + file)
-    if state_file.is_file():
-      with open(self.path + '/' + file) as fp:
-        state = json.load(fp)
-      fp.close()
-    return state
-
-  def write_state(self, state:dict, file="state.vk.json"):
-    """Writes a state file
-      :param file: A file name, defaults to state.vk.json
-      :type file: string
+    if host is None:
+      return "state.vk.json"
+    return "state." + host + ".vk.json"
+
+  def state_store(self, host:str=None) -> StateStore:
+    """Returns the store of the state file of a host, which journals each change
+      :param host: A host name from the inventory, defaults to None for a single server
+      :type host: string
+    """
+    return StateStore(self.log, self.path, file=self.state_file(host))
+
+  def blob_store(self) -> BlobStore:
+    """Returns the store of outputs, which is shared by every host so that identical outputs are stored once
     """
-    self.log.fn = self.__class__.__name__ + '.' + self.write_state.__name__
-    with open(self.path + '/' + file, 'w') as fp:
-      json.dump(state, fp, indent=2)
-    fp.close()
-    return state
-
-  def __load_config(self, config:dict):
-    """Loads one or more configuration files
+    return BlobStore(self.log, self.path)
+
+  def load_state(self, host:str=None, store:StateStore=None) -> dict:
+    """Loads the state file of a host with its journal
+      :param host: A host name from the inventory, defaults to None for a single server
+      :type host: string
     """
-    self.log.fn = self.__class__.__name__ + '.' + self.__load_config.__name__
+    if store is None:
+      store = self.state_store(host)
+    return store.load(state={
+      'viki': {
+        'data': {},
+        'mods': {}
+      }
+    })
+
+  def load_facts(self, host:str=None, facts:dict=None) -> dict:
+    """Loads the cached facts of a host
+      :param host: A host name from the inventory, defaults to None for a single server
+      :type host: string
+      :param facts: The facts section of a state of an earlier version, used when there is no cache, defaults to None
+      :type facts: dict
+    """
+    cache = self.__load_cache(facts_cache_file(os.path.join(self.path, self.state_file(host))), FACTS_CACHE_VERSION)
+    if isinstance(cache.get('facts'), dict):
+      return cache['facts']
+    return facts if isinstance(facts, dict) else {}
+
+  def write_facts(self, host:str=None, facts:dict=None):
+    """Writes the facts of a host to its cache, which is optional, so an error is ignored
+    """
+    self.__write_cache(facts_cache_file(os.path.join(self.path, self.state_file(host))), {
+      'version': FACTS_CACHE_VERSION,
+      'facts': facts
+    })
+
+  def __load_config(self, config:dict, file:str=None):
+    """Loads one or more configuration files, where each parsed file is cached by its mtime and size
+      :param file: A cache file, defaults to config_cache_file of the path
+      :type file: string
+    """
+    if file is None:
+      file = config_cache_file(self.path)
     viki = config['viki']
-    paths = [Path(p) for p in glob(self.path + '/' + '*.vk.yaml')]
-    for file in paths:
-      with open(file) as fp:
-        data = yaml.safe_load(fp)
-        for conf, obj in viki.items():
-          if conf in data['viki']:
-            for key, val in data['viki'][conf].items():
-              if not key in viki[conf]:
-                viki[conf][key] = val
-              else:
-                self.log.error("Duplicate key {} found.".format(key), KeyError)
-      fp.close()
+    paths = sorted(glob(self.path + '/' + '*.vk.yaml'))
+    stamps = {}
+    for path in paths:
+      stat = os.stat(path)
+      stamps[path] = [stat.st_mtime_ns, stat.st_size]
+    cache = self.__load_cache(file, CONFIG_CACHE_VERSION)
+    if cache.get('stamps') == stamps and 'merged' in cache:
+      return cache['merged']
+
+    files = cache.get('files', {})
+    changed = [path for path in paths if not isinstance(files.get(path), dict) or not 'data' in files[path] or files[path].get('stamp') != stamps[path]]
+    if len(changed) >= CONFIG_PARALLEL:
+      from concurrent.futures import ProcessPoolExecutor
+      with ProcessPoolExecutor() as pool:
+        parsed = list(pool.map(load_yaml, changed))
+    else:
+      parsed = [load_yaml(path) for path in changed]
+    for path, data in zip(changed, parsed):
+      files[path] = {'stamp': stamps[path], 'data': data}
+
+    for path in paths:
+      data = files[path]['data']
+      for conf in viki.keys():
+        if conf in data and data[conf] is not None:
+          duplicates = viki[conf].keys() & data[conf].keys()
+          if duplicates != set():
+            msg = "Duplicate key {} found in {}.".format(sorted(duplicates)[0], path)
+            self.log.error(msg, ValueError(msg))
+          viki[conf].update(data[conf])
+    if not all(json_data(files[path]['data']) for path in changed):
+      # A file with values that JSON does not keep is parsed on every run
+      return viki
+    self.__write_cache(file, {
+      'version': CONFIG_CACHE_VERSION,
+      'stamps': stamps,
+      'files': {path: files[path] for path in paths},
+      'merged': viki
+    })
     return viki
 
+  def __load_cache(self, file:str, version:int) -> dict:
+    # The cache only holds JSON, so a broken or crafted cache is data and not code
+    try:
+      with open(file) as fp:
+        cache = json.load(fp)
+      if isinstance(cache, dict) and cache.get('version') == version:
+        return cache
+    except (OSError, ValueError):
+      pass  # A missing or broken cache is rebuilt
+    return {}
+
+  def __write_cache(self, file:str, cache:dict):
+    tmp = '{}.{}.tmp'.format(file, os.getpid())
+    try:
+      os.makedirs(os.path.dirname(file), mode=0o700, exist_ok=True)
+      with open(tmp, 'w') as fp:
+        json.dump(cache, fp, separators=(',', ':'))
+      os.replace(tmp, file)
+    except OSError:
+      pass  # The cache is optional, e.g. for a read-only home
+
   def __load_env_file(self):
     """Load environment variables from .env file in the specified path"""
     env_file = os.path.join(self.path, '.env')
@@ -97,7 +232,6 @@ class CliRequest():
         pass  # Fail silently if .env file cannot be read
 
   def __load_os(self, vars:dict) -> dict:
-    self.log.fn = self.__class__.__name__ + '.' + self.__load_os.__name__
     # Load .env file first
     self.__load_env_file()
 
@@ -109,6 +243,8 @@ class CliRequest():
     return vars
 
   def approval(self) -> bool:
+    # The plan is logged through a queue, so it is written before the prompt
+    flush()
     user_input = input("Do you want to perform these actions?  \nviki will perform the actions described above.\n  Only 'yes' will be accepted to approve.\n\n  Enter a value: ")
     if user_input.lower() == 'yes':
       return True
@@ -0,0 +1,183 @@
+from common.daemon_transport import FRAME_ERROR, FRAME_OUTPUT, FRAME_STATUS, FRAME_STDERR, send_frame
+import hashlib, json, os, signal, socketserver, threading, time
+
+class PooledTransport():
+  __slots__ = ('transport', 'lock', 'users', 'commands', 'last_used', 'checked')
+
+  def __init__(self):
+    self.transport = None
+    self.lock = threading.Lock()
+    self.users = 0
+    self.commands = 0
+    self.last_used = time.monotonic()
+    self.checked = self.last_used
+
+class TransportPool():
+  def __init__(self, logger, idle:int=600, check:int=30):
+    """Keeps an authenticated MySSH open for each host and user, which every run shares
+      :param idle: The seconds after which an unused connection is closed, defaults to 600
+      :type idle: int
+      :param check: The seconds after which a connection is checked before it is used again, defaults to 30
+      :type check: int
+    """
+    self.log = logger
+    self.idle = idle
+    self.check = check
+    self.entries = {}
+    self.lock = threading.Lock()
+
+  def key(self, host:dict) -> tuple:
+    # The password is part of the key, so that a changed password does not reuse a connection
+    password = hashlib.sha256(str(host['password']).encode('utf-8')).hexdigest()
+    return (str(host['hostname']), int(host.get('port') or 22), str(host['username']), password)
+
+  def acquire(self, host:dict):
+    """Returns a connected MySSH for host, which the caller passes to release when done, or None
+    """
+    key = self.key(host)
+    with self.lock:
+      entry = self.entries.setdefault(key, PooledTransport())
+      entry.users += 1
+    # Only the first run connects, while other runs of the same host wait for it
+    with entry.lock:
+      now = time.monotonic()
+      if entry.transport is not None and now - entry.checked >= self.check:
+        entry.checked = now
+        if not entry.transport.alive():
+          self.log.warning('connection to {}@{}:{} lost, connecting again.', key[2], key[0], key[1])
+          entry.transport.close()
+          entry.transport = None
+      if entry.transport is None:
+        from common.my_ssh import MySSH
+        transport = MySSH()
+        if transport.connect(key[0], key[2], host['password'], port=key[1]):
+          entry.transport = transport
+          entry.checked = time.monotonic()
+          self.log.info('connected to {}@{}:{}.', key[2], key[0], key[1])
+      if entry.transport is None:
+        self.release(host)
+        return None
+      entry.commands += 1
+      return entry.transport
+
+  def release(self, host:dict):
+    with self.lock:
+      entry = self.entries.get(self.key(host))
+      if entry is not None:
+        entry.users -= 1
+        entry.last_used = time.monotonic()
+
+  def evict(self) -> int:
+    """Closes the connections that no run used for idle seconds
+      :returns: The number of connections closed
+    """
+    now = time.monotonic()
+    with self.lock:
+      keys = [key for key, entry in self.entries.items() if entry.users == 0 and now - entry.last_used >= self.idle]
+      entries = [self.entries.pop(key) for key in keys]
+    for key, entry in zip(keys, entries):
+      if entry.transport is not None:
+        entry.transport.close()
+      self.log.info('closed idle connection to {}@{}:{}.', key[2], key[0], key[1])
+    return len(entries)
+
+  def status(self) -> list:
+    now = time.monotonic()
+    with self.lock:
+      return [{
+        'hostname': key[0],
+        'port': key[1],
+        'username': key[2],
+        'connected': entry.transport is not None,
+        'users': entry.users,
+        'commands': entry.commands,
+        'idle': round(now - entry.last_used, 1)
+      } for key, entry in self.entries.items()]
+
+  def close(self):
+    with self.lock:
+      entries = list(self.entries.values())
+      self.entries = {}
+    for entry in entries:
+      if entry.transport is not None:
+        entry.transport.close()
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    """Answers one request of a DaemonTransport, i.e. connect, run or status
+    """
+    pool = self.server.pool
+    try:
+      request = json.loads(self.rfile.readline())
+    except ValueError:
+      return
+    op = request.get('op')
+    if op == 'status':
+      send_frame(self.connection, FRAME_STATUS, json.dumps(pool.status()).encode('utf-8'))
+      return
+    if not op in ('connect', 'run'):
+      send_frame(self.connection, FRAME_ERROR, 'unknown op {}'.format(op).encode('utf-8'))
+      return
+    host = request['host']
+    transport = pool.acquire(host)
+    if transport is None:
+      send_frame(self.connection, FRAME_ERROR, b'SSH connection failed')
+      return
+    try:
+      status = 0
+      if op == 'run':
+        sink = lambda data: send_frame(self.connection, FRAME_OUTPUT, data)
+        stderr_sink = (lambda data: send_frame(self.connection, FRAME_STDERR, data)) if request.get('stderr') else None
+        status = transport.run_stream(request['cmd'], sink, request.get('input_data'), request.get('timeout', 180),
+          request.get('pty', False), stderr_sink)
+      send_frame(self.connection, FRAME_STATUS, str(status).encode('utf-8'))
+    except OSError:
+      # The client went away, e.g. viki was interrupted
+      pass
+    finally:
+      pool.release(host)
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+def serve(logger, path:str, idle:int=600, check:int=30):
+  '''
+  Run the viki daemon on a Unix socket until it is interrupted.
+
+  The socket is only accessible to the current user, as requests carry the password of each host.
+
+  @param logger         The Logger of the daemon.
+  @param path           The path of the Unix socket.
+  @param idle           The seconds after which an unused connection is closed.
+  @param check          The seconds after which a connection is checked before it is used again.
+  '''
+  os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+  if os.path.exists(path):
+    os.remove(path)
+  pool = TransportPool(logger, idle=idle, check=check)
+  umask = os.umask(0o177)
+  try:
+    server = DaemonServer(path, DaemonHandler)
+  finally:
+    os.umask(umask)
+  server.pool = pool
+  stop = threading.Event()
+
+  def sweep():
+    while not stop.wait(min(idle, check)):
+      pool.evict()
+
+  threading.Thread(target=sweep, daemon=True).start()
+  # shutdown waits for serve_forever, so it is called from another thread
+  signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+  logger.info('viki daemon listening on {}.', path)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    stop.set()
+    server.server_close()
+    pool.close()
+    os.remove(path)
+    logger.info('viki daemon stopped.')
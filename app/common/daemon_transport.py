@@ -0,0 +1,104 @@
+from common.transport import Transport
+import json, os, socket, struct
+
+# A frame is a kind and a length, followed by the payload, e.g. b'o' and a chunk of output
+FRAME = struct.Struct('>cI')
+FRAME_OUTPUT = b'o'
+FRAME_STDERR = b'x'
+FRAME_STATUS = b's'
+FRAME_ERROR = b'e'
+
+def socket_path() -> str:
+  '''
+  Get the path of the Unix socket of the viki daemon.
+
+  @returns              The value of VIKI_SOCKET, or ~/.viki/daemon.sock.
+  '''
+  return os.environ.get('VIKI_SOCKET') or os.path.join(os.path.expanduser('~'), '.viki', 'daemon.sock')
+
+def send_frame(sock, kind:bytes, payload:bytes):
+  sock.sendall(FRAME.pack(kind, len(payload)) + payload)
+
+def recv_frame(rfile) -> tuple:
+  '''
+  Read a frame from a file of a socket.
+
+  @param rfile          The file returned by socket.makefile('rb').
+  @returns              A tuple of (kind, payload), or (None, b'') when the socket closed.
+  '''
+  header = rfile.read(FRAME.size)
+  if len(header) < FRAME.size:
+    return None, b''
+  kind, size = FRAME.unpack(header)
+  return kind, rfile.read(size)
+
+class DaemonTransport(Transport):
+  def __init__(self, path:str=None):
+    """Runs commands on a connection that the viki daemon keeps open, so that a run skips the SSH handshake
+      :param path: The Unix socket of the daemon, defaults to socket_path()
+      :type path: string
+    """
+    self.path = path if path is not None else socket_path()
+    self.host = None
+
+  def reachable(self) -> bool:
+    """Returns True if a daemon listens on the socket
+    """
+    try:
+      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(self.path)
+      return True
+    except OSError:
+      return False
+
+  def connect(self, hostname:str, username:str, password:str, port:int=22) -> bool:
+    host = {'hostname': hostname, 'username': username, 'password': password, 'port': port}
+    kind, payload = self.__request({'op': 'connect', 'host': host}, None)
+    if kind != FRAME_STATUS or payload != b'0':
+      return False
+    self.host = host
+    return True
+
+  def connected(self) -> bool:
+    return self.host is not None
+
+  def close(self):
+    # The connection stays open in the daemon for the next run
+    self.host = None
+
+  def run_stream(self, cmd:str, sink, input_data:str=None, timeout:int=180, pty:bool=False, stderr_sink=None) -> int:
+    if self.host is None:
+      sink(b'ERROR: connection not established\n')
+      return -1
+    request = {'op': 'run', 'host': self.host, 'cmd': cmd, 'input_data': input_data, 'timeout': timeout,
+      'pty': pty, 'stderr': stderr_sink is not None}
+    kind, payload = self.__request(request, sink, stderr_sink)
+    if kind == FRAME_STATUS:
+      return int(payload)
+    sink(b'\nERROR: ' + (payload or b'connection to the viki daemon lost') + b'\n')
+    return -1
+
+  def status(self) -> list:
+    """Returns the connections that the daemon keeps open, as a list of dict
+    """
+    kind, payload = self.__request({'op': 'status'}, None)
+    return json.loads(payload) if kind == FRAME_STATUS else []
+
+  def __request(self, request:dict, sink, stderr_sink=None) -> tuple:
+    """Sends a request on its own socket, passes each output frame to sink, and returns the last frame
+    """
+    try:
+      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(self.path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as rfile:
+          while True:
+            kind, payload = recv_frame(rfile)
+            if kind == FRAME_OUTPUT:
+              sink(payload)
+            elif kind == FRAME_STDERR:
+              stderr_sink(payload)
+            else:
+              return kind, payload
+    except OSError as e:
+      return FRAME_ERROR, str(e).encode('utf-8')
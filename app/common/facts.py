@@ -0,0 +1,34 @@
+import time
+
+class Facts():
+  def __init__(self, facts:dict, ttl:int=3600, refresh:bool=False):
+    """Caches facts of a host, e.g. the result of which for each mod, in the facts section of its state
+      :param facts: The facts section of a state, which is updated in place
+      :type facts: dict
+      :param ttl: The number of seconds before a fact is probed again, defaults to 3600
+      :type ttl: int
+      :param refresh: Probe every fact again regardless of ttl, defaults to False
+      :type refresh: bool
+    """
+    self.facts = facts
+    self.ttl = ttl
+    self.refresh = refresh
+    self.changed = False
+
+  def stale(self, kind:str, keys:list) -> list:
+    """Returns the keys of a kind that are missing or older than ttl
+    """
+    if self.refresh:
+      return list(keys)
+    cached = self.facts.get(kind, {})
+    now = time.time()
+    return [key for key in keys if not key in cached or now - cached[key].get('updated', 0) >= self.ttl]
+
+  def get(self, kind:str, key:str) -> dict:
+    return self.facts.get(kind, {}).get(key)
+
+  def set(self, kind:str, key:str, value:dict):
+    if not kind in self.facts:
+      self.facts[kind] = {}
+    self.facts[kind][key] = dict(value, updated=time.time())
+    self.changed = True
@@ -1,12 +1,17 @@
 from abc import ABC
 from common.base_response import BaseResponse
-from common.ssh_command import DATA_COMMAND, ssh_command
+from common.ssh_command import DATA_COMMAND, DATA_TEMPLATE, sudo_command
 
 class FetchResponse(BaseResponse, ABC):
-  def __init__(self, logger, ssh, config:dict, vars:dict):
+  def __init__(self, logger, ssh, config:dict, vars:dict, facts=None, channels:int=1, batch:bool=False, log_dir:str=None, tail:int=4096, blobs=None, timeout:int=180):
     self.log = logger
-    self.log.fn = self.__class__.__name__ + '.' + self.__init__.__name__
     self.ssh = ssh
+    self.channels = channels
+    self.batch = batch
+    self.log_dir = log_dir
+    self.tail = tail
+    self.timeout = timeout
+    self.blobs = blobs
     self.sudo_password = None
     if 'sudo_password' in vars and vars['sudo_password'] != '':
       self.sudo_password = vars['sudo_password']
@@ -14,24 +19,26 @@ class FetchResponse(BaseResponse, ABC):
     if unknown_mods != set():
       self.log.error('Unknown mods {} found in data.'.format(unknown_mods))
     self.config = config
-    self.check_which(self.config)
+    self.check_params(self.config, DATA_TEMPLATE)
+    self.check_which(self.config, facts)
 
   def fetch(self):
-    self.log.fn = self.__class__.__name__ + '.' + self.fetch.__name__
     state = {}
+    jobs = []
     for mod, names in self.config.items():
       state[mod] = {}
-      cmd = DATA_COMMAND[mod]
-      for name, param in names.items():
-        self.log.info('{}'.format(ssh_command(cmd, param)))
-        exec = ssh_command(cmd, param, self.sudo_password)
-        if exec[:4] == "sudo":
-          status, output = self.ssh.run(exec, self.sudo_password)
-        else:
-          status, output = self.ssh.run(exec, None)
-        if status == 0:
-          state[mod][name] = param
-          state[mod][name]['output'] = output
-        else:
-          self.log.error('mod {} returned status code {}.'.format(mod, status))
+      commands = DATA_TEMPLATE[mod].render_many(list(names.values()))
+      for (name, param), command in zip(names.items(), commands):
+        self.log.info('{}', command)
+        jobs.append((mod, name, param, sudo_command(command, self.sudo_password)))
+    resources = [(mod, name) for mod, name, param, exec in jobs]
+    sinks = self.output_sinks(resources)
+    errors = self.error_sinks(resources)
+    results = self.run_commands([exec for mod, name, param, exec in jobs], sinks, resources=resources, errors=errors)
+    for idx, ((mod, name, param, exec), (status, output)) in enumerate(zip(jobs, results)):
+      if status == 0:
+        state[mod][name] = param
+        self.store_output(state[mod][name], output, sinks[idx], errors[idx])
+      else:
+        self.log.error('mod {} returned status code {}.'.format(mod, status))
     self.state = state
@@ -0,0 +1,435 @@
+from concurrent.futures import ThreadPoolExecutor
+from common.batch_script import BATCH_LIMIT
+from common.block_delta import block_size, delta, parse_signature
+from common.remote_script import ensure_script, script_command
+from common.ssh_command import quote_value
+from common.tracer import TRACER
+import contextvars, hashlib, io, os, posixpath, shlex, stat, threading
+
+# A file of at least this size that changed on the host is sent as a block delta instead of in full
+DELTA_MIN = 1 << 20
+# Files in flight at the same time, each on its own SFTP channel of the one connection, where a block delta
+# opens another channel for block_delta and MaxSessions of sshd defaults to 10
+IN_FLIGHT = 4
+NS = 1000000000
+
+def sftp_path(path: str) -> str:
+  '''
+  Convert a remote path of the shell into a path of SFTP, which does not
+  expand ~ and starts relative paths in the home folder, e.g. "~/a" is "a".
+  '''
+  if path == '~':
+    return '.'
+  if path.startswith('~/'):
+    return path[2:]
+  return path
+
+def file_digest(path: str) -> str:
+  digest = hashlib.sha256()
+  with open(path, 'rb') as fp:
+    for data in iter(lambda: fp.read(1 << 20), b''):
+      digest.update(data)
+  return digest.hexdigest()
+
+def leaf_dirs(names: list) -> list:
+  '''
+  Get the folders of files, deepest first, e.g. for rmdir -p, which also
+  removes each parent that it leaves empty:
+
+    names               ["a", "b/c", "b/d/e"]
+    returns             ["b/d", "b"]
+  '''
+  dirs = set(posixpath.dirname(rel) for rel in names) - {''}
+  return sorted(dirs, key=lambda dir: (-dir.count('/'), dir))
+
+class SyncDiff():
+  __slots__ = ('label', 'src', 'dest', 'files', 'previous', 'remote', 'actions', 'delete')
+
+  def __init__(self, label:str, src:str, dest:str, files:dict, previous:dict):
+    self.label = label
+    self.src = src
+    self.dest = dest
+    self.files = files
+    self.previous = previous
+    self.remote = None
+    # The action of each file, i.e. skip, attrs, put or delta
+    self.actions = {}
+    self.delete = sorted(rel for rel in previous if not rel in files)
+
+  def changed(self) -> bool:
+    return self.delete != [] or any(action != 'skip' for action in self.actions.values())
+
+  def summary(self) -> str:
+    counts = {}
+    for action in self.actions.values():
+      counts[action] = counts.get(action, 0) + 1
+    return '{} to send, {} by delta, {} to update, {} to delete, {} unchanged.'.format(
+      counts.get('put', 0), counts.get('delta', 0), counts.get('attrs', 0), len(self.delete), counts.get('skip', 0))
+
+class FileSync():
+  def __init__(self, logger, ssh, root:str='.', in_flight:int=IN_FLIGHT, python:str='python3'):
+    """Pushes local files and folders to a host over SFTP, where a file is only sent when its size, mtime or sha256 changed
+      :param ssh: The Transport of the host, or None to compare local files with the state only, e.g. plan --offline
+      :type ssh: Transport
+      :param root: The folder that a relative src starts in, i.e. the path of the configuration files, defaults to .
+      :type root: string
+      :param in_flight: The number of files sent at the same time, defaults to IN_FLIGHT
+      :type in_flight: int
+      :param python: The interpreter of block_delta on the host, defaults to python3
+      :type python: string
+    """
+    self.log = logger
+    self.ssh = ssh
+    self.root = root
+    self.in_flight = in_flight
+    self.python = python
+    self.local = threading.local()
+    self.clients = []
+    self.lock = threading.Lock()
+    self.uploaded = False
+
+  def source(self, param:dict) -> str:
+    return os.path.join(self.root, os.path.expanduser(str(param['src'])))
+
+  def check(self, label:str, param:dict) -> str:
+    """Returns the local path of src
+      :raises ValueError: If src is not found
+    """
+    src = self.source(param)
+    if not os.path.exists(src):
+      msg = 'src {} of {} not found.'.format(src, label)
+      self.log.error(msg, ValueError(msg))
+    return src
+
+  def scan(self, src:str, previous:dict=None) -> dict:
+    """Lists the files of src, where a file keeps the sha256 of previous when its size and mtime did not change
+      :param src: A local file, which is synced into dest, or a folder, whose files are synced into dest
+      :type src: string
+      :param previous: The files of the last sync in the state, defaults to None
+      :type previous: dict
+      :returns: A dict of {rel: [size, mtime_ns, sha256, mode]}, where rel is a path in dest
+    """
+    previous = previous if previous is not None else {}
+    if os.path.isfile(src):
+      found = [(os.path.basename(src), src)]
+    else:
+      found = []
+      for dir, dirs, names in os.walk(src):
+        dirs.sort()
+        for name in sorted(names):
+          path = os.path.join(dir, name)
+          found.append((os.path.relpath(path, src).replace(os.sep, '/'), path))
+    files = {}
+    for rel, path in found:
+      st = os.stat(path)
+      if not stat.S_ISREG(st.st_mode):
+        continue
+      entry = previous.get(rel)
+      if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+        digest = entry[2]
+      else:
+        digest = file_digest(path)
+      files[rel] = [st.st_size, st.st_mtime_ns, digest, stat.S_IMODE(st.st_mode)]
+    return files
+
+  def diff(self, resources:list) -> list:
+    """Compares the local files of each resource with the state and with one batched stat on the host
+      :param resources: A list of (label, param, previous), where previous is the files in the state, or None
+      :type resources: list
+      :returns: A list of SyncDiff
+      :raises ValueError: If a src is not found
+    """
+    diffs = []
+    for label, param, previous in resources:
+      src = self.check(label, param)
+      with TRACER.span('sync_scan', name=label):
+        diffs.append(SyncDiff(label, src, str(param['dest']), self.scan(src, previous), previous or {}))
+    if self.ssh is not None:
+      with TRACER.span('sync_stat'):
+        found = self.remote("stat -c '%s %Y %a %n'", [(diff.dest, list(diff.files)) for diff in diffs])
+      for diff, lines in zip(diffs, found):
+        diff.remote = {}
+        for line in lines:
+          fields = line.split(' ', 3)
+          if len(fields) == 4 and fields[0].isdigit() and fields[1].isdigit():
+            diff.remote[fields[3]] = (int(fields[0]), int(fields[1]), int(fields[2], 8))
+    verify = [[] for diff in diffs]
+    for idx, diff in enumerate(diffs):
+      for rel, entry in diff.files.items():
+        action = self.__action(diff, rel, entry)
+        if action == 'verify':
+          verify[idx].append(rel)
+        else:
+          diff.actions[rel] = action
+    if any(rels != [] for rels in verify):
+      # A file with the size and mtime of the local file, which the state does not know, e.g. the first
+      # sync of a folder copied by other means, is compared by its sha256
+      with TRACER.span('sync_verify'):
+        found = self.remote('sha256sum', [(diff.dest, rels) for diff, rels in zip(diffs, verify)])
+      for diff, rels, lines in zip(diffs, verify, found):
+        digests = {}
+        for line in lines:
+          fields = line.split('  ', 1)
+          if len(fields) == 2:
+            digests[fields[1]] = fields[0]
+        for rel in rels:
+          entry = diff.files[rel]
+          if digests.get(rel) == entry[2]:
+            diff.actions[rel] = 'skip' if diff.remote[rel][2] == entry[3] else 'attrs'
+          else:
+            diff.actions[rel] = self.__send(diff, rel, entry)
+    return diffs
+
+  def __action(self, diff, rel:str, entry:list) -> str:
+    """Returns the action of a local file, or verify when only its sha256 on the host tells
+    """
+    previous = diff.previous.get(rel)
+    if diff.remote is None:
+      # Without a connection, the host is taken to have the files of the last sync
+      remote = (previous[0], previous[1] // NS, previous[3]) if previous is not None and len(previous) > 3 else None
+    else:
+      remote = diff.remote.get(rel)
+    if remote is None:
+      return 'put'
+    if previous is not None and remote[:2] == (previous[0], previous[1] // NS):
+      # The host still has the file of the last sync
+      if previous[2] != entry[2]:
+        return self.__send(diff, rel, entry)
+      return 'skip' if remote == (entry[0], entry[1] // NS, entry[3]) else 'attrs'
+    if remote[:2] == (entry[0], entry[1] // NS):
+      return 'verify'
+    return self.__send(diff, rel, entry)
+
+  def __send(self, diff, rel:str, entry:list) -> str:
+    remote = diff.remote.get(rel) if diff.remote is not None else None
+    if entry[0] >= DELTA_MIN and remote is not None and remote[0] > 0:
+      return 'delta'
+    return 'put'
+
+  def remote(self, command:str, groups:list) -> list:
+    """Runs a command over the files of many folders as few remote scripts as possible, e.g. one stat
+      :param command: A command that takes file names and prints a line for each, e.g. stat -c '%s %n'
+      :type command: string
+      :param groups: A list of (dest, names), where each name is relative to the folder dest
+      :type groups: list
+      :returns: A list of the output lines of each group
+    """
+    scripts = []
+    script = ''
+    for idx, (dest, names) in enumerate(groups):
+      prefix = "echo '#{}'; ( cd {} && {} --".format(idx, quote_value(dest), command)
+      line = None
+      for name in names:
+        arg = ' ' + shlex.quote(name)
+        if line is not None and len(script) + len(line) + len(arg) > BATCH_LIMIT:
+          # A group with many files is split across scripts, and the header of each part is the same
+          scripts.append(script + line + ' ) 2>/dev/null\n')
+          script = ''
+          line = None
+        line = (line if line is not None else prefix) + arg
+      if line is not None:
+        script += line + ' ) 2>/dev/null\n'
+    if script != '':
+      scripts.append(script)
+    jobs = [('sh -c ' + shlex.quote(script), None) for script in scripts]
+    if len(jobs) > 1:
+      outputs = self.ssh.run_many(jobs, max_channels=self.in_flight)
+    else:
+      outputs = [self.ssh.run(exec, input_data) for exec, input_data in jobs]
+    found = [[] for group in groups]
+    for status, output in outputs:
+      if status == -1:
+        raise OSError('remote {} failed: {}'.format(command.split(' ')[0], output.strip()))
+      current = None
+      for line in output.splitlines():
+        if line.startswith('#') and line[1:].isdigit():
+          current = found[int(line[1:])]
+        elif current is not None:
+          current.append(line)
+    return found
+
+  def push(self, resources:list) -> list:
+    """Syncs the files of each resource, with several files in flight on their own SFTP channels
+      :param resources: A list of (label, param, previous), where previous is the files in the state, or None
+      :type resources: list
+      :returns: A list of (status, message, files) for each resource, where files are stored in its state
+    """
+    try:
+      diffs = self.diff(resources)
+    except OSError as e:
+      return [(-1, str(e), None) for resource in resources]
+    errors = [[] for diff in diffs]
+    self.__prepare(diffs, errors)
+    tasks = [(idx, rel, action) for idx, diff in enumerate(diffs) for rel, action in diff.actions.items() if action != 'skip']
+    # The largest files start first, so that they do not finish last on one channel
+    tasks.sort(key=lambda task: diffs[task[0]].files[task[1]][0], reverse=True)
+    literal = [0 for diff in diffs]
+    if tasks != []:
+      with ThreadPoolExecutor(max_workers=max(1, self.in_flight)) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, self.__transfer, diffs[idx], rel, action) for idx, rel, action in tasks]
+        for (idx, rel, action), future in zip(tasks, futures):
+          try:
+            literal[idx] += future.result()
+          except Exception as e:
+            errors[idx].append('{}: {}'.format(rel, e))
+    self.close()
+    results = []
+    for diff, messages, sent in zip(diffs, errors, literal):
+      if messages != []:
+        message = '{} failed, {}'.format(len(messages), '; '.join(messages[:3]))
+        self.log.error('{}: {}'.format(diff.label, message))
+        results.append((1, message, None))
+      else:
+        message = '{} {} bytes sent.'.format(diff.summary(), sent)
+        self.log.info('{}: {}', diff.label, message)
+        results.append((0, message, {rel: entry[:4] for rel, entry in diff.files.items()}))
+    return results
+
+  def remove(self, resources:list) -> list:
+    """Deletes the files of the last sync of each resource, and then the folders that they leave empty
+      :param resources: A list of (label, param), where param has dest and the files of the last sync in its state
+      :type resources: list
+      :returns: A list of (status, message) for each resource, where files that are left fail it
+    """
+    groups = [(str(param['dest']), sorted(param.get('files') or {})) for label, param in resources]
+    try:
+      if any(names != [] for dest, names in groups):
+        self.remote('rm -f', groups)
+        found = self.remote("stat -c '%n'", groups)
+        # A folder that still holds a file that is not synced, e.g. one written on the host, is kept
+        self.remote('rmdir -p', [(dest, leaf_dirs(names)) for dest, names in groups])
+      else:
+        found = [[] for group in groups]
+    except OSError as e:
+      return [(-1, str(e)) for resource in resources]
+    results = []
+    for (label, param), (dest, names), lines in zip(resources, groups, found):
+      if lines != []:
+        message = '{} files not deleted, {}'.format(len(lines), ', '.join(lines[:3]))
+        results.append((1, message))
+      else:
+        message = '{} files deleted.'.format(len(names))
+        self.log.info('{}: {}', label, message)
+        results.append((0, message))
+    return results
+
+  def __prepare(self, diffs:list, errors:list):
+    """Creates the folders of new files and deletes the files removed from src, in one remote script each
+    """
+    dirs = []
+    for diff in diffs:
+      # A folder that holds a file on the host exists
+      found = set(posixpath.dirname(rel) for rel in (diff.remote or {}))
+      dirs.append(sorted(set(posixpath.dirname(rel) for rel, action in diff.actions.items() if action == 'put') - found - {''}))
+    try:
+      if any(names != [] for names in dirs):
+        self.remote('mkdir -p', [(diff.dest, names) for diff, names in zip(diffs, dirs)])
+      if any(diff.delete != [] for diff in diffs):
+        self.remote('rm -f', [(diff.dest, diff.delete) for diff in diffs])
+    except OSError as e:
+      for messages in errors:
+        messages.append(str(e))
+
+  def __client(self):
+    """Returns the SFTP client of the current thread, which opens a channel on first use
+    """
+    client = getattr(self.local, 'sftp', None)
+    if client is None:
+      client = self.ssh.open_sftp()
+      if client is None:
+        raise OSError('transport {} has no SFTP'.format(type(self.ssh).__name__))
+      self.local.sftp = client
+      with self.lock:
+        self.clients.append(client)
+    return client
+
+  def close(self):
+    with self.lock:
+      clients = self.clients
+      self.clients = []
+    for client in clients:
+      client.close()
+    self.local = threading.local()
+
+  def __transfer(self, diff, rel:str, action:str) -> int:
+    """Sends one file to a temporary file next to it, which replaces the file with its mode and mtime
+      :returns: The number of bytes of the file that were sent
+    """
+    entry = diff.files[rel]
+    local = diff.src if os.path.isfile(diff.src) else os.path.join(diff.src, *rel.split('/'))
+    path = posixpath.join(diff.dest, rel)
+    tmp = posixpath.join(posixpath.dirname(path), '.' + posixpath.basename(path) + '.viki')
+    sftp = self.__client()
+    with TRACER.span('sync_file', name=rel, action=action):
+      if action == 'attrs':
+        self.__attrs(sftp, sftp_path(path), entry)
+        return 0
+      sent = None
+      if action == 'delta':
+        sent = self.__delta(sftp, local, path, tmp, entry)
+      if sent is None:
+        with open(local, 'rb') as fp:
+          sftp.putfo(fp, sftp_path(tmp), file_size=entry[0])
+        sent = entry[0]
+      self.__attrs(sftp, sftp_path(tmp), entry)
+      try:
+        sftp.posix_rename(sftp_path(tmp), sftp_path(path))
+      except IOError:
+        # A server without the posix-rename extension only renames to a new name
+        try:
+          sftp.remove(sftp_path(path))
+        except IOError:
+          pass
+        sftp.rename(sftp_path(tmp), sftp_path(path))
+    return sent
+
+  def __attrs(self, sftp, path:str, entry:list):
+    sftp.chmod(path, entry[3])
+    sftp.utime(path, (entry[1] // NS, entry[1] // NS))
+
+  def __delta(self, sftp, local:str, path:str, tmp:str, entry:list) -> int:
+    """Builds the temporary file on the host from its copy of the file and a block delta
+      :returns: The number of literal bytes sent, or None to send the whole file, e.g. without python3 on the host
+    """
+    status, signature, error = self.__helper(['signature', quote_value(path), str(block_size(entry[0]))])
+    if status != 0:
+      self.log.info('block delta of {} not used, status {}: {}', path, status, error.strip())
+      return None
+    size, length, blocks = parse_signature(signature)
+    ops = tmp + '.delta'
+    with open(local, 'rb') as src, sftp.open(sftp_path(ops), 'wb') as fp:
+      fp.set_pipelined(True)
+      sent = delta(src, size, length, blocks, fp.write)
+    status, output, error = self.__helper(['patch', quote_value(path), quote_value(ops), quote_value(tmp), entry[2]])
+    if status != 0:
+      raise OSError('block delta failed with status {}: {}'.format(status, error.strip()))
+    return sent
+
+  def __helper(self, args:list) -> tuple:
+    """Runs block_delta on the host, and uploads it first when the host does not have this version
+      :returns: A tuple of (status, stdout bytes, stderr string)
+    """
+    def launch(path:str) -> tuple:
+      out = []
+      err = []
+      status = self.ssh.run_stream(script_command(path, self.python, ' '.join(args)), out.append, stderr_sink=err.append)
+      return status, (b''.join(out), b''.join(err).decode('utf-8', errors='replace'))
+    # The upload raises instead of returning a status, so every result is from launch
+    status, (out, err) = ensure_script('block_delta', 'delta', launch, self.__upload)
+    return status, out, err
+
+  def __upload(self, path:str, source:bytes) -> int:
+    with self.lock:
+      if self.uploaded:
+        return 0
+      sftp = self.__client()
+      for dir in ['.cache', '.cache/viki']:
+        try:
+          sftp.mkdir(dir)
+        except IOError:
+          pass  # The folder exists
+      path = sftp_path(path)
+      sftp.putfo(io.BytesIO(source), path + '.tmp')
+      sftp.posix_rename(path + '.tmp', path)
+      self.uploaded = True
+    return 0
@@ -0,0 +1,276 @@
+from common.facts import Facts
+from common.plan_file import SavedPlan, state_fingerprint
+from common.transport import is_local
+from common.tracer import TRACER
+import copy, os
+
+class HostRunner():
+  def __init__(self, logger, request, name:str, vars:dict, args):
+    """Runs the commands of viki against one host
+      :param args: The options parsed by Cli
+      :type args: argparse.Namespace
+    """
+    self.log = logger
+    self.request = request
+    self.name = name
+    self.vars = vars
+    self.args = args
+    self.log_dir = os.path.join(request.path, 'logs') if name is None else os.path.join(request.path, 'logs', name)
+    self.label = name if name is not None else str(vars.get('hostname'))
+    # Responses store outputs inside the resource params, so each host gets its own copy
+    self.data = copy.deepcopy(request.data)
+    self.mods = copy.deepcopy(request.mods)
+    self.store = request.state_store(name)
+    self.state = request.load_state(name, self.store)
+    self.blobs = request.blob_store()
+    self.ssh = None
+    # The facts of a state of an earlier version seed the cache, and are dropped by the next write of the state
+    self.facts = Facts(request.load_facts(name, self.state['viki'].pop('facts', None)), ttl=args.facts_ttl, refresh=args.refresh_facts)
+    self.plan_response = None
+    self.failed = False
+    self.summary = ''
+
+  def credentials(self) -> bool:
+    if is_local(self.vars):
+      return True
+    for key in ['hostname', 'username', 'password']:
+      if not key in self.vars or self.vars[key] == '' or self.vars[key] is None:
+        return False
+    return True
+
+  def check(self, data:bool=False, mods:bool=False) -> bool:
+    """Checks the config of the host against the command templates, so that an unknown mod or a missing
+      parameter fails the host before the SSH handshake
+      :param data: Whether to check the data section, defaults to False
+      :type data: bool
+      :param mods: Whether to check the mods section, defaults to False
+      :type mods: bool
+      :returns: False if the host failed
+    """
+    from common.ssh_command import DATA_TEMPLATE, MODS_TEMPLATE
+    sections = ([('data', self.data, DATA_TEMPLATE, None)] if data else []) + ([('mods', self.mods, MODS_TEMPLATE, 'insert')] if mods else [])
+    errors = []
+    for section, config, templates, op in sections:
+      for mod, names in config.items():
+        if not mod in templates:
+          errors.append('Unknown mod {} found in {}.'.format(mod, section))
+          continue
+        template = templates[mod] if op is None else templates[mod][op]
+        for name, param in names.items():
+          missing = template.check(param)[0]
+          if missing != []:
+            errors.append('Missing parameters {} in {}.{}.'.format(missing, mod, name))
+    for msg in errors:
+      self.log.error(msg)
+    return errors == [] or self.fail(errors[0])
+
+  def connect(self) -> bool:
+    if self.ssh is not None:
+      return True
+    if is_local(self.vars):
+      from common.local_transport import LocalTransport
+      self.ssh = LocalTransport()
+      self.ssh.connect()
+      return True
+    if self.args.daemon:
+      from common.daemon_transport import DaemonTransport
+      daemon = DaemonTransport(self.args.socket)
+      if daemon.reachable():
+        if not daemon.connect(self.vars['hostname'], self.vars['username'], self.vars['password'],
+          int(self.vars['port']) if 'port' in self.vars else 22):
+          self.log.error('SSH connection of viki daemon failed.')
+          return self.fail('SSH connection failed.')
+        self.ssh = daemon
+        return True
+      self.log.warning('viki daemon not found on {}, connecting directly.', daemon.path)
+    # Imported here so that an offline plan and a local host do not load paramiko
+    from common.my_ssh import MySSH
+    ssh = MySSH(verbose=self.args.verbose)
+    ssh.connect(
+      hostname=self.vars['hostname'],
+      username=self.vars['username'],
+      password=self.vars['password'],
+      port=int(self.vars['port']) if 'port' in self.vars else 22
+    )
+    if ssh.connected() is False:
+      self.log.error('SSH connection failed.')
+      return self.fail('SSH connection failed.')
+    self.ssh = ssh
+    if self.args.agent or self.vars.get('transport') == 'agent':
+      from common.agent_transport import AgentTransport
+      self.ssh = AgentTransport(ssh)
+      if not self.ssh.start():
+        self.log.warning('viki agent not started, as {}, running each command in a session.', self.ssh.reason)
+    return True
+
+  def fail(self, summary:str) -> bool:
+    self.failed = True
+    self.summary = summary
+    return False
+
+  def fetch(self):
+    if not self.check(data=True) or not self.connect():
+      return
+    # The responses are imported when a command needs them, so that gc and argument errors start fast
+    from common.fetch_response import FetchResponse
+    fetch_response = FetchResponse(self.log, self.ssh, self.data, self.vars, facts=self.facts, channels=self.args.channels, batch=self.args.batch, log_dir=os.path.join(self.log_dir, 'data'), tail=self.args.tail, blobs=self.blobs, timeout=self.args.timeout)
+    fetch_response.fetch()
+    self.state['viki']['data'] = fetch_response.state
+
+  def run_fetch(self):
+    with TRACER.span('fetch'):
+      self.fetch()
+    if self.failed:
+      return
+    self.write_state()
+    self.summary = 'Fetch complete! {} data resources.'.format(
+      sum(len(names) for names in self.state['viki']['data'].values()))
+
+  def run_plan(self, fetch:bool=False, offline:bool=False):
+    if not self.check(data=fetch and not offline, mods=True):
+      return
+    if not offline and not self.connect():
+      return
+    from common.plan_response import PlanResponse
+    with TRACER.span('plan'):
+      self.plan_response = PlanResponse(self.log, self.ssh, self.mods, self.state['viki']['mods'], facts=self.facts, root=self.request.path, drift=self.state['viki'].get('drift'))
+    if fetch and not offline:
+      with TRACER.span('fetch'):
+        self.fetch()
+    # Keep the facts of a plan so that the next plan does not probe the host again, without writing the state
+    self.write_facts()
+    self.summary = self.plan_summary(self.plan_response)
+
+  def run_refresh(self):
+    """Marks the resources of the state that are missing on the host, which the next plan adds again
+    """
+    if not self.connect():
+      return
+    from common.refresh_response import RefreshResponse
+    refresh_response = RefreshResponse(self.log, self.ssh, self.state['viki']['mods'], self.vars, drift=self.state['viki'].get('drift'), channels=self.args.channels, timeout=self.args.timeout)
+    with TRACER.span('refresh'):
+      drift = refresh_response.refresh()
+    if drift != {} or 'drift' in self.state['viki']:
+      self.state['viki']['drift'] = drift
+    self.write_state()
+    self.summary = 'Refresh complete! {} resources checked, {} drifted.'.format(
+      refresh_response.count, sum(len(names) for names in drift.values()))
+
+  def saved_plan(self) -> dict:
+    """Returns the plan of this host for a plan file
+    """
+    return {
+      'insert': self.plan_response.delta_insert,
+      'replace': self.plan_response.delta_replace,
+      'update': self.plan_response.delta_update,
+      'remove': self.plan_response.delta_remove,
+      'commands': self.plan_response.render_commands(),
+      'fingerprint': state_fingerprint(self.state['viki']['mods'])
+    }
+
+  def run_saved(self, hosts:dict):
+    """Loads the plan of this host from a plan file instead of planning again
+      :param hosts: The plan of each host returned by read_plan
+      :type hosts: dict
+    """
+    key = self.name if self.name is not None else ''
+    if not key in hosts:
+      self.summary = 'Not in saved plan.'
+      return
+    plan = SavedPlan(hosts[key])
+    if plan.fingerprint != state_fingerprint(self.state['viki']['mods']):
+      self.log.error('Saved plan is stale, the state file changed after plan.')
+      self.fail('Saved plan is stale.')
+      return
+    if plan.count_insert + plan.count_remove > 0 and not self.connect():
+      return
+    self.plan_response = plan
+    self.summary = self.plan_summary(plan)
+
+  def plan_summary(self, plan_response) -> str:
+    """Returns the counts of a plan, where a replaced or updated resource is not counted in add and destroy
+    """
+    return 'Plan {} to add, {} to update, {} to replace, {} to destroy.'.format(
+      plan_response.count_insert - plan_response.count_replace - plan_response.count_update,
+      plan_response.count_update,
+      plan_response.count_replace,
+      plan_response.count_remove - plan_response.count_replace)
+
+  def changes(self) -> int:
+    if self.failed or self.plan_response is None:
+      return 0
+    return self.plan_response.count_insert + self.plan_response.count_remove
+
+  def report(self):
+    """Logs the plan of this host, which is called serially so that plans do not interleave
+    """
+    if self.failed or self.plan_response is None:
+      return
+    plan_response = self.plan_response
+    if self.changes() == 0:
+      self.log.info('No changes. Your server matches the configuration.')
+    else:
+      if plan_response.count_insert > plan_response.count_replace + plan_response.count_update:
+        add = {mod: {name: param for name, param in names.items() if not name in plan_response.delta_replace.get(mod, {}) and not name in plan_response.delta_update.get(mod, {})} for mod, names in plan_response.delta_insert.items()}
+        self.log.info('add:\n{}'.format(plan_response.pretty_json(add)))
+      if plan_response.count_update > 0:
+        self.log.info('update:\n{}'.format(plan_response.pretty_json(plan_response.delta_update)))
+      if plan_response.count_replace > 0:
+        self.log.info('replace:\n{}'.format(plan_response.pretty_json(plan_response.delta_replace)))
+      if plan_response.count_remove > plan_response.count_replace:
+        destroy = {mod: {name: param for name, param in names.items() if not name in plan_response.delta_replace.get(mod, {})} for mod, names in plan_response.delta_remove.items()}
+        self.log.info('destroy:\n{}'.format(plan_response.pretty_json(destroy)))
+      self.log.info(self.summary)
+
+  def run_apply(self):
+    if self.changes() == 0:
+      return
+    plan_response = self.plan_response
+    commands = plan_response.commands if isinstance(plan_response, SavedPlan) else None
+    from common.apply_response import ApplyResponse
+    apply_response = ApplyResponse(self.log, self.ssh, plan_response.delta_insert, plan_response.delta_remove, self.state['viki']['mods'], self.vars, channels=self.args.channels, batch=self.args.batch, log_dir=os.path.join(self.log_dir, 'mods'), tail=self.args.tail, blobs=self.blobs, commands=commands, store=self.store, replace=plan_response.delta_replace, root=self.request.path, drift=self.state['viki'].get('drift'), timeout=self.args.timeout)
+    with TRACER.span('apply'):
+      # A replaced resource is destroyed before it is added again, e.g. a container with the same name
+      failed = apply_response.apply_remove(replace=True) if plan_response.count_replace > 0 else set()
+      if plan_response.count_insert > 0: apply_response.apply_insert(failed)
+      if plan_response.count_remove > plan_response.count_replace: apply_response.apply_remove()
+    self.state['viki']['mods'] = apply_response.state
+    self.write_state()
+    self.summary = self.apply_summary(apply_response)
+    if apply_response.failed != set():
+      self.failed = True
+
+  def apply_summary(self, apply_response) -> str:
+    """Returns the counts of the resources that apply changed, where a failed or skipped resource is not counted
+    """
+    in_delta = lambda delta, resource: resource[1] in delta.get(resource[0], {})
+    replace = self.plan_response.delta_replace
+    update = self.plan_response.delta_update
+    counts = (
+      len([resource for resource in apply_response.inserted if not in_delta(replace, resource) and not in_delta(update, resource)]),
+      len([resource for resource in apply_response.inserted if in_delta(update, resource)]),
+      len([resource for resource in apply_response.inserted if in_delta(replace, resource)]),
+      len([resource for resource in apply_response.removed if not in_delta(replace, resource)]))
+    if apply_response.failed != set():
+      return 'Apply failed! {} added, {} updated, {} replaced, {} destroyed, {} failed.'.format(*counts, len(apply_response.failed))
+    return 'Apply complete! {} added, {} updated, {} replaced, {} destroyed.'.format(*counts)
+
+  def digests(self) -> set:
+    """Returns the digests of the outputs in the state of this host, e.g. for gc
+    """
+    digests = set()
+    for section in ['data', 'mods']:
+      for names in self.state['viki'].get(section, {}).values():
+        for param in names.values():
+          if isinstance(param, dict):
+            digests.update(param[key] for key in ['output_digest', 'error_digest'] if key in param)
+    return digests
+
+  def write_facts(self):
+    if self.facts.changed:
+      self.request.write_facts(self.name, self.facts.facts)
+      self.facts.changed = False
+
+  def write_state(self):
+    self.write_facts()
+    self.store.write(self.state)
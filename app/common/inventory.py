@@ -0,0 +1,52 @@
+import os
+
+class Inventory():
+  def __init__(self, logger, hosts:dict, groups:dict, vars:dict):
+    self.log = logger
+    self.hosts = hosts if hosts is not None else {}
+    self.groups = groups if groups is not None else {}
+    self.vars = vars
+    unknown_hosts = set(h for members in self.groups.values() for h in members) - set(self.hosts.keys())
+    if unknown_hosts != set():
+      self.log.error('Unknown hosts {} found in groups.'.format(unknown_hosts))
+
+  def select(self, limit:str=None) -> list:
+    """Selects the hosts to run against
+      :param limit: A comma separated list of host or group names, defaults to all hosts
+      :type limit: string
+      :returns: A list of (name, vars) tuples, where name is None without an inventory
+    """
+    if self.hosts == {}:
+      return [(None, self.vars)]
+    names = list(self.hosts.keys())
+    if limit is not None and limit != '':
+      names = []
+      for item in limit.split(','):
+        item = item.strip()
+        if item in self.groups:
+          members = self.groups[item]
+        elif item in self.hosts:
+          members = [item]
+        else:
+          self.log.error('Unknown host or group {} found in limit.'.format(item))
+          continue
+        for name in members:
+          if not name in names:
+            names.append(name)
+    return [(name, self.host_vars(name)) for name in names]
+
+  def host_vars(self, name:str) -> dict:
+    """Merges the vars of a host over the global vars
+      :param name: A host name from the inventory
+      :type name: string
+    """
+    vars = dict(self.vars)
+    host = self.hosts[name] if self.hosts[name] is not None else {}
+    for key, val in host.items():
+      # Values such as VK_VAR_web1_password are resolved from the environment
+      if isinstance(val, str) and val[:7] == 'VK_VAR_' and val in os.environ:
+        val = os.environ[val]
+      vars[key] = val
+    if not 'hostname' in host:
+      vars['hostname'] = name
+    return vars
@@ -0,0 +1,74 @@
+from common.transport import Transport
+from common.tracer import TRACER
+import os, select, signal, subprocess, time
+
+class LocalTransport(Transport):
+  def __init__(self, shell:str='/bin/sh'):
+    """Runs commands on the current workstation in a subprocess, without SSH or a PTY
+      :param shell: The shell that runs each command, defaults to /bin/sh
+      :type shell: string
+    """
+    self.shell = shell
+    self.bufsize = 65536
+    self.is_connected = False
+
+  def connect(self, hostname:str=None, username:str=None, password:str=None, port:int=22) -> bool:
+    # Commands run as the current user, so the credentials of the host are not used
+    self.is_connected = True
+    return True
+
+  def connected(self) -> bool:
+    return self.is_connected
+
+  def close(self):
+    self.is_connected = False
+
+  def run_stream(self, cmd:str, sink, input_data:str=None, timeout:int=180, pty:bool=False, stderr_sink=None) -> int:
+    # Commands run without a terminal, so pty is ignored
+    if not self.is_connected:
+      sink(b'ERROR: connection not established\n')
+      return -1
+    # A session of its own, so that a timeout kills the children of the command too
+    with TRACER.span('session_open'):
+      proc = subprocess.Popen([self.shell, '-c', cmd], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT if stderr_sink is None else subprocess.PIPE, start_new_session=True)
+    start = time.perf_counter()
+    first = True
+    try:
+      if input_data is not None:
+        proc.stdin.write((input_data.replace('\\n', '\n') + '\n').encode('utf-8'))
+      proc.stdin.close()
+    except BrokenPipeError:
+      pass
+    # Each open pipe and the sink of its output
+    fds = {proc.stdout.fileno(): sink}
+    if stderr_sink is not None:
+      fds[proc.stderr.fileno()] = stderr_sink
+    deadline = time.monotonic() + timeout
+    while fds:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        os.killpg(proc.pid, signal.SIGKILL)
+        self.__close(proc)
+        proc.wait()
+        sink(('\nERROR: timeout after %d seconds\n' % (timeout)).encode('utf-8'))
+        return -1
+      readable, _, _ = select.select(list(fds), [], [], remaining)
+      for fd in readable:
+        data = os.read(fd, self.bufsize)
+        if data == b'':
+          del fds[fd]
+          continue
+        if first:
+          first = False
+          TRACER.record('first_byte', start, time.perf_counter())
+        fds[fd](data)
+    self.__close(proc)
+    status = proc.wait()
+    TRACER.record('exec', start, time.perf_counter())
+    return status
+
+  def __close(self, proc):
+    proc.stdout.close()
+    if proc.stderr is not None:
+      proc.stderr.close()
@@ -1,25 +1,78 @@
-import logging, sys
+import atexit, logging, logging.handlers, queue, sys
+
+# The listener of the queue, which is started by the first Logger of __main__
+LISTENER = None
+
+class ContextFormatter(logging.Formatter):
+  def format(self, record):
+    """Prefixes each message with its connection id, level and the function that logged it, e.g. MySSH._run_poll
+    """
+    fn = getattr(record, 'fn', None) or '{}.{}'.format(record.name, record.funcName)
+    return '[cid:{}][{}][{}] {}'.format(getattr(record, 'cid', 0), record.levelname, fn, super().format(record))
+
+def listen(stream=sys.stdout) -> logging.handlers.QueueListener:
+  '''
+  Route the records of every logger through a queue to a background thread that writes them to a stream.
+
+  A thread that logs, e.g. the command loop of a channel, only puts each record in the queue and does not
+  wait for the stream. The listener is stopped at exit, which writes the records that are left.
+
+  @param stream         The stream that the records are written to, defaults to stdout.
+  @returns              The QueueListener that writes the records.
+  '''
+  handler = logging.StreamHandler(stream)
+  handler.setFormatter(ContextFormatter())
+  records = queue.SimpleQueue()
+  listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+  logging.getLogger().addHandler(logging.handlers.QueueHandler(records))
+  listener.start()
+  atexit.register(listener.stop)
+  global LISTENER
+  LISTENER = listener
+  return listener
+
+def flush():
+  '''
+  Write the records that are left in the queue, e.g. the plan before a prompt for approval.
+  '''
+  if LISTENER is not None:
+    LISTENER.stop()
+    LISTENER.start()
 
 class Logger:
-  def __init__(self, fn:str, id:int=0, level=logging.INFO):
+  def __init__(self, name:str, id:int=0, level=logging.INFO):
+    """Logs with the connection id and the function that called it, e.g. [cid:1][INFO][HostRunner.connect]
+      :param name: The name of the caller, where __main__ routes every record to stdout through a queue
+      :type name: string
+    """
     self.id = id
-    self.fn = fn
+    self.name = name
     self.log = logging.getLogger()
     self.log.setLevel(level)
-    if self.fn == "__main__":
-      handler = logging.StreamHandler(sys.stdout)
-      self.log.addHandler(handler)
+    if self.name == "__main__":
+      listen(sys.stdout)
 
-  def info(self, msg):
-    self.log.info('[cid:{}][INFO][{}] {}'.format(self.id, self.fn, msg))
+  def info(self, msg:str, *args):
+    """Logs a message, where args are formatted into msg with str.format only when INFO is enabled
+    """
+    if self.log.isEnabledFor(logging.INFO):
+      self.__log(logging.INFO, msg, args)
 
-  def warning(self, msg):
-    self.log.warning('[cid:{}][WARNING][{}] {}'.format(self.id, self.fn, msg))
+  def warning(self, msg:str, *args):
+    if self.log.isEnabledFor(logging.WARNING):
+      self.__log(logging.WARNING, msg, args)
 
-  def error(self, msg, e=None):
-    self.log.error('[cid:{}][ERROR][{}] {}'.format(self.id, self.fn, msg))
+  def error(self, msg:str, e=None):
+    fn = self.__log(logging.ERROR, msg, ())
     if not e is None:
       if type(e) is KeyError:
-        raise Exception('[cid:{}][ERROR][{}] {} is missing from dict.'.format(self.id, self.fn, str(e)))
+        raise Exception('[cid:{}][ERROR][{}] {} is missing from dict.'.format(self.id, fn, str(e)))
       else:
-        raise Exception('[cid:{}][ERROR][{}] {}'.format(self.id, self.fn, str(e)))
\ No newline at end of file
+        raise Exception('[cid:{}][ERROR][{}] {}'.format(self.id, fn, str(e)))
+
+  def __log(self, level:int, msg:str, args:tuple) -> str:
+    # The caller of info, warning or error, read from the stack instead of a shared attribute,
+    # so that each host thread logs its own function
+    fn = sys._getframe(2).f_code.co_qualname
+    self.log.log(level, msg.format(*args) if args else msg, extra={'cid': self.id, 'fn': fn})
+    return fn
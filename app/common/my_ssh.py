@@ -10,14 +10,16 @@ VERSION 1.2
 '''
 import paramiko
 import logging
+import select
 import socket
 import time
-import datetime
+from common.transport import Transport
+from common.tracer import TRACER
 
 # ================================================================
 # class MySSH
 # ================================================================
-class MySSH:
+class MySSH(Transport):
     '''
     Create an SSH connection to a server and execute commands.
     Here is a typical usage:
@@ -34,7 +36,7 @@ class MySSH:
         print '%s' % (output)
 
         # Run a command that does requires input.
-        status, output = ssh.run('sudo uname -a', 'sudo-password')
+        status, output = ssh.run("sudo -S -p '' uname -a", 'sudo-password')
         print 'status = %d' % (status)
         print 'output (%d):' % (len(output))
         print '%s' % (output)
@@ -48,6 +50,9 @@ class MySSH:
         '''
         self.ssh = None
         self.transport = None
+        self.hostname = None
+        self.username = None
+        self.port = None
         self.compress = compress
         self.bufsize = 65536
 
@@ -55,11 +60,15 @@ class MySSH:
         self.logger = logging.getLogger('MySSH')
         self.set_verbosity(verbose)
 
-        fmt = '%(asctime)s MySSH:%(funcName)s:%(lineno)d %(message)s'
-        format = logging.Formatter(fmt)
-        handler = logging.StreamHandler()
-        handler.setFormatter(format)
-        self.logger.addHandler(handler)
+        # The logger is shared by every instance, e.g. one per host. When
+        # the application routes the root logger through a queue, e.g.
+        # viki, the records propagate to it instead of a handler here.
+        if not self.logger.handlers and not logging.getLogger().handlers:
+            fmt = '%(asctime)s MySSH:%(funcName)s:%(lineno)d %(message)s'
+            format = logging.Formatter(fmt)
+            handler = logging.StreamHandler()
+            handler.setFormatter(format)
+            self.logger.addHandler(handler)
         self.info = self.logger.info
 
     def __del__(self):
@@ -78,34 +87,34 @@ class MySSH:
 
         @returns True if the connection succeeded or false otherwise.
         '''
-        self.info('connecting %s@%s:%d' % (username, hostname, port))
+        self.info('connecting %s@%s:%d', username, hostname, port)
         self.hostname = hostname
         self.username = username
         self.port = port
         self.ssh = paramiko.SSHClient()
         self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         try:
-            self.ssh.connect(hostname=hostname,
-                             port=port,
-                             username=username,
-                             password=password)
+            with TRACER.span('connect'):
+                self.ssh.connect(hostname=hostname,
+                                 port=port,
+                                 username=username,
+                                 password=password)
             self.transport = self.ssh.get_transport()
             self.transport.use_compression(self.compress)
-            self.info('succeeded: %s@%s:%d' % (username,
-                                               hostname,
-                                               port))
+            # Without TCP_NODELAY, Nagle's algorithm holds each small
+            # request until the last one is acknowledged, which adds a
+            # delayed ACK of about 40 ms to every command.
+            try:
+                self.transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except (AttributeError, OSError):
+                pass
+            self.info('succeeded: %s@%s:%d', username, hostname, port)
         except socket.error as e:
             self.transport = None
-            self.info('failed: %s@%s:%d: %s' % (username,
-                                                hostname,
-                                                port,
-                                                str(e)))
+            self.info('failed: %s@%s:%d: %s', username, hostname, port, e)
         except paramiko.BadAuthenticationType as e:
             self.transport = None
-            self.info('failed: %s@%s:%d: %s' % (username,
-                                                hostname,
-                                                port,
-                                                str(e)))
+            self.info('failed: %s@%s:%d: %s', username, hostname, port, e)
 
         return self.transport is not None
 
@@ -124,35 +133,127 @@ class MySSH:
 
             ssh = MySSH()
             ssh.connect('host', 'user', 'password')
-            status, output = ssh.run('sudo uname -a', '<sudo-password>')
+            status, output = ssh.run("sudo -S -p '' uname -a", '<sudo-password>')
 
         @param cmd         The command to run.
         @param input_data  The input data (default is None).
         @param timeout     The timeout in seconds (default is 10 seconds).
         @returns The status and the output (stdout and stderr combined).
         '''
-        self.info('running command: (%d) %s' % (timeout, cmd))
+        chunks = []
+        status = self.run_stream(cmd, chunks.append, input_data, timeout)
+        output = b''.join(chunks).decode('utf-8', errors='replace')
+        if self.verbose:
+            self.info('output size %d', len(output))
+        return status, output
+
+    def run_stream(self, cmd, sink, input_data=None, timeout=180, pty=False, stderr_sink=None):
+        '''
+        Run a command with optional input data and pass its output to a
+        sink as it arrives, so that memory does not grow with the output.
+
+        Here is an example that shows how to follow the output live:
+
+            ssh = MySSH()
+            ssh.connect('host', 'user', 'password')
+            status = ssh.run_stream('wget url', sys.stdout.buffer.write)
+
+        The command runs without a PTY unless pty is set, which saves the
+        terminal setup and keeps the output as the bytes that it wrote.
+        The input data is written to stdin once, followed by EOF, e.g. a
+        password for sudo -S, instead of waiting for a prompt.
+
+        @param cmd          The command to run.
+        @param sink         A callable that takes each chunk of bytes.
+        @param input_data   The input data (default is None).
+        @param timeout      The timeout in seconds (default is 180 seconds).
+        @param pty          Allocate a PTY (default is False).
+        @param stderr_sink  A callable that takes each chunk of stderr, or
+                            None to pass stderr to sink (default is None).
+        @returns The status.
+        '''
+        if self.verbose:
+            self.info('running command: (%d) %s', timeout, cmd)
 
         if self.transport is None:
-            self.info('no connection to %s@%s:%s' % (str(self.username),
-                                                     str(self.hostname),
-                                                     str(self.port)))
-            return -1, 'ERROR: connection not established\n'
+            self.info('no connection to %s@%s:%s', self.username, self.hostname, self.port)
+            sink(b'ERROR: connection not established\n')
+            return -1
 
         # Fix the input data.
         input_data = self._run_fix_input_data(input_data)
 
         # Initialize the session.
-        self.info('initializing the session')
-        session = self.transport.open_session()
-        session.set_combine_stderr(True)
-        session.get_pty()
-        session.exec_command(cmd)
-        output = self._run_poll(session, timeout, input_data)
-        status = session.recv_exit_status()
-        self.info('output size %d' % (len(output)))
-        self.info('status %d' % (status))
-        return status, output
+        if self.verbose:
+            self.info('initializing the session (pty %s)', pty)
+        with TRACER.span('session_open'):
+            session = self.transport.open_session()
+            session.set_combine_stderr(stderr_sink is None)
+            if pty:
+                session.get_pty()
+            session.exec_command(cmd)
+        self._run_send_input(session, input_data)
+        if TRACER.enabled:
+            sink = self._run_first_byte(sink)
+        with TRACER.span('exec'):
+            self._run_poll(session, timeout, sink, stderr_sink)
+        with TRACER.span('exit'):
+            status = session.recv_exit_status()
+        if self.verbose:
+            self.info('status %d', status)
+        return status
+
+    def _run_first_byte(self, sink):
+        '''
+        Wrap a sink to record the time from exec until the first byte.
+
+        @param sink  A callable that takes each chunk of bytes.
+        @returns the wrapped sink.
+        '''
+        start = time.perf_counter()
+        first = [True]
+
+        def wrapped(data):
+            if first[0]:
+                first[0] = False
+                TRACER.record('first_byte', start, time.perf_counter())
+            sink(data)
+        return wrapped
+
+    def run_many(self, commands, max_channels=8, timeout=180):
+        '''
+        Run several commands at the same time, each on its own channel
+        of the one transport.
+
+        Note that the server limits the sessions of one connection, e.g.
+        MaxSessions in sshd_config defaults to 10.
+
+        @param commands      A list of (cmd, input_data) pairs.
+        @param max_channels  The maximum number of open channels.
+        @param timeout       The timeout in seconds for each command.
+        @returns A list of (status, output) pairs in the order of commands.
+        '''
+        self.info('running %d commands on %d channels', len(commands), max_channels)
+        return super().run_many(commands, max_channels, timeout)
+
+    def open_sftp(self):
+        '''
+        Open an SFTP client on its own channel of the one transport.
+
+        Here is an example that shows how to copy a file to the host:
+
+            ssh = MySSH()
+            ssh.connect('host', 'user', 'password')
+            sftp = ssh.open_sftp()
+            sftp.put('local.txt', 'remote.txt')
+            sftp.close()
+
+        @returns the SFTPClient, or None if not connected.
+        '''
+        if self.transport is None:
+            return None
+        with TRACER.span('sftp_open'):
+            return paramiko.SFTPClient.from_transport(self.transport)
 
     def connected(self):
         '''
@@ -162,112 +263,145 @@ class MySSH:
         '''
         return self.transport is not None
 
+    def alive(self):
+        '''
+        Is the connection still working?
+
+        An SSH ignore message is sent, which fails when the server or
+        the network dropped the connection.
+
+        @returns True if the transport is active or false otherwise.
+        '''
+        if self.transport is None or not self.transport.is_active():
+            return False
+        try:
+            self.transport.send_ignore()
+        except (EOFError, socket.error, paramiko.SSHException):
+            return False
+        return True
+
+    def close(self):
+        '''
+        Close the connection to the host.
+        '''
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
     def set_verbosity(self, verbose):
         '''
         Turn verbose messages on or off.
 
+        The messages of the polling loop are only formatted and logged
+        when self.verbose is set, so that they cost a test when disabled.
+
         @param verbose  Enable/disable verbose messages.
         '''
         if verbose > 0:
             self.logger.setLevel(logging.INFO)
         else:
             self.logger.setLevel(logging.ERROR)
+        self.verbose = self.logger.isEnabledFor(logging.INFO)
 
     def _run_fix_input_data(self, input_data):
         '''
         Fix the input data supplied by the user for a command.
 
         @param input_data  The input data (default is None).
-        @returns the fixed input data.
+        @returns the fixed input data, or None.
         '''
         if input_data is not None:
-            if len(input_data) > 0:
-                if '\\n' in input_data:
-                    # Convert \n in the input into new lines.
-                    lines = input_data.split('\\n')
-                    input_data = '\n'.join(lines)
-            return input_data.split('\n')
-        return []
-
-    def _run_send_input(self, session, stdin, input_data):
+            # Convert \n in the input into new lines.
+            return input_data.replace('\\n', '\n') + '\n'
+        return None
+
+    def _run_send_input(self, session, input_data):
         '''
-        Send the input data.
+        Send the input data once and close stdin.
 
         @param session     The session.
-        @param stdin       The stdin stream for the session.
-        @param input_data  The input data (default is None).
+        @param input_data  The fixed input data, or None.
         '''
         if input_data is not None:
-            self.info('session.exit_status_ready() %s' % str(session.exit_status_ready()))
-            self.info('stdin.channel.closed %s' % str(stdin.channel.closed))
-            if stdin.channel.closed is False:
-                self.info('sending input data')
-                stdin.write(input_data)
+            if self.verbose:
+                self.info('sending input data %d', len(input_data))
+            session.sendall(input_data.encode('utf-8'))
+        session.shutdown_write()
 
-    def _run_poll(self, session, timeout, input_data):
+    def _run_poll(self, session, timeout, sink, stderr_sink=None):
         '''
-        Poll until the command completes.
-
-        @param session     The session.
-        @param timeout     The timeout in seconds.
-        @param input_data  The input data.
-        @returns the output
+        Wait for output until the command completes.
+
+        The loop blocks in select() on the channel, which wakes up as
+        soon as data, EOF or a close arrives instead of sleeping for a
+        fixed interval. Each chunk is passed to the sink as it arrives.
+
+        @param session      The session.
+        @param timeout      The timeout in seconds.
+        @param sink         A callable that takes each chunk of bytes.
+        @param stderr_sink  A callable that takes each chunk of stderr, or
+                            None when stderr is combined with stdout.
+        @returns the number of output bytes
         '''
-        interval = 0.1
-        maxseconds = timeout
-        maxcount = maxseconds / interval
-
-        # Poll until completion or timeout
-        # Note that we cannot directly use the stdout file descriptor
-        # because it stalls at 64K bytes (65536).
-        input_idx = 0
+        # A channel that reported its exit status without EOF (e.g. a
+        # background child holding the pty) is checked at this interval.
+        maxwait = 1.0
+
         timeout_flag = False
-        self.info('polling (%d, %d)' % (maxseconds, maxcount))
-        start = datetime.datetime.now()
-        start_secs = time.mktime(start.timetuple())
-        output = ''
+        verbose = self.verbose
+        if verbose:
+            self.info('polling (%d)', timeout)
+        deadline = time.monotonic() + timeout
+        total = 0
         session.setblocking(0)
         while True:
-            if session.recv_ready():
-                data = session.recv(self.bufsize)
-                output += data.decode('utf-8')
-                self.info('read %d bytes, total %d' % (len(data), len(output)))
-
-                if session.send_ready():
-                    # We received a potential prompt.
-                    # In the future this could be made to work more like
-                    # pexpect with pattern matching.
-                    if input_idx < len(input_data):
-                        data = input_data[input_idx] + '\n'
-                        input_idx += 1
-                        self.info('sending input data %d' % (len(data)))
-                        session.send(data)
-
-            self.info('session.exit_status_ready() = %s' % (str(session.exit_status_ready())))
-            if session.exit_status_ready():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if verbose:
+                    self.info('polling finished - timeout')
+                timeout_flag = True
                 break
 
-            # Timeout check
-            now = datetime.datetime.now()
-            now_secs = time.mktime(now.timetuple())
-            et_secs = now_secs - start_secs
-            self.info('timeout check %d %d' % (et_secs, maxseconds))
-            if et_secs > maxseconds:
-                self.info('polling finished - timeout')
-                timeout_flag = True
+            readable, _, _ = select.select([session], [], [], min(remaining, maxwait))
+            if readable:
+                if stderr_sink is not None and session.recv_stderr_ready():
+                    data = session.recv_stderr(self.bufsize)
+                    stderr_sink(data)
+                    if verbose:
+                        self.info('read %d stderr bytes', len(data))
+                    continue
+                try:
+                    data = session.recv(self.bufsize)
+                except socket.timeout:
+                    data = None
+                if data == b'':
+                    # EOF, the remote side has no more output.
+                    break
+                if data:
+                    sink(data)
+                    total += len(data)
+                    if verbose:
+                        self.info('read %d bytes, total %d', len(data), total)
+            elif session.exit_status_ready() and not session.recv_ready():
                 break
-            time.sleep(0.200)
 
-        self.info('polling loop ended')
-        if session.recv_ready():
+        if verbose:
+            self.info('polling loop ended')
+        while session.recv_ready():
             data = session.recv(self.bufsize)
-            output += data.decode('utf-8')
-            self.info('read %d bytes, total %d' % (len(data), len(output)))
-
-        self.info('polling finished - %d output bytes' % (len(output)))
+            sink(data)
+            total += len(data)
+            if verbose:
+                self.info('read %d bytes, total %d', len(data), total)
+        while stderr_sink is not None and session.recv_stderr_ready():
+            stderr_sink(session.recv_stderr(self.bufsize))
+
+        if verbose:
+            self.info('polling finished - %d output bytes', total)
         if timeout_flag:
-            self.info('appending timeout message')
-            output += '\nERROR: timeout after %d seconds\n' % (timeout)
+            if verbose:
+                self.info('appending timeout message')
+            sink(('\nERROR: timeout after %d seconds\n' % (timeout)).encode('utf-8'))
             session.close()
 
-        return output
+        return total
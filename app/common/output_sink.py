@@ -0,0 +1,61 @@
+import codecs, hashlib, os
+
+class OutputSink():
+  def __init__(self, path:str, tail:int=4096, empty:bool=True):
+    """Writes the output of a command to a log file as it arrives, and keeps only a digest and a tail in memory
+      :param path: The log file, which is replaced on each run, or None to keep the whole output in data
+      :type path: string
+      :param tail: The maximum number of characters to keep, defaults to 4096
+      :type tail: int
+      :param empty: Create the log file when nothing is written, else remove the log file of an earlier run, defaults to True
+      :type empty: bool
+    """
+    self.path = path
+    self.empty = empty
+    self.limit = tail
+    self.size = 0
+    self.tail = ''
+    self.hash = hashlib.sha256()
+    self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    # The bytes of the output as written, without a log file
+    self.data = bytearray() if path is None else None
+    # The log file is opened by the first write, so that many sinks do not hold many descriptors
+    self.fp = None
+
+  def __call__(self, data:bytes):
+    self.write(data)
+
+  def open(self):
+    if self.path is None:
+      return
+    if self.fp is None:
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      self.fp = open(self.path, 'wb')
+
+  def write(self, data:bytes):
+    if self.data is not None:
+      self.data += data
+    else:
+      self.open()
+      self.fp.write(data)
+      # Flush each chunk so that operators can follow the log with tail -f
+      self.fp.flush()
+    self.size += len(data)
+    self.hash.update(data)
+    self.tail = (self.tail + self.decoder.decode(data))[-self.limit:]
+
+  def close(self):
+    if self.data is not None:
+      self.tail = (self.tail + self.decoder.decode(b'', final=True))[-self.limit:]
+      return
+    if self.fp is None and not self.empty:
+      if os.path.exists(self.path):
+        os.remove(self.path)
+      return
+    self.open()
+    if not self.fp.closed:
+      self.tail = (self.tail + self.decoder.decode(b'', final=True))[-self.limit:]
+      self.fp.close()
+
+  def digest(self) -> str:
+    return self.hash.hexdigest()
@@ -0,0 +1,93 @@
+from common.state_store import Shard, shard_digest
+import hashlib, json, struct, time, zlib
+
+PLAN_MAGIC = b'VKPLAN'
+PLAN_VERSION = 2
+# magic, version, payload length, sha256 of the payload
+PLAN_HEADER = struct.Struct('>6sHI32s')
+
+def state_fingerprint(state_mods: dict) -> str:
+  '''
+  Hash the mods section of a state file, which changes on every apply.
+  The digest of each shard comes from the index, so that shards are not
+  read.
+
+  @param state_mods     The mods section of a state file.
+  @returns              The sha256 hex digest of the shard digests.
+  '''
+  digests = {}
+  for mod, names in state_mods.items():
+    digests[mod] = names.fingerprint() if isinstance(names, Shard) else shard_digest(names)
+  canonical = json.dumps(digests, sort_keys=True, separators=(',', ':'))
+  return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def write_plan(file: str, hosts: dict) -> int:
+  '''
+  Write a plan file, which is a header followed by the zlib compressed
+  JSON payload:
+
+    magic "VKPLAN" | version | payload length | sha256 of payload | payload
+
+  Here is an example of hosts:
+
+    hosts               { "web1": { "insert": {...}, "replace": {...},
+                          "update": {...}, "remove": {...},
+                          "commands": {...}, "fingerprint": "..." } }
+
+  @param file           The plan file, e.g. plan.vkplan.
+  @param hosts          The plan of each host, where a single server is "".
+  @returns              The number of bytes written.
+  '''
+  payload = zlib.compress(json.dumps({
+    'created': time.time(),
+    'hosts': hosts
+  }, separators=(',', ':')).encode('utf-8'), 9)
+  header = PLAN_HEADER.pack(PLAN_MAGIC, PLAN_VERSION, len(payload), hashlib.sha256(payload).digest())
+  with open(file, 'wb') as fp:
+    fp.write(header)
+    fp.write(payload)
+  return len(header) + len(payload)
+
+def read_plan(file: str) -> dict:
+  '''
+  Read and verify a plan file written by write_plan.
+
+  @param file           The plan file, e.g. plan.vkplan.
+  @returns              The plan of each host.
+  @raises ValueError    If the file is not a plan, has another version or
+                        fails the checksum.
+  '''
+  with open(file, 'rb') as fp:
+    data = fp.read()
+  if len(data) < PLAN_HEADER.size:
+    raise ValueError('{} is not a viki plan file.'.format(file))
+  magic, version, length, digest = PLAN_HEADER.unpack_from(data)
+  if magic != PLAN_MAGIC:
+    raise ValueError('{} is not a viki plan file.'.format(file))
+  if version != PLAN_VERSION:
+    raise ValueError('{} has plan version {}, expected {}.'.format(file, version, PLAN_VERSION))
+  payload = data[PLAN_HEADER.size:]
+  if len(payload) != length or hashlib.sha256(payload).digest() != digest:
+    raise ValueError('{} failed the checksum.'.format(file))
+  return json.loads(zlib.decompress(payload).decode('utf-8'))['hosts']
+
+class SavedPlan():
+  def __init__(self, plan:dict):
+    """Stands in for a PlanResponse with the plan of a host from a plan file
+      :param plan: The plan of a host returned by read_plan
+      :type plan: dict
+    """
+    self.delta_insert = plan['insert']
+    self.delta_replace = plan['replace']
+    # A plan of an earlier version has no synced resources
+    self.delta_update = plan.get('update', {})
+    self.delta_remove = plan['remove']
+    self.commands = plan['commands']
+    self.fingerprint = plan['fingerprint']
+    self.count_insert = sum(len(names) for names in self.delta_insert.values())
+    self.count_replace = sum(len(names) for names in self.delta_replace.values())
+    self.count_update = sum(len(names) for names in self.delta_update.values())
+    self.count_remove = sum(len(names) for names in self.delta_remove.values())
+
+  def pretty_json(self, config:dict) -> str:
+    return json.dumps(config, indent=4)
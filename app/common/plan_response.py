@@ -1,46 +1,122 @@
 from abc import ABC
 from common.base_response import BaseResponse
-from common.ssh_command import MODS_COMMAND
+from common.ssh_command import MODS_COMMAND, MODS_TEMPLATE, SYNC_PARAMS, resource_fingerprint
+from common.state_store import Shard
+from common.scheduler import Scheduler
 
 class PlanResponse(BaseResponse, ABC):
-  def __init__(self, logger, ssh, config:dict, state:dict):
+  def __init__(self, logger, ssh, config:dict, state:dict, facts=None, root:str='.', drift:dict=None):
+    """Compares the configuration with the state of a host
+      :param ssh: The Transport of the host, or None for plan --offline
+      :type ssh: Transport
+      :param root: The path of the configuration files, where the src of a synced resource starts, defaults to .
+      :type root: string
+      :param drift: The resources that refresh found missing on the host, as {mod: {name: time}}, defaults to None
+      :type drift: dict
+    """
     self.log = logger
-    self.log.fn = self.__class__.__name__ + '.' + self.__init__.__name__
     self.ssh = ssh
+    self.root = root
+    self.drift = drift if drift is not None else {}
     unknown_mods = self.check_schema(config, schema=MODS_COMMAND)
     if unknown_mods != set():
       self.log.error('Unknown modules {} found in mods.'.format(unknown_mods))
     self.config = config
-    self.check_which(self.config)
+    self.check_params(self.config, MODS_TEMPLATE, 'insert')
+    Scheduler(self.log, self.config).check()
     self.state = state
-    self.delta_insert = self.__delta_insert()
+    self.delta_insert, self.delta_replace, self.delta_remove = self.__deltas()
+    self.delta_update = self.__updates()
     self.count_insert = self.__delta_count(self.delta_insert)
-    self.delta_remove = self.__delta_remove()
+    self.count_update = self.__delta_count(self.delta_update)
+    self.count_replace = self.__delta_count(self.delta_replace)
     self.count_remove = self.__delta_count(self.delta_remove)
+    self.check_params({mod: {name: self.state[mod][name] for name in names} for mod, names in self.delta_remove.items()}, MODS_TEMPLATE, 'remove')
+    if self.ssh is not None:
+      self.check_which(self.config, facts)
 
-  def __delta_insert(self) -> dict:
-    self.log.fn = self.__class__.__name__ + '.' + self.__delta_insert.__name__
-    delta = {}
+  def __deltas(self) -> tuple:
+    """Classifies each resource as unchanged, add, replace or destroy in one pass over fingerprints
+      :returns: A tuple of (insert, replace, remove), where a replaced resource is also in insert and remove
+    """
+    insert = {}
+    replace = {}
+    remove = {}
     for mod, names in self.config.items():
-      state = self.state if mod in self.state else { mod: {} }
-      add = self.check_schema(names, state[mod])
-      delta[mod] = dict.fromkeys(add, 0)
+      state = self.state[mod] if mod in self.state else {}
+      # Keep the order of the configuration so that apply is deterministic
+      insert[mod] = {}
+      replace[mod] = {}
+      remove[mod] = {}
       for name, param in names.items():
-        if name in delta[mod]:
-          delta[mod][name] = param
-    return delta
+        if not name in state:
+          insert[mod][name] = param
+        elif name in self.drift.get(mod, {}):
+          # A resource that is gone from the host is added again in place, without its remove command
+          self.log.info('{}.{} drifted, it is added again.', mod, name)
+          insert[mod][name] = param
+        elif resource_fingerprint(mod, param) != self.__state_fingerprint(mod, name, param):
+          insert[mod][name] = param
+          replace[mod][name] = param
+          remove[mod][name] = 0
+      for name in state:
+        if not name in names:
+          remove[mod][name] = 0
+    return insert, replace, remove
 
-  def __delta_remove(self) -> dict:
-    self.log.fn = self.__class__.__name__ + '.' + self.__delta_remove.__name__
-    delta = {}
+  def __updates(self) -> dict:
+    """Finds the synced resources whose files changed locally, or on the host unless offline, which apply syncs in place
+      :returns: The updated resources, which are also in delta_insert
+    """
+    update = {}
+    jobs = []
     for mod, names in self.config.items():
-      state = self.state if mod in self.state else { mod: {} }
-      remove = self.check_schema(state[mod], names)
-      delta[mod] = dict.fromkeys(remove, 0)
-      for name, param in names.items():
-        if name in delta[mod]:
-          delta[mod][name] = param
-    return delta
+      if mod in SYNC_PARAMS:
+        update[mod] = {}
+        jobs += [(mod, name, param) for name, param in names.items()]
+    if jobs == []:
+      return update
+    from common.file_sync import FileSync
+    sync = FileSync(self.log, self.ssh, self.root)
+    for mod, name, param in jobs:
+      sync.check('{}.{}'.format(mod, name), param)
+    jobs = [(mod, name, param) for mod, name, param in jobs if mod in self.state and name in self.state[mod] and not name in self.delta_insert[mod]]
+    # The files of every synced resource are checked with one remote stat
+    diffs = sync.diff([('{}.{}'.format(mod, name), param, self.state[mod][name].get('files')) for mod, name, param in jobs])
+    for (mod, name, param), diff in zip(jobs, diffs):
+      if diff.changed():
+        self.log.info('{}: {}', diff.label, diff.summary())
+        update[mod][name] = param
+    for mod, names in update.items():
+      if names != {}:
+        self.delta_insert[mod] = {name: param for name, param in self.config[mod].items() if name in self.delta_insert[mod] or name in names}
+    return update
+
+  def __state_fingerprint(self, mod:str, name:str, param:dict) -> str:
+    """Returns the fingerprint of a resource in the state, or of its stored params if it has none
+      :param param: The params of the resource in the configuration
+      :type param: dict
+    """
+    names = self.state[mod]
+    fingerprint = names.resource_fingerprint(name) if isinstance(names, Shard) else names[name].get('fingerprint')
+    if fingerprint is None:
+      # A resource applied before fingerprints were stored, whose output param was overwritten with the
+      # output of its command, e.g. wget, so that output is left out of the comparison
+      fingerprint = resource_fingerprint(mod, {**names[name], 'output': param.get('output')})
+    return fingerprint
+
+  def render_commands(self) -> dict:
+    """Renders the commands of the deltas without the sudo password, e.g. for a plan file
+    """
+    commands = {'insert': {}, 'remove': {}}
+    for mod, names in self.delta_insert.items():
+      rendered = MODS_TEMPLATE[mod]['insert'].render_many(list(names.values()))
+      commands['insert'][mod] = dict(zip(names.keys(), rendered))
+    for mod, names in self.delta_remove.items():
+      found = [name for name in names.keys() if mod in self.state and name in self.state[mod]]
+      rendered = MODS_TEMPLATE[mod]['remove'].render_many([self.state[mod][name] for name in found])
+      commands['remove'][mod] = dict(zip(found, rendered))
+    return commands
 
   def __delta_count(self, delta:dict) -> int:
     sum = 0
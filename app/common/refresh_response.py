@@ -0,0 +1,81 @@
+from abc import ABC
+from common.base_response import BaseResponse
+from common.ssh_command import MODS_PROBE, PROBE_TEMPLATE, probe_key, sudo_command
+import time
+
+class RefreshResponse(BaseResponse, ABC):
+  def __init__(self, logger, ssh, state:dict, vars:dict, drift:dict=None, channels:int=1, timeout:int=180):
+    """Checks that the resources of a state still exist on the host, e.g. a container that stopped out of band
+      :param state: The mods section of a state
+      :type state: dict
+      :param drift: The drift section of the state, which keeps the time that each resource was first found missing
+      :type drift: dict
+    """
+    self.log = logger
+    self.ssh = ssh
+    self.channels = channels
+    self.timeout = timeout
+    # Every probe of a mod is one command, and every command is one script, i.e. one round trip
+    self.batch = True
+    self.sudo_password = None
+    if 'sudo_password' in vars and vars['sudo_password'] != '':
+      self.sudo_password = vars['sudo_password']
+    self.state = state
+    self.drift = drift if drift is not None else {}
+    self.count = 0
+
+  def probe_command(self, mod:str, params:list) -> str:
+    """Returns the command that checks every resource of a mod, which prints the index of each that exists
+    """
+    probe = MODS_PROBE[mod]
+    if 'list' in probe:
+      return probe['list']
+    tests = PROBE_TEMPLATE[mod].render_many(params)
+    return '\n'.join('if {}; then echo {}; fi'.format(test, idx) for idx, test in enumerate(tests))
+
+  def refresh(self) -> dict:
+    """Probes the resources of every mod with one batched check each
+      :returns: The drifted resources, as {mod: {name: time}}, where a mod that was not probed keeps its drift
+    """
+    jobs = []
+    drift = {}
+    for mod, names in self.state.items():
+      if len(names) == 0:
+        continue
+      if not mod in MODS_PROBE:
+        self.log.warning('mod {} has no probe, {} resources not checked.', mod, len(names))
+        self.__keep(drift, mod)
+        continue
+      names = list(names.keys())
+      params = [self.state[mod][name] for name in names]
+      jobs.append((mod, names, params, sudo_command(self.probe_command(mod, params), self.sudo_password)))
+    results = self.run_commands([exec for mod, names, params, exec in jobs])
+    now = time.time()
+    for (mod, names, params, exec), (status, output) in zip(jobs, results):
+      lines = set(line.strip() for line in output.splitlines())
+      if 'list' in MODS_PROBE[mod]:
+        if status != 0:
+          # A list that failed, e.g. sudo, does not tell that the resources are gone
+          self.log.error('probe of mod {} returned status code {}: {}'.format(mod, status, output.strip()))
+          self.__keep(drift, mod)
+          continue
+        found = [probe_key(mod, param) in lines for param in params]
+      else:
+        if status == -1:
+          self.log.error('probe of mod {} did not finish: {}'.format(mod, output.strip()))
+          self.__keep(drift, mod)
+          continue
+        found = [str(idx) in lines for idx in range(len(names))]
+      self.count += len(names)
+      for name, exists in zip(names, found):
+        if not exists:
+          drift.setdefault(mod, {})[name] = self.drift.get(mod, {}).get(name, now)
+          self.log.warning('{}.{} not found on the host, it is added again by the next apply.', mod, name)
+    return drift
+
+  def __keep(self, drift:dict, mod:str):
+    """Keeps the drift of a mod that was not probed, for the resources that are still in the state
+    """
+    names = {name: since for name, since in self.drift.get(mod, {}).items() if name in self.state[mod]}
+    if names != {}:
+      drift[mod] = names
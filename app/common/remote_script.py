@@ -0,0 +1,63 @@
+'''
+Keeps a Python script of viki on each host, e.g. viki_agent or block_delta, in ~/.cache/viki/<prefix>-<digest>.py.
+
+The digest of the source names the file, so a host runs the version of this viki, and a script is only uploaded
+when the command that runs it exits with SCRIPT_MISSING.
+'''
+import functools, hashlib, os
+
+# Exit status of the command of a script when the host does not have this version yet
+SCRIPT_MISSING = 3
+
+@functools.lru_cache(maxsize=None)
+def script_source(module: str) -> tuple:
+  '''
+  Read the source of a script in the common folder.
+
+  @param module         The module name, e.g. viki_agent.
+  @returns              A tuple of (source, digest), where the digest names the uploaded file.
+  '''
+  with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), module + '.py'), 'rb') as fp:
+    source = fp.read()
+  return source, hashlib.sha256(source).hexdigest()[:16]
+
+def script_path(module: str, prefix: str) -> str:
+  '''
+  Get the path of a script on the host, e.g. ~/.cache/viki/agent-<digest>.py.
+  '''
+  return '~/.cache/viki/{}-{}.py'.format(prefix, script_source(module)[1])
+
+def script_command(path: str, python: str, args: str = '') -> str:
+  '''
+  Get the command that runs a script, or exits with SCRIPT_MISSING when the host does not have it.
+
+  @param python         The interpreter and its options, e.g. "python3 -u".
+  @param args           The quoted arguments of the script, defaults to none.
+  '''
+  return 'test -f {path} || exit {missing}; exec {python} {path}{args}'.format(
+    path=path, missing=SCRIPT_MISSING, python=python, args=' ' + args if args != '' else '')
+
+def upload_command(path: str) -> str:
+  '''
+  Get the command that writes its stdin to a script on the host, with a rename so that a partial file is never run.
+  '''
+  return 'mkdir -p ~/.cache/viki && cat > {path}.tmp && mv {path}.tmp {path}'.format(path=path)
+
+def ensure_script(module: str, prefix: str, launch, upload) -> tuple:
+  '''
+  Run a script on the host, and upload it first when the host does not have this version.
+
+  @param launch         A function that takes the path of the script and returns a tuple of
+                        (status, result), where status is SCRIPT_MISSING without the script.
+  @param upload         A function that takes the path and the source of the script, writes
+                        it to the host and returns an exit status, 0 when it is written.
+  @returns              The (status, result) of the last launch, or of the upload that failed.
+  '''
+  path = script_path(module, prefix)
+  status, result = launch(path)
+  if status == SCRIPT_MISSING:
+    status = upload(path, script_source(module)[0])
+    if status != 0:
+      return status, None
+    status, result = launch(path)
+  return status, result
@@ -0,0 +1,128 @@
+class Scheduler():
+  def __init__(self, logger, *resources):
+    """Orders resources by their depends_on, e.g. depends_on: [ mkdir.docker ] or depends_on: mkdir.docker
+      :param resources: One or more resources of each mod, e.g. the mods of the configuration or of a state,
+        where the first that has a resource wins, and whose params are only read when a resource is visited
+      :type resources: dict
+    """
+    self.log = logger
+    self.resources = resources
+    self.parsed = {}
+    self.unknown = {}
+    self.before = {}
+
+  def __param(self, node:tuple):
+    mod, name = node
+    for resources in self.resources:
+      if mod in resources and name in resources[mod]:
+        return resources[mod][name]
+    return None
+
+  def __depends(self, node:tuple) -> list:
+    if not node in self.parsed:
+      param = self.__param(node)
+      refs = param.get('depends_on', []) if isinstance(param, dict) else []
+      if isinstance(refs, str):
+        refs = [refs]
+      depends = []
+      for ref in refs:
+        mod, _, name = str(ref).partition('.')
+        if self.__param((mod, name)) is not None:
+          depends.append((mod, name))
+        else:
+          self.unknown.setdefault(node, []).append(ref)
+      self.parsed[node] = depends
+    return self.parsed[node]
+
+  def check(self):
+    """Raises an error for an unknown resource in depends_on or for a cycle between resources
+    """
+    nodes = [(mod, name) for resources in self.resources for mod, names in resources.items() for name in names]
+    for node in nodes:
+      self.__depends(node)
+    for (mod, name), refs in self.unknown.items():
+      msg = 'Unknown resources {} found in depends_on of {}.{}.'.format(refs, mod, name)
+      self.log.error(msg, ValueError(msg))
+    # Iterative depth first search, where a grey node on the path closes a cycle
+    color = dict.fromkeys(nodes, 0)
+    for root in nodes:
+      if color[root] != 0:
+        continue
+      path = [root]
+      stack = [iter(self.__depends(root))]
+      color[root] = 1
+      while stack:
+        node = next(stack[-1], None)
+        if node is None:
+          color[path.pop()] = 2
+          stack.pop()
+        elif color[node] == 1:
+          cycle = path[path.index(node):] + [node]
+          msg = 'Cycle found in depends_on: {}.'.format(' -> '.join(mod + '.' + name for mod, name in cycle))
+          self.log.error(msg, ValueError(msg))
+        elif color[node] == 0:
+          color[node] = 1
+          path.append(node)
+          stack.append(iter(self.__depends(node)))
+
+  def levels(self, delta:dict, reverse:bool=False) -> list:
+    """Groups the resources of a delta into levels, where each level only depends on earlier levels
+      :param delta: The resources of each mod to run, e.g. a delta of PlanResponse
+      :type delta: dict
+      :param reverse: Order for remove, where a resource runs before the resources that it depends on
+      :type reverse: bool
+      :returns: A list of levels, each a list of (mod, name) in the order of delta
+    """
+    nodes = [(mod, name) for mod, names in delta.items() for name in names.keys()]
+    order = {node: idx for idx, node in enumerate(nodes)}
+    self.before = {node: [] for node in nodes}
+    for node in nodes:
+      for dep in self.__delta_depends(node, order):
+        if reverse:
+          self.before[dep].append(node)
+        else:
+          self.before[node].append(dep)
+    # Kahn's algorithm, one level at a time
+    after = {node: [] for node in nodes}
+    count = {}
+    for node in nodes:
+      count[node] = len(self.before[node])
+      for dep in self.before[node]:
+        after[dep].append(node)
+    levels = []
+    level = [node for node in nodes if count[node] == 0]
+    while level:
+      levels.append(level)
+      ready = []
+      for node in level:
+        for nxt in after[node]:
+          count[nxt] -= 1
+          if count[nxt] == 0:
+            ready.append(nxt)
+      level = sorted(ready, key=order.get)
+    if sum(len(level) for level in levels) < len(nodes):
+      msg = 'Cycle found in depends_on of {}.'.format([mod + '.' + name for mod, name in nodes if count[(mod, name)] > 0])
+      self.log.error(msg, ValueError(msg))
+    return levels
+
+  def __delta_depends(self, node:tuple, order:dict) -> list:
+    """Returns the resources of a delta that a resource depends on, also through resources outside the delta
+    """
+    found = []
+    seen = set()
+    stack = list(self.__depends(node))
+    while stack:
+      dep = stack.pop()
+      if dep in seen:
+        continue
+      seen.add(dep)
+      if dep in order:
+        found.append(dep)
+      else:
+        stack.extend(self.__depends(dep))
+    return found
+
+  def blocked(self, node:tuple, failed:set) -> bool:
+    """Returns True if a resource that must run before this resource failed, after levels
+    """
+    return any(dep in failed for dep in self.before.get(node, []))
@@ -1,3 +1,5 @@
+import functools, hashlib, json, re, shlex
+
 DATA_COMMAND={
   "df": "df -h",
   "docker": "sudo docker ps",
@@ -22,12 +24,244 @@ MODS_COMMAND={
     "insert": "mkdir -p ${path}",
     "remove": "rmdir ${path}"
   },
+  "sync": {
+    "insert": "mkdir -p ${dest}",
+    "remove": "rmdir ${dest} 2>/dev/null || true"
+  },
   "wget": {
     "insert": "[ -f ${path}/${output} ] || wget -O ${path}/${output} ${url}",
     "remove": "rm ${path}/${output}"
   }
 }
 
+# A cheap check that a resource of each mod still exists on the host, where refresh checks every resource of
+# a mod in one remote script. A "test" is a shell test of each resource, and a "list" runs once and prints a
+# line for each resource that exists, which is matched against the "key" of each resource, e.g. one docker ps
+MODS_PROBE={
+  "cloudflared": {
+    "list": "sudo docker ps --format '{{.Names}}'",
+    "key": "${name}"
+  },
+  "compose": {
+    "test": "sudo docker-compose -f ${path} ps -q 2>/dev/null | grep -q ."
+  },
+  "gitwiki": {
+    "test": "[ -d /var/snap/docker/common/var-lib-docker/volumes/${volume}/_data/${folder} ]"
+  },
+  "mkdir": {
+    "test": "[ -d ${path} ]"
+  },
+  "sync": {
+    "test": "[ -d ${dest} ]"
+  },
+  "wget": {
+    "test": "[ -f ${path}/${output} ]"
+  }
+}
+
+# How the commands of each mod run, where a mod that is not listed uses DEFAULT_PROFILE. Only a mod that
+# needs a terminal sets pty, e.g. a command that refuses to run without one
+DEFAULT_PROFILE = {"pty": False}
+EXEC_PROFILE = {}
+
+# Mods whose insert command creates a directory that FileSync then fills with local files over SFTP, and
+# whose synced files FileSync deletes before the remove command, which only removes the directory when it
+# is empty. The parameters of each are used by FileSync instead of a command, e.g. the local src of sync
+SYNC_PARAMS = {"sync": frozenset(["src"])}
+
+# Parameters of a resource that are not placeholders, e.g. outputs stored in a state, where output is
+# only a placeholder of some commands, e.g. wget
+META_PARAMS = frozenset(['depends_on', 'fingerprint', 'output', 'output_digest', 'output_size', 'output_log',
+  'error_digest', 'error_size', 'files'])
+PLACEHOLDER = re.compile(r'\$\{(\w+)\}')
+SAFE_VALUE = re.compile(r'[\w@%+=:,./-]+')
+# A leading ~ or ~user, up to the first slash, is only expanded by the shell when it is not quoted
+TILDE_PREFIX = re.compile(r'~[\w.-]*(/|$)')
+
+def quote_value(value, context: str = '') -> str:
+  '''
+  Quote a parameter value for the shell context of its placeholder.
+
+  Here is an example of a value in each context:
+
+    value               "it's ~/a b"
+    context ''          'it'"'"'s ~/a b'
+    context "'"         it'"'"'s ~/a b
+    context '"'         it's ~/a b
+
+  A value in an unquoted context is left as is when it only has safe
+  characters, and keeps a leading ~ unquoted so that it still expands,
+  e.g. "~/a b" returns ~/'a b'.
+
+  @param value          The parameter value, which is converted to str.
+  @param context        The quote that the placeholder is in, where '' is
+                        unquoted. (Default: '')
+  @returns              The value to substitute for the placeholder.
+  '''
+  value = str(value)
+  if context == "'":
+    return value.replace("'", "'\"'\"'")
+  if context == '"':
+    return re.sub(r'([\\"$`])', r'\\\1', value)
+  if value == '' or SAFE_VALUE.fullmatch(value):
+    return shlex.quote(value)
+  match = TILDE_PREFIX.match(value)
+  if match is not None:
+    rest = value[match.end():]
+    return match.group(0) + (quote_value(rest) if rest != '' else '')
+  return shlex.quote(value)
+
+class CommandTemplate():
+  def __init__(self, command: str, params: frozenset = frozenset()):
+    """Compiles a command with ${key} placeholders once, e.g. "ls -lAG ${path}"
+      :param command: The command with placeholders, where a placeholder may be inside single or double quotes
+      :type command: string
+      :param params: The parameters of the mod that are not placeholders, e.g. SYNC_PARAMS, defaults to none
+      :type params: frozenset
+    """
+    self.command = command
+    self.params = params
+    # Literals and (key, context) pairs in the order of the command
+    self.parts = []
+    self.keys = set()
+    context = ''
+    pos = 0
+    for match in PLACEHOLDER.finditer(command):
+      literal = command[pos:match.start()]
+      context = self.__context(literal, context)
+      self.parts.append(literal)
+      self.parts.append((match.group(1), context))
+      self.keys.add(match.group(1))
+      pos = match.end()
+    self.parts.append(command[pos:])
+
+  def __context(self, literal: str, context: str) -> str:
+    """Returns the quote that is open after a literal, which starts in context
+    """
+    escaped = False
+    for char in literal:
+      if escaped:
+        escaped = False
+      elif char == '\\' and context != "'":
+        escaped = True
+      elif context == '' and char in ("'", '"'):
+        context = char
+      elif char == context:
+        context = ''
+    return context
+
+  def check(self, param: dict) -> tuple:
+    """Returns a tuple of (missing, unknown) sorted lists of parameters of a resource
+    """
+    keys = set(param.keys())
+    return sorted(self.keys - keys), sorted(keys - self.keys - self.params - META_PARAMS)
+
+  def render(self, param: dict, sudo_password: str = None) -> str:
+    """Returns the command with the shell quoted values of param
+      :raises ValueError: If a placeholder has no parameter
+    """
+    missing, unknown = self.check(param)
+    if missing != []:
+      raise ValueError('Missing parameters {} for command "{}".'.format(missing, self.command))
+    ret = ''.join(part if isinstance(part, str) else quote_value(param[part[0]], part[1]) for part in self.parts)
+    return sudo_command(ret, sudo_password)
+
+  def render_many(self, params_list: list, sudo_password: str = None) -> list:
+    """Returns the command of each param in params_list, e.g. for every resource of a mod
+      :raises ValueError: If a placeholder has no parameter in any param, before any command is rendered
+    """
+    errors = []
+    for idx, param in enumerate(params_list):
+      missing, unknown = self.check(param)
+      if missing != []:
+        errors.append('{}: {}'.format(idx, missing))
+    if errors != []:
+      raise ValueError('Missing parameters for command "{}" in {}.'.format(self.command, ', '.join(errors)))
+    literals = [part if isinstance(part, str) else None for part in self.parts]
+    ret = []
+    for param in params_list:
+      ret.append(sudo_command(''.join(
+        literal if literal is not None else quote_value(param[part[0]], part[1])
+        for literal, part in zip(literals, self.parts)), sudo_password))
+    return ret
+
+DATA_TEMPLATE = {mod: CommandTemplate(cmd) for mod, cmd in DATA_COMMAND.items()}
+MODS_TEMPLATE = {mod: {op: CommandTemplate(cmd, SYNC_PARAMS.get(mod, frozenset())) for op, cmd in cmds.items()}
+  for mod, cmds in MODS_COMMAND.items()}
+
+PROBE_TEMPLATE = {mod: CommandTemplate(probe['test']) for mod, probe in MODS_PROBE.items() if 'test' in probe}
+
+def probe_key(mod: str, param: dict) -> str:
+  '''
+  Render the key of a list probe of MODS_PROBE without shell quotes,
+  e.g. "tunnel" for the key "${name}" and param { "name": "tunnel" }.
+  '''
+  return PLACEHOLDER.sub(lambda match: str(param.get(match.group(1), '')), MODS_PROBE[mod]['key'])
+
+def resource_fingerprint(mod: str, param: dict) -> str:
+  '''
+  Hash the parameters of a resource that its commands use, so that a
+  change to any of them replaces the resource, e.g. for the mod mkdir:
+
+    param               { "path": "/tmp/a", "depends_on": "mkdir.b" }
+    canonical           [["path","/tmp/a"]]
+
+  The parameters of SYNC_PARAMS are not hashed, as a changed src is
+  synced in place instead of replaced.
+
+  @param mod            The mod of the resource in MODS_TEMPLATE.
+  @param param          The configuration parameters of the resource.
+  @returns              The sha256 hex digest of the canonical parameters.
+  '''
+  keys = sorted(set().union(*(template.keys for template in MODS_TEMPLATE[mod].values())))
+  canonical = json.dumps([[key, param.get(key)] for key in keys], separators=(',', ':'), default=str)
+  return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def exec_profile(mod: str) -> dict:
+  '''
+  Get the execution profile of a mod, e.g. { "pty": False }.
+
+  @param mod            The mod of DATA_COMMAND or MODS_COMMAND, or None.
+  @returns              The EXEC_PROFILE of the mod over DEFAULT_PROFILE.
+  '''
+  return {**DEFAULT_PROFILE, **EXEC_PROFILE.get(mod, {})}
+
+# Reads the sudo password from the first line of stdin once, and shadows sudo with a function that passes
+# it to sudo -S, so that every sudo of a command or a batch script is authenticated without a prompt
+SUDO_PREFIX = "[ -n \"$VIKI_SUDO\" ] || IFS= read -r VIKI_SUDO; sudo() { printf '%s\\n' \"$VIKI_SUDO\" | command sudo -S -p '' \"$@\"; }; "
+SUDO_WORD = re.compile(r'(^|[\s;&|(])sudo\s')
+
+def sudo_command(command: str, sudo_password: str = None) -> str:
+  '''
+  Authenticate every sudo of a rendered command with the sudo password,
+  which the transport writes to stdin once, i.e. needs_sudo_input.
+
+  Here is an example of a command and the return value:
+
+    command             "[ -d /a ] || sudo mkdir /a"
+    returns             SUDO_PREFIX + "[ -d /a ] || sudo mkdir /a"
+
+  The password is not part of the command, so it is not in the process
+  list of the host. Note that the stdin of sudo is the password, so a
+  command that pipes into sudo, e.g. "cat a | sudo tee b", is not
+  supported.
+
+  @param command        The rendered ssh command, e.g. from a plan file.
+  @param sudo_password  Used for sudo password authentication. (Default: None for passwordless)
+  @returns              The ssh command to run.
+  '''
+  if sudo_password is None or len(sudo_password) == 0 or command.startswith(SUDO_PREFIX):
+    return command
+  if SUDO_WORD.search(command) is None:
+    return command
+  return SUDO_PREFIX + command
+
+def needs_sudo_input(command: str) -> bool:
+  '''
+  Check if a command returned by sudo_command reads the sudo password from stdin.
+  '''
+  return SUDO_PREFIX in command
+
 def ssh_command(command: str, config_param: dict, sudo_password: str = None) -> str:
   '''
   Replace placeholders in ssh command with configuration parameters.
@@ -38,16 +272,17 @@ def ssh_command(command: str, config_param: dict, sudo_password: str = None) ->
     config_param        { "path" : "~" }
     returns             "ls -lAG ~"
 
+  The command is compiled into a CommandTemplate once, so prefer
+  DATA_TEMPLATE and MODS_TEMPLATE for the commands of modules.
+
   @param command        The command with placeholders to substitute.
   @param config_param   The configuration parameters.
   @param sudo_password  Used for sudo password authentication. (Default: None for passwordless)
   @returns              The ssh command to run with actual values.
+  @raises ValueError    If a placeholder has no configuration parameter.
   '''
-  ret = command
-  if ret[:4] == "sudo" and not sudo_password is None:
-    if len(sudo_password)>0:
-      ret = "echo " + sudo_password + " | " + ret[:4] + " -S " + ret[5:]
-  for key, val in config_param.items():
-    sub = '${' + key + '}'
-    ret = ret.replace(sub, val)
-  return ret
\ No newline at end of file
+  return command_template(command).render(config_param, sudo_password)
+
+@functools.lru_cache(maxsize=256)
+def command_template(command: str) -> CommandTemplate:
+  return CommandTemplate(command)
@@ -0,0 +1,59 @@
+import subprocess, sys, time
+
+# A line of python -X importtime, e.g. "import time:       361 |      13511 |   yaml"
+IMPORT_TIME = 'import time:'
+
+def import_times(lines:list) -> list:
+  '''
+  Parse the stderr of python -X importtime.
+
+  Here is an example of the list returned, where depth 0 is imported by the application:
+
+    [ ("common.cli_request", 53423, 290, 0), ("yaml", 13511, 361, 1) ]
+
+  @param lines          The lines of stderr.
+  @returns              A list of (module, cumulative, self, depth), in microseconds.
+  '''
+  times = []
+  for line in lines:
+    if not line.startswith(IMPORT_TIME):
+      continue
+    fields = line[len(IMPORT_TIME):].split('|')
+    if len(fields) != 3 or not fields[0].strip().isdigit():
+      # The header, i.e. "self [us] | cumulative | imported package"
+      continue
+    name = fields[2].rstrip()
+    depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+    times.append((name.strip(), int(fields[1]), int(fields[0]), depth))
+  return times
+
+def startup_profile(script:str, argv:list, count:int=15) -> str:
+  '''
+  Run viki again with python -X importtime and report where its startup time goes.
+
+  The command runs in full, e.g. plan --offline, and its output is discarded.
+
+  @param script         The path of viki.py.
+  @param argv           The arguments of the command, defaults to --help when empty.
+  @param count          The number of modules reported.
+  @returns              The report as text.
+  '''
+  argv = argv if argv != [] else ['--help']
+  start = time.perf_counter()
+  proc = subprocess.run([sys.executable, '-X', 'importtime', script] + argv,
+    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+  wall = time.perf_counter() - start
+  times = import_times(proc.stderr.splitlines())
+  total = sum(cumulative for name, cumulative, own, depth in times if depth == 0)
+  lines = ['Startup profile of viki {} (exit status {})'.format(' '.join(argv), proc.returncode),
+    '  wall time      {:>8.1f} ms'.format(wall * 1000),
+    '  imports        {:>8.1f} ms in {} modules'.format(total / 1000, len(times)),
+    '', 'Slowest imports by cumulative time:']
+  for name, cumulative, own, depth in sorted(times, key=lambda item: item[1], reverse=True)[:count]:
+    lines.append('  {:>8.1f} ms {:>8.1f} ms self  {}{}'.format(cumulative / 1000, own / 1000, '  ' * depth, name))
+  lines.append('')
+  lines.append('Modules of viki:')
+  for name, cumulative, own, depth in times:
+    if name.startswith('common.'):
+      lines.append('  {:>8.1f} ms  {}'.format(cumulative / 1000, name))
+  return '\n'.join(lines)
@@ -0,0 +1,272 @@
+from collections.abc import MutableMapping
+from common.tracer import TRACER
+import hashlib, json, os, threading
+
+STATE_VERSION = 1
+# Sections of a state that are split into one shard file per mod
+STATE_SHARDS = ('data', 'mods')
+
+def shard_text(names) -> str:
+  return json.dumps(dict(names), indent=2)
+
+def shard_digest(names) -> str:
+  return hashlib.sha256(shard_text(names).encode('utf-8')).hexdigest()
+
+def fsync_dir(path:str):
+  '''
+  Flush the entries of a folder, e.g. after a rename into it, so that the rename survives a power loss.
+
+  @param path           The folder.
+  '''
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except OSError:
+    return  # A platform that cannot open a folder, e.g. Windows
+  try:
+    os.fsync(fd)
+  except OSError:
+    pass
+  finally:
+    os.close(fd)
+
+class Shard(MutableMapping):
+  def __init__(self, file:str=None, names:list=None, digest:str=None, data:dict=None, fingerprints:dict=None):
+    """The resources of one mod, where the names come from the index and the shard file is read on first use
+      :param file: The shard file, defaults to None for a new shard
+      :type file: string
+      :param fingerprints: The fingerprint of each resource from the index, defaults to None
+      :type fingerprints: dict
+    """
+    self.file = file
+    self.names = dict.fromkeys(names if names is not None else [])
+    self.names.update(fingerprints if fingerprints is not None else {})
+    self.digest = digest
+    self.data = data if data is not None or file is not None else {}
+
+  def load(self) -> dict:
+    if self.data is None:
+      with open(self.file) as fp:
+        self.data = json.load(fp)
+    return self.data
+
+  def loaded(self) -> bool:
+    return self.data is not None
+
+  def resource_fingerprint(self, name:str) -> str:
+    """Returns the fingerprint stored with a resource, without reading the shard file, or None
+    """
+    if self.data is None:
+      return self.names.get(name)
+    param = self.data.get(name)
+    return param.get('fingerprint') if isinstance(param, dict) else None
+
+  def fingerprint(self) -> str:
+    if self.data is None:
+      return self.digest
+    return shard_digest(self.data)
+
+  def __getitem__(self, name):
+    return self.load()[name]
+
+  def __setitem__(self, name, value):
+    self.load()[name] = value
+
+  def __delitem__(self, name):
+    del self.load()[name]
+
+  def __contains__(self, name):
+    return name in (self.data if self.data is not None else self.names)
+
+  def __iter__(self):
+    return iter(self.data if self.data is not None else self.names)
+
+  def __len__(self):
+    return len(self.data if self.data is not None else self.names)
+
+  def __repr__(self):
+    return repr(dict(self))
+
+class ShardMap(MutableMapping):
+  def __init__(self, shards:dict=None):
+    """The shards of a section of a state, e.g. viki.mods, by mod
+    """
+    self.shards = shards if shards is not None else {}
+
+  def __getitem__(self, mod):
+    return self.shards[mod]
+
+  def __setitem__(self, mod, names):
+    self.shards[mod] = names if isinstance(names, Shard) else Shard(data=dict(names))
+
+  def __delitem__(self, mod):
+    del self.shards[mod]
+
+  def setdefault(self, mod, names=None):
+    if not mod in self.shards:
+      self[mod] = names if names is not None else {}
+    return self.shards[mod]
+
+  def __iter__(self):
+    return iter(self.shards)
+
+  def __len__(self):
+    return len(self.shards)
+
+  def __repr__(self):
+    return repr(self.shards)
+
+class StateStore():
+  def __init__(self, logger, path:str, file:str="state.vk.json", compact_every:int=1000):
+    """Persists a state as an index with one shard file per mod, e.g. state.vk.d/index.json and
+      state.vk.d/mods/mkdir.<digest>.json, plus an append-only journal, e.g. state.vk.json.journal
+      :param file: A state file name, defaults to state.vk.json, which is only read to migrate it
+      :type file: string
+      :param compact_every: The number of journal records before the journal is compacted into the shards
+      :type compact_every: int
+    """
+    self.log = logger
+    self.file = os.path.join(path, file)
+    self.dir = os.path.join(path, file[:-len('.json')] + '.d' if file.endswith('.json') else file + '.d')
+    self.index_file = os.path.join(self.dir, 'index.json')
+    self.journal_file = self.file + '.journal'
+    self.compact_every = compact_every
+    self.records = 0
+    self.state = None
+    self.lock = threading.Lock()
+
+  def load(self, state:dict) -> dict:
+    """Loads the index, or a state file without shards, and replays the journal on top of it
+      :param state: The state to return when there is no index or state file
+      :type state: dict
+    """
+    if os.path.isfile(self.index_file):
+      state = self.__load_index()
+    elif os.path.isfile(self.file):
+      with open(self.file) as fp:
+        state = json.load(fp)
+    self.records = 0
+    torn = False
+    if os.path.isfile(self.journal_file):
+      with open(self.journal_file) as fp:
+        for line in fp:
+          try:
+            record = json.loads(line)
+          except ValueError:
+            # A torn record from a crash while it was written
+            self.log.warning('Ignored a partial record in {}.'.format(self.journal_file))
+            torn = True
+            break
+          self.__replay(state, record)
+          self.records += 1
+    self.state = state
+    if torn:
+      # Compact so that the next record is not appended to the partial one
+      self.write(state)
+    return state
+
+  def __load_index(self) -> dict:
+    with open(self.index_file) as fp:
+      index = json.load(fp)
+    viki = dict(index['viki'])
+    for section in STATE_SHARDS:
+      shards = {}
+      for mod, entry in index['shards'].get(section, {}).items():
+        shards[mod] = Shard(os.path.join(self.dir, entry['file']), entry['names'], entry['digest'], fingerprints=entry.get('fingerprints'))
+      viki[section] = ShardMap(shards)
+    return {'viki': viki}
+
+  def __replay(self, state:dict, record:dict):
+    node = state
+    for key in record['path'][:-1]:
+      node = node.setdefault(key, {})
+    if record['op'] == 'set':
+      node[record['path'][-1]] = record['value']
+    elif record['op'] == 'del':
+      node.pop(record['path'][-1], None)
+
+  def set(self, path:list, value):
+    """Journals a value that was set in the state, e.g. set(['viki', 'mods', 'mkdir', 'docker'], param)
+    """
+    self.__append({'op': 'set', 'path': path, 'value': value})
+
+  def delete(self, path:list):
+    """Journals a key that was deleted from the state, e.g. delete(['viki', 'mods', 'mkdir', 'docker'])
+    """
+    self.__append({'op': 'del', 'path': path})
+
+  def __append(self, record:dict):
+    line = json.dumps(record, separators=(',', ':')) + '\n'
+    with self.lock, TRACER.span('journal'):
+      created = not os.path.isfile(self.journal_file)
+      with open(self.journal_file, 'a') as fp:
+        fp.write(line)
+        fp.flush()
+        os.fsync(fp.fileno())
+      if created:
+        # The entry of a new journal, without which its first records could be lost
+        fsync_dir(os.path.dirname(self.journal_file) or '.')
+      self.records += 1
+
+  def checkpoint(self):
+    """Compacts the journal into the shards once it has compact_every records
+      Call it only when the loaded state holds every journaled change, e.g. between levels of apply
+    """
+    if self.state is not None and self.records >= self.compact_every:
+      self.write(self.state)
+
+  def write(self, state:dict) -> dict:
+    """Writes the shards that changed and then the index, each atomically with a temp file and a rename,
+      and then removes the journal and the shard files that the index no longer references
+    """
+    with self.lock, TRACER.span('state_write'):
+      index = {'version': STATE_VERSION, 'viki': {}, 'shards': {}}
+      for key, val in state['viki'].items():
+        if not key in STATE_SHARDS:
+          index['viki'][key] = val
+      for section in STATE_SHARDS:
+        index['shards'][section] = {}
+        os.makedirs(os.path.join(self.dir, section), exist_ok=True)
+        for mod, names in state['viki'].get(section, {}).items():
+          index['shards'][section][mod] = self.__write_shard(section, mod, names)
+        # The renamed shards are flushed before the index that references them
+        fsync_dir(os.path.join(self.dir, section))
+      self.__write_file(self.index_file, json.dumps(index, indent=2))
+      fsync_dir(self.dir)
+      if os.path.isfile(self.journal_file):
+        os.remove(self.journal_file)
+      self.__remove_unused(index)
+      if os.path.isfile(self.file):
+        # The state file was migrated to shards, and is kept as a backup
+        os.replace(self.file, self.file + '.migrated')
+      self.records = 0
+      self.state = state
+    return state
+
+  def __write_shard(self, section:str, mod:str, names) -> dict:
+    if isinstance(names, Shard) and not names.loaded():
+      fingerprints = {name: fp for name, fp in names.names.items() if fp is not None}
+      return {'file': os.path.relpath(names.file, self.dir), 'names': list(names.names), 'digest': names.digest, 'fingerprints': fingerprints}
+    text = shard_text(names)
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    # The digest in the file name keeps the shard of the previous index until the new index is written
+    file = os.path.join(section, mod + '.' + digest[:16] + '.json')
+    if not os.path.isfile(os.path.join(self.dir, file)):
+      self.__write_file(os.path.join(self.dir, file), text)
+    # Fingerprints in the index let plan compare resources without reading shard files
+    fingerprints = {name: param['fingerprint'] for name, param in names.items() if isinstance(param, dict) and 'fingerprint' in param}
+    return {'file': file, 'names': list(names.keys()), 'digest': digest, 'fingerprints': fingerprints}
+
+  def __write_file(self, file:str, text:str):
+    tmp = file + '.tmp'
+    with open(tmp, 'w') as fp:
+      fp.write(text)
+      fp.flush()
+      os.fsync(fp.fileno())
+    os.replace(tmp, file)
+
+  def __remove_unused(self, index:dict):
+    used = set(entry['file'] for section in index['shards'].values() for entry in section.values())
+    for section in STATE_SHARDS:
+      for file in os.listdir(os.path.join(self.dir, section)):
+        if not os.path.join(section, file) in used:
+          os.remove(os.path.join(self.dir, section, file))
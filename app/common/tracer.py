@@ -0,0 +1,149 @@
+import contextvars, json, os, threading, time
+
+# Tags of the current host, e.g. host=web1, which are added to every span that starts in this context
+TAGS = contextvars.ContextVar('viki_tags', default={})
+
+class NullSpan():
+  """Stands in for a Span when the tracer is disabled, so that instrumentation costs one call
+  """
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+NULL_SPAN = NullSpan()
+
+class Span():
+  __slots__ = ('tracer', 'name', 'tags', 'start', 'token')
+
+  def __init__(self, tracer, name:str, tags:dict):
+    self.tracer = tracer
+    self.name = name
+    self.tags = tags
+    self.start = 0.0
+    self.token = None
+
+  def __enter__(self):
+    # The spans that start inside this one inherit its tags, e.g. exec inside resource gets mod and name
+    if self.tags:
+      self.token = TAGS.set({**TAGS.get(), **self.tags})
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.tracer.record(self.name, self.start, time.perf_counter(), self.tags)
+    if self.token is not None:
+      TAGS.reset(self.token)
+      self.token = None
+    return False
+
+class Tracer():
+  def __init__(self):
+    """Records timing spans, e.g. connect, exec and state_write, tagged by host, mod and name
+    """
+    self.enabled = False
+    self.spans = []
+    self.lock = threading.Lock()
+    self.origin = time.perf_counter()
+
+  def enable(self):
+    self.enabled = True
+    self.origin = time.perf_counter()
+
+  def tag(self, **tags):
+    """Adds tags to the spans of the current context, e.g. tag(host='web1') in the thread of a host
+    """
+    TAGS.set({**TAGS.get(), **tags})
+
+  def span(self, name:str, /, **tags):
+    """Returns a context manager that records a span from enter to exit, e.g. with TRACER.span('exec'):
+    """
+    if not self.enabled:
+      return NULL_SPAN
+    return Span(self, name, tags)
+
+  def record(self, name:str, start:float, end:float, tags:dict=None):
+    """Records a span that was measured with time.perf_counter, e.g. from exec until the first byte
+    """
+    if not self.enabled:
+      return
+    span = (name, start - self.origin, end - start, threading.get_ident(), {**TAGS.get(), **(tags or {})})
+    with self.lock:
+      self.spans.append(span)
+
+  def slowest(self, name:str='resource', count:int=10) -> list:
+    """Returns the count longest spans of a name as a list of (duration, tags)
+    """
+    with self.lock:
+      spans = [(duration, tags) for span, start, duration, tid, tags in self.spans if span == name]
+    return sorted(spans, key=lambda span: span[0], reverse=True)[:count]
+
+  def totals(self) -> dict:
+    """Returns the (count, seconds) of each span name
+    """
+    totals = {}
+    with self.lock:
+      for name, start, duration, tid, tags in self.spans:
+        count, seconds = totals.get(name, (0, 0.0))
+        totals[name] = (count + 1, seconds + duration)
+    return totals
+
+  def write_chrome_trace(self, file:str) -> int:
+    """Writes the spans in the Chrome trace event format, e.g. for chrome://tracing or Perfetto
+      :returns: The number of spans written
+    """
+    with self.lock:
+      spans = list(self.spans)
+    events = []
+    for name, start, duration, tid, tags in spans:
+      events.append({
+        'name': name,
+        'cat': tags.get('mod') or 'viki',
+        'ph': 'X',
+        'ts': round(start * 1e6, 3),
+        'dur': round(duration * 1e6, 3),
+        'pid': os.getpid(),
+        'tid': tid,
+        'args': tags
+      })
+    self.__write_file(file, json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+    return len(events)
+
+  def write_prometheus(self, file:str) -> int:
+    """Writes the spans as a Prometheus textfile, summed by span, host and mod to keep the labels few
+      :returns: The number of series written
+    """
+    series = {}
+    with self.lock:
+      for name, start, duration, tid, tags in self.spans:
+        key = (name, str(tags.get('host') or ''), str(tags.get('mod') or ''))
+        count, seconds, longest = series.get(key, (0, 0.0, 0.0))
+        series[key] = (count + 1, seconds + duration, max(longest, duration))
+    lines = [
+      '# HELP viki_span_seconds Duration of viki spans, e.g. connect, exec and state_write.',
+      '# TYPE viki_span_seconds summary'
+    ]
+    maxima = [
+      '# HELP viki_span_max_seconds Longest viki span of the last run.',
+      '# TYPE viki_span_max_seconds gauge'
+    ]
+    for (name, host, mod), (count, seconds, longest) in sorted(series.items()):
+      labels = 'span="{}",host="{}",mod="{}"'.format(self.__escape(name), self.__escape(host), self.__escape(mod))
+      lines.append('viki_span_seconds_sum{{{}}} {:.6f}'.format(labels, seconds))
+      lines.append('viki_span_seconds_count{{{}}} {}'.format(labels, count))
+      maxima.append('viki_span_max_seconds{{{}}} {:.6f}'.format(labels, longest))
+    # A textfile collector may read the file at any time, so it is replaced atomically
+    self.__write_file(file, '\n'.join(lines + maxima) + '\n')
+    return len(series)
+
+  def __escape(self, value:str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+  def __write_file(self, file:str, text:str):
+    tmp = file + '.tmp'
+    with open(tmp, 'w') as fp:
+      fp.write(text)
+    os.replace(tmp, file)
+
+TRACER = Tracer()
@@ -0,0 +1,80 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+
+# Hostnames that run on the current workstation, unless a port other than 22 is set, e.g. an SSH tunnel
+LOCAL_HOSTNAMES = ('localhost', '127.0.0.1', '::1')
+
+def is_local(vars:dict) -> bool:
+  '''
+  Check if the commands of a host run on the current workstation.
+
+  Here is an example of vars, where transport overrides the hostname:
+
+    vars                { "hostname": "localhost" }
+    vars                { "hostname": "web1", "transport": "local" }
+
+  @param vars           The vars of a host.
+  @returns              True for a LocalTransport or False for MySSH.
+  '''
+  if 'transport' in vars and vars['transport'] not in ('', None):
+    return vars['transport'] == 'local'
+  port = int(vars['port']) if 'port' in vars and vars['port'] not in ('', None) else 22
+  return str(vars.get('hostname')) in LOCAL_HOSTNAMES and port == 22
+
+class Transport(ABC):
+  """Runs commands on a host, where run_stream is the only method that runs a command
+  """
+  @abstractmethod
+  def connect(self, hostname:str, username:str, password:str, port:int=22) -> bool:
+    pass
+
+  @abstractmethod
+  def connected(self) -> bool:
+    pass
+
+  @abstractmethod
+  def run_stream(self, cmd:str, sink, input_data:str=None, timeout:int=180, pty:bool=False, stderr_sink=None) -> int:
+    """Runs a command and passes each chunk of bytes of its output to sink as it arrives
+      :param sink: A callable that takes each chunk of bytes
+      :type sink: function
+      :param input_data: Lines written once to stdin, which is then closed, e.g. a sudo password, defaults to None
+      :type input_data: string
+      :param pty: Run the command in a terminal, which only a mod that needs one sets, defaults to False
+      :type pty: bool
+      :param stderr_sink: A callable that takes each chunk of stderr, defaults to None to pass stderr to sink
+      :type stderr_sink: function
+      :returns: The exit status, or -1 when the command did not run
+    """
+    pass
+
+  def alive(self) -> bool:
+    """Returns True if the connection still works, e.g. before the viki daemon shares it again
+    """
+    return self.connected()
+
+  def open_sftp(self):
+    """Opens an SFTP client on the connection, e.g. for each file in flight of FileSync
+      :returns: A paramiko SFTPClient, or None when the transport has no SFTP, e.g. a local host
+    """
+    return None
+
+  def close(self):
+    pass
+
+  def set_verbosity(self, verbose:bool):
+    pass
+
+  def run(self, cmd:str, input_data:str=None, timeout:int=180) -> tuple:
+    """Runs a command and returns a tuple of (status, output)
+    """
+    chunks = []
+    status = self.run_stream(cmd, chunks.append, input_data, timeout)
+    return status, b''.join(chunks).decode('utf-8', errors='replace')
+
+  def run_many(self, commands:list, max_channels:int=8, timeout:int=180) -> list:
+    """Runs a list of (cmd, input_data) pairs at the same time and returns their (status, output) in order
+    """
+    with ThreadPoolExecutor(max_workers=max(1, max_channels)) as pool:
+      futures = [pool.submit(contextvars.copy_context().run, self.run, cmd, input_data, timeout) for cmd, input_data in commands]
+      return [future.result() for future in futures]
@@ -0,0 +1,99 @@
+'''
+Runs the commands of viki on a host, where viki uploads this file once and starts it on one SSH channel.
+
+Each line of stdin is a request, and each line of stdout is a part of an answer, in JSON:
+
+  request       { "id": 1, "cmd": "ls -l /", "input": null, "timeout": 180, "stderr": true }
+  output        { "id": 1, "out": "<base64 bytes>" }
+  stderr        { "id": 1, "err": "<base64 bytes>" }, only when the request sets stderr, else it is in out
+  exit status   { "id": 1, "status": 0 }
+
+The commands run at the same time, each in a thread, and their answers are sent as they arrive. This file
+only uses the standard library of Python 3, as it runs on the host.
+'''
+import base64, json, os, signal, subprocess, sys, threading
+
+VERSION = 1
+BUFSIZE = 65536
+LOCK = threading.Lock()
+PROCS = {}
+
+def send(message):
+  line = (json.dumps(message) + '\n').encode('utf-8')
+  with LOCK:
+    sys.stdout.buffer.write(line)
+    sys.stdout.buffer.flush()
+
+def kill(proc):
+  try:
+    os.killpg(proc.pid, signal.SIGKILL)
+  except OSError:
+    pass
+
+def pump(id, key, fp):
+  fd = fp.fileno()
+  while True:
+    data = os.read(fd, BUFSIZE)
+    if data == b'':
+      break
+    send({'id': id, key: base64.b64encode(data).decode('ascii')})
+  fp.close()
+
+def run(request):
+  id = request['id']
+  input_data = request.get('input')
+  timeout = request.get('timeout') or 180
+  try:
+    # A session of its own, so that a timeout kills the children of the command too
+    proc = subprocess.Popen(['/bin/sh', '-c', request['cmd']], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE if request.get('stderr') else subprocess.STDOUT, start_new_session=True)
+  except OSError as e:
+    send({'id': id, 'out': base64.b64encode(str(e).encode('utf-8')).decode('ascii')})
+    send({'id': id, 'status': -1})
+    return
+  PROCS[id] = proc
+  expired = []
+
+  def expire():
+    expired.append(True)
+    kill(proc)
+
+  timer = threading.Timer(timeout, expire)
+  timer.start()
+  try:
+    if input_data is not None:
+      proc.stdin.write((input_data.replace('\\n', '\n') + '\n').encode('utf-8'))
+    proc.stdin.close()
+  except OSError:
+    pass
+  errors = None
+  if proc.stderr is not None:
+    errors = threading.Thread(target=pump, args=(id, 'err', proc.stderr))
+    errors.daemon = True
+    errors.start()
+  pump(id, 'out', proc.stdout)
+  if errors is not None:
+    errors.join()
+  status = proc.wait()
+  timer.cancel()
+  PROCS.pop(id, None)
+  if expired:
+    message = '\nERROR: timeout after %d seconds\n' % (timeout)
+    send({'id': id, 'out': base64.b64encode(message.encode('utf-8')).decode('ascii')})
+    status = -1
+  send({'id': id, 'status': status})
+
+def main():
+  send({'agent': VERSION, 'pid': os.getpid()})
+  for line in sys.stdin.buffer:
+    if line.strip() == b'':
+      continue
+    thread = threading.Thread(target=run, args=(json.loads(line.decode('utf-8')),))
+    thread.daemon = True
+    thread.start()
+  # viki closed the channel, so the commands that are left are killed
+  for proc in list(PROCS.values()):
+    kill(proc)
+
+if __name__ == '__main__':
+  main()
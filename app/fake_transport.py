@@ -0,0 +1,72 @@
+from common.transport import Transport
+import re, threading, time
+
+BATCH_BEGIN = re.compile(r'(VIKI[0-9a-f]+):begin (\d+)')
+WHICH_LOOP = re.compile(r'^for m in (.*?); do ')
+
+def fake_output(cmd:str, output_size:int=256) -> tuple:
+  '''
+  Answer a command without running it, e.g. for benchmarks and tests.
+
+  Scripts of batch_scripts get a begin and an end line for each command,
+  and the mod loop of check_which gets a path for each mod, so that the
+  responses parse the output as if the commands ran.
+
+  @param cmd            The command.
+  @param output_size    The number of output bytes of each command.
+  @returns              A tuple of (status, output bytes).
+  '''
+  payload = b'x' * max(0, output_size - 1) + b'\n' if output_size > 0 else b''
+  if cmd[:6] == 'sh -c ' and BATCH_BEGIN.search(cmd):
+    chunks = []
+    for match in BATCH_BEGIN.finditer(cmd):
+      marker, idx = match.group(1), match.group(2)
+      chunks.append('{} {}\n'.format(marker + ':begin', idx).encode('utf-8'))
+      chunks.append(payload)
+      chunks.append('\n{} {} 0\n'.format(marker + ':end', idx).encode('utf-8'))
+    return 0, b''.join(chunks)
+  match = WHICH_LOOP.match(cmd)
+  if match is not None:
+    mods = match.group(1).replace("'", '').split()
+    return 0, ''.join('{0} 0 /usr/bin/{0}\n'.format(mod) for mod in mods).encode('utf-8')
+  return 0, payload
+
+class FakeTransport(Transport):
+  def __init__(self, latency:float=0.0, output_size:int=256):
+    """Answers every command with fake_output after a fixed latency, and counts commands and bytes
+      :param latency: The seconds that each command takes, e.g. a round trip, defaults to 0.0
+      :type latency: float
+      :param output_size: The number of output bytes of each command, defaults to 256
+      :type output_size: int
+    """
+    self.latency = latency
+    self.output_size = output_size
+    self.is_connected = False
+    self.commands = 0
+    self.bytes_sent = 0
+    self.bytes_received = 0
+    self.lock = threading.Lock()
+
+  def connect(self, hostname:str=None, username:str=None, password:str=None, port:int=22) -> bool:
+    self.is_connected = True
+    return True
+
+  def connected(self) -> bool:
+    return self.is_connected
+
+  def close(self):
+    self.is_connected = False
+
+  def run_stream(self, cmd:str, sink, input_data:str=None, timeout:int=180, pty:bool=False, stderr_sink=None) -> int:
+    if not self.is_connected:
+      sink(b'ERROR: connection not established\n')
+      return -1
+    if self.latency > 0:
+      time.sleep(self.latency)
+    status, output = fake_output(cmd, self.output_size)
+    with self.lock:
+      self.commands += 1
+      self.bytes_sent += len(cmd.encode('utf-8')) + (len(input_data) if input_data is not None else 0)
+      self.bytes_received += len(output)
+    sink(output)
+    return status
@@ -0,0 +1,86 @@
+from fake_transport import fake_output
+import paramiko, socket, threading, time
+
+class StandInHandler(paramiko.ServerInterface):
+  def __init__(self, server):
+    self.server = server
+
+  def get_allowed_auths(self, username):
+    return 'password'
+
+  def check_auth_password(self, username, password):
+    return paramiko.AUTH_SUCCESSFUL
+
+  def check_channel_request(self, kind, chanid):
+    return paramiko.OPEN_SUCCEEDED
+
+  def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+    return True
+
+  def check_channel_exec_request(self, channel, command):
+    threading.Thread(target=self.server.answer, args=(channel, command.decode('utf-8')), daemon=True).start()
+    return True
+
+class StandInServer():
+  def __init__(self, latency:float=0.0, output_size:int=256, host:str='127.0.0.1'):
+    """A local SSH server that answers each command with fake_output instead of running it, e.g. for benchmarks
+      :param latency: The seconds that each command takes, defaults to 0.0
+      :type latency: float
+      :param output_size: The number of output bytes of each command, defaults to 256
+      :type output_size: int
+    """
+    self.latency = latency
+    self.output_size = output_size
+    self.key = paramiko.RSAKey.generate(2048)
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.sock.bind((host, 0))
+    self.host = host
+    self.port = self.sock.getsockname()[1]
+    self.commands = 0
+    self.bytes_sent = 0
+    self.bytes_received = 0
+    self.lock = threading.Lock()
+    self.transports = []
+
+  def start(self):
+    self.sock.listen(16)
+    threading.Thread(target=self.__accept, daemon=True).start()
+    return self
+
+  def stop(self):
+    self.sock.close()
+    for transport in self.transports:
+      transport.close()
+
+  def __accept(self):
+    while True:
+      try:
+        client, _ = self.sock.accept()
+      except OSError:
+        return
+      client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      transport = paramiko.Transport(client)
+      transport.add_server_key(self.key)
+      transport.start_server(server=StandInHandler(self))
+      self.transports.append(transport)
+
+  def answer(self, channel, command:str):
+    """Counts bytes from the point of view of the client, where sent is the command and received is the output
+    """
+    if self.latency > 0:
+      time.sleep(self.latency)
+    status, output = fake_output(command, self.output_size)
+    with self.lock:
+      self.commands += 1
+      self.bytes_sent += len(command.encode('utf-8'))
+      self.bytes_received += len(output)
+    try:
+      channel.sendall(output)
+      channel.send_exit_status(status)
+      # Only EOF, as the exec request is answered after check_channel_exec_request returns, and a channel
+      # that is closed before the answer fails on the client, which closes the channel when it is done
+      channel.shutdown_write()
+    except (OSError, EOFError):
+      # The client timed out and closed the channel before the answer
+      pass
@@ -0,0 +1,13 @@
+from common.logger import Logger
+import pytest
+
+@pytest.fixture
+def logger():
+  return Logger('test')
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path_factory, monkeypatch):
+  # The config cache of each test stays out of the cache of the user
+  path = tmp_path_factory.mktemp('cache')
+  monkeypatch.setenv('XDG_CACHE_HOME', str(path))
+  return path
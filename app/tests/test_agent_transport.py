@@ -0,0 +1,136 @@
+from common.agent_transport import AgentTransport
+from common.local_transport import LocalTransport
+from common.remote_script import SCRIPT_MISSING
+import io, os, subprocess, sys, time
+
+AGENT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common', 'viki_agent.py')
+# An agent that answers the first request with a line that is not JSON, and then hangs
+GARBLED = '''import json, sys, time
+print(json.dumps({"agent": 1}), flush=True)
+sys.stdin.readline()
+print('{"id": 1, "out": ', flush=True)
+time.sleep(30)
+'''
+
+class Session():
+  def __init__(self, ssh):
+    """A channel that runs the agent in a local process instead of on a host
+    """
+    self.ssh = ssh
+    self.proc = None
+    self.status = 0
+
+  def exec_command(self, cmd:str):
+    if cmd.startswith('mkdir'):
+      self.ssh.uploaded = True
+      return
+    if not self.ssh.uploaded:
+      self.status = SCRIPT_MISSING
+      return
+    self.proc = subprocess.Popen(self.ssh.argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+  def settimeout(self, timeout):
+    pass
+
+  def makefile(self, mode:str, bufsize:int):
+    return self.proc.stdout if self.proc is not None else io.BytesIO()
+
+  def sendall(self, data:bytes):
+    if self.proc is None:
+      return
+    self.proc.stdin.write(data)
+    self.proc.stdin.flush()
+
+  def shutdown_write(self):
+    pass
+
+  def recv_exit_status(self) -> int:
+    return self.status
+
+  def close(self):
+    if self.proc is not None:
+      self.proc.kill()
+      self.proc.wait()
+
+class AgentSSH(LocalTransport):
+  def __init__(self, argv:list, uploaded:bool=True):
+    """A connected LocalTransport whose sessions run the agent, and which runs the commands that fall back to sessions
+    """
+    super().__init__()
+    self.connect()
+    self.argv = argv
+    self.uploaded = uploaded
+    self.transport = self
+    self.sessions = []
+
+  def open_session(self):
+    self.sessions.append(Session(self))
+    return self.sessions[-1]
+
+  def alive(self) -> bool:
+    return True
+
+def test_commands_run_on_the_agent():
+  transport = AgentTransport(AgentSSH([sys.executable, '-u', AGENT]))
+  try:
+    assert transport.start()
+    assert transport.run('echo a; exit 2') == (2, 'a\n')
+    out = []
+    err = []
+    assert transport.run_stream('echo out; echo err >&2', out.append, stderr_sink=err.append) == 0
+    assert (b''.join(out), b''.join(err)) == (b'out\n', b'err\n')
+    assert transport.run('read a; echo $a', input_data='secret') == (0, 'secret\n')
+    # Each command runs on the one channel of the agent
+    assert len(transport.ssh.sessions) == 1
+  finally:
+    transport.close()
+
+def test_the_agent_is_uploaded_when_it_is_missing():
+  transport = AgentTransport(AgentSSH([sys.executable, '-u', AGENT], uploaded=False))
+  try:
+    assert transport.start()
+    assert transport.ssh.uploaded
+    assert transport.run('echo a') == (0, 'a\n')
+  finally:
+    transport.close()
+
+def test_a_pty_command_runs_in_a_session():
+  ssh = AgentSSH([sys.executable, '-u', AGENT])
+  transport = AgentTransport(ssh)
+  try:
+    assert transport.start()
+    chunks = []
+    assert transport.run_stream('echo a', chunks.append, pty=True) == 0
+    assert chunks == [b'a\n']
+  finally:
+    transport.close()
+
+def test_an_answer_that_is_not_valid_fails_the_calls_and_drops_the_agent():
+  transport = AgentTransport(AgentSSH([sys.executable, '-u', '-c', GARBLED]))
+  try:
+    assert transport.start()
+    assert transport.alive()
+    start = time.monotonic()
+    status, output = transport.run('echo a', timeout=60)
+    assert status == -1
+    assert 'ERROR: agent answer not valid' in output
+    # The call fails as the answer arrives, not after its timeout
+    assert time.monotonic() - start < 10
+    assert not transport.alive()
+    assert 'not valid' in transport.reason
+    # The next commands run in sessions
+    assert transport.run('echo b') == (0, 'b\n')
+  finally:
+    transport.close()
+
+def test_the_calls_fail_when_the_agent_exits():
+  transport = AgentTransport(AgentSSH([sys.executable, '-u', AGENT]))
+  try:
+    assert transport.start()
+    status, output = transport.run('kill $PPID; sleep 30', timeout=60)
+    assert status == -1
+    assert 'ERROR: agent exited' in output
+    assert transport.alive()
+    assert transport.run('echo b') == (0, 'b\n')
+  finally:
+    transport.close()
@@ -0,0 +1,106 @@
+from common.base_response import BaseResponse
+from common.batch_script import batch_marker, batch_results, batch_scripts
+from common.local_transport import LocalTransport
+from common.ssh_command import sudo_command
+import os, time
+
+MARKER = 'VIKI0123abcd'
+
+class CountingTransport(LocalTransport):
+  def __init__(self):
+    """A connected LocalTransport that counts the round trips
+    """
+    super().__init__()
+    self.connect()
+    self.commands = []
+
+  def run_stream(self, cmd:str, sink, *args, **kwargs) -> int:
+    self.commands.append(cmd)
+    return super().run_stream(cmd, sink, *args, **kwargs)
+
+def run_batch(commands:list, timeout:int=None, input_data:str=None) -> list:
+  ssh = CountingTransport()
+  results = []
+  for exec, indices in batch_scripts(commands, MARKER, timeout=timeout):
+    status, output = ssh.run(exec, input_data)
+    results.extend(batch_results(output, MARKER, indices))
+  return results
+
+def test_batch_marker_is_random():
+  assert batch_marker() != batch_marker()
+  assert batch_marker().startswith('VIKI')
+
+def test_batch_results_keep_the_status_of_each_command():
+  output = ('{0}:begin 0\na\n{0}:end 0 0\n'
+    '{0}:begin 1\nline 1\nline 2\n{0}:end 1 3\n'
+    '{0}:begin 2\n\n{0}:end 2 0\n').format(MARKER)
+  assert batch_results(output, MARKER, [0, 1, 2]) == [(0, 'a'), (3, 'line 1\nline 2'), (0, '')]
+
+def test_batch_results_of_a_command_that_did_not_finish():
+  output = '{0}:begin 0\na\n{0}:end 0 0\n{0}:begin 1\npartial'.format(MARKER)
+  results = batch_results(output, MARKER, [0, 1])
+  assert results[0] == (0, 'a')
+  assert results[1][0] == -1
+
+def test_batch_scripts_split_at_the_limit():
+  commands = ['echo {}'.format(idx) for idx in range(10)]
+  scripts = batch_scripts(commands, MARKER, limit=200)
+  assert len(scripts) > 1
+  assert [idx for exec, indices in scripts for idx in indices] == list(range(10))
+
+def test_a_failing_middle_command_does_not_stop_the_script():
+  results = run_batch(['echo one', 'echo two; exit 3', "echo 'three'"])
+  assert results == [(0, 'one\n'), (3, 'two\n'), (0, 'three\n')]
+
+def test_batch_reads_the_sudo_password_once(tmp_path, monkeypatch):
+  # A stand-in for sudo that prints the password that it reads from stdin
+  sudo = tmp_path / 'sudo'
+  sudo.write_text('#!/bin/sh\ncat\n')
+  sudo.chmod(0o755)
+  monkeypatch.setenv('PATH', '{}:{}'.format(tmp_path, os.environ['PATH']))
+  commands = [sudo_command('sudo ls', 'secret'), 'echo plain', sudo_command('true || sudo ls', 'secret') + '; sudo ls']
+  results = run_batch(commands, input_data='secret')
+  assert results == [(0, 'secret\n'), (0, 'plain\n'), (0, 'secret\n')]
+
+def test_run_commands_batches_in_one_round_trip(logger):
+  response = BaseResponse(logger)
+  response.ssh = CountingTransport()
+  response.batch = True
+  results = response.run_commands(['echo a', 'false', 'echo c'])
+  assert len(response.ssh.commands) == 1
+  assert results == [(0, 'a\n'), (1, ''), (0, 'c\n')]
+
+# The hung commands sleep for HUNG seconds and time out after 1, so a margin of half of HUNG tells them
+# apart on a slow host, and quick commands get a timeout that they cannot reach
+HUNG = 60
+
+def test_a_hung_command_is_killed_after_the_timeout():
+  start = time.perf_counter()
+  results = run_batch(['sleep {}'.format(HUNG), 'echo after'], timeout=1)
+  assert time.perf_counter() - start < HUNG / 2
+  assert results[0][0] != 0
+  assert 'ERROR: timeout after 1 seconds' in results[0][1]
+  assert results[1] == (0, 'after\n')
+
+def test_a_killed_command_does_not_run_its_next_step():
+  results = run_batch(['sleep {}; echo leaked'.format(HUNG), 'echo after'], timeout=1)
+  assert not 'leaked' in results[0][1]
+  assert results[1] == (0, 'after\n')
+
+def test_quick_commands_do_not_wait_for_their_watchdog():
+  start = time.perf_counter()
+  results = run_batch(['echo {}'.format(idx) for idx in range(50)], timeout=HUNG)
+  assert results == [(0, '{}\n'.format(idx)) for idx in range(50)]
+  # Each watchdog is killed when its command ends, or the script would take HUNG seconds
+  assert time.perf_counter() - start < HUNG / 2
+
+def test_run_commands_batches_with_the_timeout_of_the_response(logger):
+  response = BaseResponse(logger)
+  response.ssh = LocalTransport()
+  response.ssh.connect()
+  response.batch = True
+  response.timeout = 1
+  start = time.perf_counter()
+  results = response.run_commands(['echo a', 'sleep {}'.format(HUNG), 'echo c'])
+  assert time.perf_counter() - start < HUNG / 2
+  assert [status for status, output in results] == [0, 143, 0]
@@ -0,0 +1,43 @@
+from benchmark import compare, run_size
+from fake_transport import FakeTransport, fake_output
+import argparse
+
+def bench_args(**kwargs) -> argparse.Namespace:
+  args = {'transport': 'fake', 'latency': 0.0, 'output_size': 16, 'channels': 1, 'batch': False, 'tail': 64}
+  args.update(kwargs)
+  return argparse.Namespace(**args)
+
+def test_fake_output_answers_each_command_of_a_batch_script():
+  script = "sh -c 'echo VIKIab12:begin 0; ls; echo VIKIab12:end 0 $?; echo VIKIab12:begin 1; df'"
+  status, output = fake_output(script, output_size=4)
+  assert status == 0
+  assert output.count(b'VIKIab12:begin') == 2
+  assert b'VIKIab12:end 1 0\n' in output
+
+def test_fake_transport_refuses_commands_before_connect():
+  transport = FakeTransport()
+  output = []
+  assert transport.run_stream('ls', output.append) == -1
+  transport.connect()
+  assert transport.run_stream('ls', output.append) == 0
+  assert transport.commands == 1
+
+def test_run_size_measures_every_phase():
+  rows = run_size(bench_args(), 10)
+  assert [row['phase'] for row in rows] == ['fetch', 'plan', 'apply', 'replan']
+  assert rows[2]['commands'] == 10
+  # Nothing changed, so the plan only checks that the mods exist
+  assert rows[3]['commands'] == 1
+
+def test_run_size_batches_apply_into_one_script():
+  rows = run_size(bench_args(batch=True), 10)
+  # mkdir.r5 depends on mkdir.r0, so apply runs two levels of one script each
+  assert rows[2]['commands'] == 2
+
+def test_compare_reports_slower_phases_only():
+  meta = {'transport': 'fake'}
+  baseline = {'meta': meta, 'results': [{'size': 10, 'phase': 'plan', 'wall': 1.0}, {'size': 10, 'phase': 'apply', 'wall': 1.0}]}
+  results = {'meta': meta, 'results': [{'size': 10, 'phase': 'plan', 'wall': 1.5}, {'size': 10, 'phase': 'apply', 'wall': 1.1}]}
+  regressions = compare(results, baseline, 0.2)
+  assert len(regressions) == 1
+  assert regressions[0].startswith('plan 10')
@@ -0,0 +1,53 @@
+from common.blob_store import BlobStore
+import hashlib, os, time
+
+def age(file:str, seconds:int):
+  past = time.time() - seconds
+  os.utime(file, (past, past))
+
+def test_identical_outputs_are_stored_once(logger, tmp_path):
+  blobs = BlobStore(logger, str(tmp_path))
+  digest = blobs.put(b'output')
+  assert digest == hashlib.sha256(b'output').hexdigest()
+  assert blobs.put(b'output') == digest
+  assert os.listdir(os.path.dirname(blobs.file(digest))) == [digest]
+  assert blobs.get(digest) == b'output'
+
+def test_put_file_streams_a_log_file(logger, tmp_path):
+  blobs = BlobStore(logger, str(tmp_path))
+  log = tmp_path / 'a.log'
+  log.write_bytes(b'x' * 200000)
+  digest = blobs.put_file(str(log), hashlib.sha256(b'x' * 200000).hexdigest())
+  assert blobs.get(digest) == b'x' * 200000
+  # Compressed with zlib
+  assert os.path.getsize(blobs.file(digest)) < 2000
+
+def test_gc_removes_old_unreferenced_blobs(logger, tmp_path):
+  blobs = BlobStore(logger, str(tmp_path))
+  keep, old, new = blobs.put(b'keep'), blobs.put(b'old'), blobs.put(b'new')
+  age(blobs.file(keep), 7200)
+  age(blobs.file(old), 7200)
+  count, size = blobs.gc({keep})
+  assert count == 1 and size > 0
+  assert blobs.has(keep) and not blobs.has(old)
+  # A blob of an apply that runs at the same time, which its state does not reference yet
+  assert blobs.has(new)
+
+def test_gc_skips_temp_files_of_a_running_write(logger, tmp_path):
+  blobs = BlobStore(logger, str(tmp_path))
+  digest = hashlib.sha256(b'partial').hexdigest()
+  os.makedirs(os.path.dirname(blobs.file(digest)))
+  running = blobs.file(digest) + '.1.2.tmp'
+  crashed = blobs.file(digest) + '.3.4.tmp'
+  open(running, 'wb').close()
+  open(crashed, 'wb').close()
+  age(crashed, 7200)
+  assert blobs.gc(set())[0] == 1
+  assert os.path.exists(running) and not os.path.exists(crashed)
+
+def test_gc_with_a_grace_of_zero_removes_every_unreferenced_blob(logger, tmp_path):
+  blobs = BlobStore(logger, str(tmp_path))
+  blobs.put(b'a')
+  blobs.put(b'b')
+  assert blobs.gc(set(), grace=0)[0] == 2
+  assert blobs.gc(set(), grace=0) == (0, 0)
@@ -0,0 +1,50 @@
+from common import block_delta
+from common.block_delta import delta, parse_signature, patch, signature
+import hashlib, io, pytest, random
+
+def round_trip(old:bytes, new:bytes, size:int) -> int:
+  ops = io.BytesIO()
+  size, length, blocks = parse_signature(signature(io.BytesIO(old), size))
+  sent = delta(io.BytesIO(new), size, length, blocks, ops.write)
+  ops.seek(0)
+  assert ops.read(4) == size.to_bytes(4, 'big')
+  out = io.BytesIO()
+  assert patch(io.BytesIO(old), ops, out, size) == hashlib.sha256(new).hexdigest()
+  assert out.getvalue() == new
+  return sent
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+  # Small literals and chunks, so that a file of a few blocks is read in many chunks
+  monkeypatch.setattr(block_delta, 'LITERAL_LIMIT', 3000)
+
+@pytest.fixture
+def old():
+  return random.Random(1).randbytes(40000)
+
+def test_an_unchanged_file_sends_no_literal(old):
+  assert round_trip(old, old, 1024) == 0
+
+def test_an_edit_sends_about_the_changed_blocks(old):
+  new = old[:10000] + b'inserted' + old[10000:25000] + old[26000:]
+  assert round_trip(old, new, 1024) < 3 * 1024
+
+def test_the_short_last_block_matches_the_end(old):
+  old = old[:10500]
+  assert round_trip(old, b'head' + old, 1024) == 4
+
+def test_a_new_file_is_sent_in_literals_of_the_limit(old):
+  new = random.Random(2).randbytes(10000)
+  ops = []
+  size, length, blocks = parse_signature(signature(io.BytesIO(old), 1024))
+  assert delta(io.BytesIO(new), size, length, blocks, ops.append) == len(new)
+  assert max(len(op) for op in ops) <= 3000 + 5
+  assert round_trip(old, new, 1024) == len(new)
+
+def test_empty_files():
+  assert round_trip(b'', b'abc', 2048) == 3
+  assert round_trip(b'abc', b'', 2048) == 0
+
+def test_a_truncated_signature_is_rejected(old):
+  with pytest.raises(ValueError):
+    parse_signature(signature(io.BytesIO(old), 1024)[:-1])
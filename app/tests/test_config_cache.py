@@ -0,0 +1,63 @@
+from common.cli_request import CliRequest, config_cache_file
+import json, os, pytest
+
+CONFIG = '''viki:
+  vars:
+    hostname: web
+  mods:
+    mkdir:
+      a:
+        path: /srv/a
+'''
+
+def test_cache_is_json_outside_the_config_path(logger, tmp_path, cache_home):
+  (tmp_path / 'a.vk.yaml').write_text(CONFIG)
+  CliRequest(logger, path=str(tmp_path))
+  file = config_cache_file(str(tmp_path))
+  assert file.startswith(str(cache_home))
+  assert sorted(os.listdir(tmp_path)) == ['a.vk.yaml']
+  with open(file) as fp:
+    assert json.load(fp)['merged']['mods'] == {'mkdir': {'a': {'path': '/srv/a'}}}
+
+def test_cache_files_differ_by_config_path(tmp_path):
+  assert config_cache_file(str(tmp_path / 'a')) != config_cache_file(str(tmp_path / 'b'))
+
+def test_unchanged_files_are_not_parsed_again(logger, tmp_path, monkeypatch):
+  (tmp_path / 'a.vk.yaml').write_text(CONFIG)
+  CliRequest(logger, path=str(tmp_path))
+
+  def load_yaml(file):
+    raise AssertionError('{} parsed again'.format(file))
+
+  monkeypatch.setattr('common.cli_request.load_yaml', load_yaml)
+  assert CliRequest(logger, path=str(tmp_path)).mods == {'mkdir': {'a': {'path': '/srv/a'}}}
+
+def test_a_changed_file_is_parsed_again(logger, tmp_path):
+  file = tmp_path / 'a.vk.yaml'
+  file.write_text(CONFIG)
+  CliRequest(logger, path=str(tmp_path))
+  file.write_text(CONFIG.replace('/srv/a', '/srv/changed'))
+  os.utime(file, ns=(1, 1))
+  assert CliRequest(logger, path=str(tmp_path)).mods['mkdir']['a']['path'] == '/srv/changed'
+
+def test_a_broken_or_foreign_cache_is_rebuilt(logger, tmp_path):
+  (tmp_path / 'a.vk.yaml').write_text(CONFIG)
+  file = config_cache_file(str(tmp_path))
+  os.makedirs(os.path.dirname(file))
+  for data in [b'\x80\x04\x95 not json', b'{"version": 2, "files": {"x": 1}}', b'[1, 2]']:
+    with open(file, 'wb') as fp:
+      fp.write(data)
+    assert CliRequest(logger, path=str(tmp_path)).mods == {'mkdir': {'a': {'path': '/srv/a'}}}
+
+def test_values_that_json_changes_are_not_cached(logger, tmp_path):
+  (tmp_path / 'a.vk.yaml').write_text(CONFIG + '  data:\n    docker:\n      ports:\n        80: http\n')
+  request = CliRequest(logger, path=str(tmp_path))
+  assert request.data == {'docker': {'ports': {80: 'http'}}}
+  assert not os.path.exists(config_cache_file(str(tmp_path)))
+  assert CliRequest(logger, path=str(tmp_path)).data == {'docker': {'ports': {80: 'http'}}}
+
+def test_duplicate_keys_across_files_are_an_error(logger, tmp_path):
+  (tmp_path / 'a.vk.yaml').write_text(CONFIG)
+  (tmp_path / 'b.vk.yaml').write_text(CONFIG)
+  with pytest.raises(Exception, match='Duplicate key hostname'):
+    CliRequest(logger, path=str(tmp_path))
@@ -0,0 +1,70 @@
+from common.daemon import DaemonHandler, DaemonServer, TransportPool
+from common.daemon_transport import DaemonTransport
+from stand_in_server import StandInServer
+import os, pytest, shutil, socket, tempfile, threading, time
+
+@pytest.fixture(scope='module')
+def server():
+  server = StandInServer(output_size=64).start()
+  yield server
+  server.stop()
+
+@pytest.fixture
+def daemon(logger):
+  # A Unix socket path is short, so it is not in tmp_path
+  folder = tempfile.mkdtemp(prefix='viki')
+  path = os.path.join(folder, 'daemon.sock')
+  daemon = DaemonServer(path, DaemonHandler)
+  daemon.pool = TransportPool(logger, idle=0)
+  thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+  thread.start()
+  yield daemon
+  daemon.shutdown()
+  daemon.server_close()
+  daemon.pool.close()
+  shutil.rmtree(folder)
+
+def released(pool) -> list:
+  # The daemon releases a connection after it sends the status, i.e. just after the run returns
+  deadline = time.monotonic() + 5
+  while any(entry['users'] > 0 for entry in pool.status()) and time.monotonic() < deadline:
+    time.sleep(0.01)
+  return pool.status()
+
+def test_runs_share_one_connection(server, daemon):
+  connections = len(server.transports)
+  transports = [DaemonTransport(daemon.server_address) for idx in range(3)]
+  for transport in transports:
+    assert transport.reachable()
+    assert transport.connect(server.host, 'test', 'test', port=server.port)
+  for transport in transports:
+    assert transport.run('uname -a') == (0, 'x' * 63 + '\n')
+  assert len(server.transports) == connections + 1
+  released(daemon.pool)
+  status = transports[0].status()
+  assert [(entry['username'], entry['connected'], entry['users'], entry['commands']) for entry in status] == [('test', True, 0, 6)]
+
+def test_a_changed_password_does_not_reuse_a_connection(server, daemon):
+  for password in ('a', 'b'):
+    assert DaemonTransport(daemon.server_address).connect(server.host, 'test', password, port=server.port)
+  assert len(daemon.pool.status()) == 2
+
+def test_idle_connections_are_evicted(server, daemon):
+  assert DaemonTransport(daemon.server_address).connect(server.host, 'test', 'test', port=server.port)
+  released(daemon.pool)
+  assert daemon.pool.evict() == 1
+  assert daemon.pool.status() == []
+
+def test_a_failed_connection_is_reported(daemon):
+  with socket.socket() as sock:
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+  transport = DaemonTransport(daemon.server_address)
+  assert not transport.connect('127.0.0.1', 'test', 'test', port=port)
+  assert transport.run('uname -a')[0] == -1
+
+def test_a_daemon_that_is_not_running(tmp_path):
+  transport = DaemonTransport(str(tmp_path / 'none.sock'))
+  assert not transport.reachable()
+  assert not transport.connect('127.0.0.1', 'test', 'test')
+  assert transport.status() == []
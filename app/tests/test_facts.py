@@ -0,0 +1,73 @@
+from common.base_response import BaseResponse
+from common.facts import Facts
+from common.cli_request import facts_cache_file
+import json, shlex, sys, time, viki
+
+class WhichSSH():
+  def __init__(self):
+    """Answers the which probe of check_which in place of a host, where every mod is installed in /usr/bin
+    """
+    self.commands = 0
+
+  def run(self, cmd:str, input_data:str=None, timeout:int=180) -> tuple:
+    self.commands += 1
+    mods = shlex.split(cmd[len('for m in '):cmd.index(';')])
+    return 0, ''.join('{0} 0 /usr/bin/{0}\n'.format(mod) for mod in mods)
+
+def which_response(logger) -> BaseResponse:
+  response = BaseResponse(logger)
+  response.ssh = WhichSSH()
+  return response
+
+def test_check_which_probes_every_mod_in_one_command(logger):
+  response = which_response(logger)
+  facts = Facts({})
+  response.check_which({'mkdir': {}, 'wget': {}, 'compose': {}}, facts)
+  assert response.ssh.commands == 1
+  assert facts.get('which', 'wget')['output'] == '/usr/bin/wget'
+  assert facts.changed
+
+def test_check_which_only_probes_stale_mods(logger):
+  response = which_response(logger)
+  cached = {'which': {'mkdir': {'status': 0, 'output': '/bin/mkdir', 'updated': time.time()}}}
+  facts = Facts(cached)
+  response.check_which({'mkdir': {}}, facts)
+  assert response.ssh.commands == 0
+  response.check_which({'mkdir': {}, 'wget': {}}, facts)
+  assert response.ssh.commands == 1
+  assert sorted(cached['which'].keys()) == ['mkdir', 'wget']
+
+def test_stale_facts_by_ttl_and_refresh():
+  facts = {'which': {'old': {'updated': time.time() - 7200}, 'new': {'updated': time.time()}}}
+  assert Facts(facts, ttl=3600).stale('which', ['old', 'new', 'missing']) == ['old', 'missing']
+  assert Facts(facts, refresh=True).stale('which', ['old', 'new']) == ['old', 'new']
+
+def test_a_missing_mod_is_logged(logger, caplog):
+  response = which_response(logger)
+  facts = Facts({'which': {'nope': {'status': 1, 'output': '', 'updated': time.time()}}})
+  response.check_which({'nope': {}}, facts)
+  assert 'mod nope returned status code 1.' in caplog.text
+
+CONFIG = '''viki:
+  vars:
+    hostname: localhost
+  mods:
+    mkdir:
+      a:
+        path: {}
+'''
+
+def test_plan_keeps_facts_out_of_the_state(tmp_path, monkeypatch):
+  (tmp_path / 'a.vk.yaml').write_text(CONFIG.format(tmp_path / 'a'))
+  # A state of an earlier version, which plan must not migrate
+  legacy = {'viki': {'data': {}, 'mods': {}, 'facts': {'which': {'wget': {'status': 0, 'output': '/bin/wget', 'updated': time.time()}}}}}
+  (tmp_path / 'state.vk.json').write_text(json.dumps(legacy))
+  for argv in (['plan', '--offline'], ['plan']):
+    monkeypatch.setattr(sys, 'argv', ['viki', '-p', str(tmp_path)] + argv)
+    viki.main()
+  assert sorted(path.name for path in tmp_path.iterdir()) == ['a.vk.yaml', 'state.vk.json']
+  assert json.loads((tmp_path / 'state.vk.json').read_text()) == legacy
+  # The second plan probed mkdir, and keeps it with the facts of the state in the cache
+  with open(facts_cache_file(str(tmp_path / 'state.vk.json'))) as fp:
+    facts = json.load(fp)['facts']
+  assert sorted(facts['which']) == ['mkdir', 'wget']
@@ -0,0 +1,78 @@
+from common.apply_response import ApplyResponse
+from common.file_sync import FileSync, leaf_dirs
+from common.local_transport import LocalTransport
+from common.ssh_command import MODS_TEMPLATE
+import os, pytest
+
+@pytest.fixture
+def ssh():
+  ssh = LocalTransport()
+  ssh.connect()
+  return ssh
+
+def make_files(root, names:list):
+  for name in names:
+    path = root / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(name)
+
+def test_scan_lists_the_files_of_a_folder(tmp_path, logger):
+  make_files(tmp_path / 'src', ['a', 'b/c'])
+  files = FileSync(logger, None).scan(str(tmp_path / 'src'))
+  assert list(files) == ['a', 'b/c']
+  assert files['b/c'][0] == 3
+
+def test_scan_keeps_the_digest_of_an_unchanged_file(tmp_path, logger):
+  make_files(tmp_path / 'src', ['a'])
+  sync = FileSync(logger, None)
+  files = sync.scan(str(tmp_path / 'src'))
+  previous = {'a': files['a'][:2] + ['digest', files['a'][3]]}
+  assert sync.scan(str(tmp_path / 'src'), previous)['a'][2] == 'digest'
+
+def test_leaf_dirs_are_deepest_first():
+  assert leaf_dirs(['a', 'b/c', 'b/d/e', 'f/g']) == ['b/d', 'b', 'f']
+
+def test_remove_deletes_only_the_synced_files(tmp_path, ssh, logger):
+  dest = tmp_path / 'dest'
+  make_files(dest, ['a', 'b/c', 'b/d/e', 'f/g', 'keep', 'f/keep'])
+  param = {'dest': str(dest), 'files': {'a': [], 'b/c': [], 'b/d/e': [], 'f/g': []}}
+  assert FileSync(logger, ssh).remove([('sync.a', param)]) == [(0, '4 files deleted.')]
+  assert sorted(os.listdir(dest)) == ['f', 'keep']
+  assert os.listdir(dest / 'f') == ['keep']
+  # The remove command keeps dest, which still has files that are not synced
+  assert ssh.run(MODS_TEMPLATE['sync']['remove'].render(param))[0] == 0
+  assert dest.exists()
+
+def test_remove_fails_when_a_file_is_left(tmp_path, ssh, logger):
+  dest = tmp_path / 'dest'
+  make_files(dest, ['a', 'b/c'])
+  # A folder in place of a synced file is not deleted by rm -f
+  param = {'dest': str(dest), 'files': {'a': [], 'b': []}}
+  status, message = FileSync(logger, ssh).remove([('sync.a', param)])[0]
+  assert status == 1
+  assert message == '1 files not deleted, b'
+
+def test_destroy_removes_dest_left_empty(tmp_path, ssh, logger):
+  dest = tmp_path / 'dest'
+  make_files(dest, ['a', 'b/c'])
+  other = tmp_path / 'other'
+  make_files(other, ['a', 'b'])
+  state = {'sync': {
+    'a': {'src': 'files', 'dest': str(dest), 'files': {'a': [], 'b/c': []}},
+    # A synced file that is already gone from the host
+    'b': {'src': 'files', 'dest': str(other), 'files': {'a': [], 'b': [], 'c': []}}
+  }}
+  response = ApplyResponse(logger, ssh, {}, {'sync': {'a': 0, 'b': 0}}, state, {})
+  assert response.apply_remove() == set()
+  assert not dest.exists()
+  assert not other.exists()
+  assert response.state['sync'] == {}
+
+def test_destroy_keeps_the_state_of_files_that_are_left(tmp_path, ssh, logger):
+  dest = tmp_path / 'dest'
+  make_files(dest, ['a/b'])
+  state = {'sync': {'a': {'src': 'files', 'dest': str(dest), 'files': {'a': []}}}}
+  response = ApplyResponse(logger, ssh, {}, {'sync': {'a': 0}}, state, {})
+  assert response.apply_remove() == {('sync', 'a')}
+  assert 'a' in response.state['sync']
+  assert (dest / 'a' / 'b').exists()
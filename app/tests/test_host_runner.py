@@ -0,0 +1,121 @@
+from common.cli import Cli
+from common.cli_request import CliRequest
+from common.host_runner import HostRunner
+from fake_transport import FakeTransport
+import os, pytest, sys, threading, viki
+
+CONFIG = '''viki:
+  vars:
+    hostname: web
+    username: admin
+    password: secret
+  mods:
+    mkdir:
+      good:
+        path: /srv/good
+      bad:
+        path: /srv/bad
+      child:
+        path: /srv/bad/child
+        depends_on: mkdir.bad
+'''
+
+class FailingTransport(FakeTransport):
+  def run_stream(self, cmd:str, sink, input_data:str=None, timeout:int=180, pty:bool=False, stderr_sink=None) -> int:
+    if '/srv/bad' in cmd:
+      sink(b'mkdir: permission denied\n')
+      return 1
+    return super().run_stream(cmd, sink, input_data, timeout, pty, stderr_sink)
+
+def host_runner(logger, path:str, argv:list) -> HostRunner:
+  args = Cli(app='viki', desc='').parser.parse_args(['-p', path] + argv)
+  request = CliRequest(logger, path=path)
+  runner = HostRunner(logger, request, None, request.vars, args)
+  runner.ssh = FailingTransport()
+  runner.ssh.connect()
+  return runner
+
+def test_apply_counts_only_the_resources_that_applied(logger, tmp_path):
+  (tmp_path / 'a.vk.yaml').write_text(CONFIG)
+  runner = host_runner(logger, str(tmp_path), ['apply'])
+  runner.run_plan()
+  assert runner.summary == 'Plan 3 to add, 0 to update, 0 to replace, 0 to destroy.'
+  runner.run_apply()
+  assert runner.failed
+  # child is skipped as bad failed
+  assert runner.summary == 'Apply failed! 1 added, 0 updated, 0 replaced, 0 destroyed, 2 failed.'
+  assert list(runner.state['viki']['mods']['mkdir'].keys()) == ['good']
+
+def test_apply_without_failures_completes(logger, tmp_path):
+  (tmp_path / 'a.vk.yaml').write_text(CONFIG.split('      bad:')[0])
+  runner = host_runner(logger, str(tmp_path), ['apply'])
+  runner.run_plan()
+  runner.run_apply()
+  assert not runner.failed
+  assert runner.summary == 'Apply complete! 1 added, 0 updated, 0 replaced, 0 destroyed.'
+
+def test_missing_credentials_fail_only_their_host(tmp_path, monkeypatch):
+  (tmp_path / 'a.vk.yaml').write_text('''viki:
+  hosts:
+    local:
+      transport: local
+    web:
+      hostname: web
+''')
+  monkeypatch.setattr(sys, 'argv', ['viki', '-p', str(tmp_path), 'refresh'])
+  with pytest.raises(SystemExit) as e:
+    viki.main()
+  assert e.value.code == 1
+  # The local host still ran and wrote its state
+  assert os.path.isdir(tmp_path / 'state.local.vk.d')
+  assert not os.path.exists(tmp_path / 'state.web.vk.d')
+
+class MeetingTransport(FakeTransport):
+  def __init__(self, parties:int):
+    """Holds each mkdir until parties of them run at the same time, which fails when they run one at a time
+    """
+    super().__init__()
+    self.barrier = threading.Barrier(parties, timeout=30)
+
+  def run_stream(self, cmd:str, sink, input_data:str=None, timeout:int=180, pty:bool=False, stderr_sink=None) -> int:
+    if cmd.startswith('mkdir'):
+      try:
+        self.barrier.wait()
+      except threading.BrokenBarrierError:
+        return 1
+    return super().run_stream(cmd, sink, input_data, timeout, pty, stderr_sink)
+
+def test_a_level_runs_in_parallel_by_default(logger, tmp_path):
+  (tmp_path / 'a.vk.yaml').write_text(CONFIG.split('      bad:')[0] + '''      other:
+        path: /srv/other
+''')
+  runner = host_runner(logger, str(tmp_path), ['apply'])
+  runner.ssh = MeetingTransport(2)
+  runner.ssh.connect()
+  runner.run_plan()
+  runner.run_apply()
+  assert runner.summary == 'Apply complete! 2 added, 0 updated, 0 replaced, 0 destroyed.'
+
+def test_a_missing_parameter_fails_the_host_before_it_connects(logger, tmp_path):
+  (tmp_path / 'a.vk.yaml').write_text(CONFIG.replace('        path: /srv/bad\n', '        mode: 755\n'))
+  args = Cli(app='viki', desc='').parser.parse_args(['-p', str(tmp_path), 'apply'])
+  request = CliRequest(logger, path=str(tmp_path))
+  runner = HostRunner(logger, request, None, request.vars, args)
+  runner.connect = lambda: pytest.fail('connected with a missing parameter')
+  runner.run_plan(fetch=True)
+  assert runner.failed
+  assert runner.summary == "Missing parameters ['path'] in mkdir.bad."
+
+def test_the_report_of_a_replace_only_plan_destroys_nothing(logger, tmp_path, caplog):
+  (tmp_path / 'a.vk.yaml').write_text(CONFIG.split('      bad:')[0])
+  runner = host_runner(logger, str(tmp_path), ['apply'])
+  runner.run_plan()
+  runner.run_apply()
+  (tmp_path / 'a.vk.yaml').write_text(CONFIG.split('      bad:')[0].replace('/srv/good', '/srv/better'))
+  runner = host_runner(logger, str(tmp_path), ['plan'])
+  runner.run_plan()
+  caplog.clear()
+  runner.report()
+  assert 'replace:' in caplog.text
+  assert not 'destroy:' in caplog.text
+  assert 'Plan 0 to add, 0 to update, 1 to replace, 0 to destroy.' in caplog.text
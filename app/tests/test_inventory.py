@@ -0,0 +1,56 @@
+from common.inventory import Inventory
+from viki import fan_out
+import threading
+
+HOSTS = {'web1': {'hostname': '10.0.0.1'}, 'web2': None, 'db': {'username': 'VK_VAR_db_user'}}
+GROUPS = {'web': ['web1', 'web2']}
+
+def test_select_without_hosts_returns_the_global_vars(logger):
+  vars = {'hostname': 'example.com'}
+  assert Inventory(logger, {}, {}, vars).select() == [(None, vars)]
+
+def test_select_limit_by_group_and_host_without_duplicates(logger):
+  inventory = Inventory(logger, HOSTS, GROUPS, {})
+  names = [name for name, vars in inventory.select('web, web1,db')]
+  assert names == ['web1', 'web2', 'db']
+
+def test_host_vars_override_the_global_vars(logger, monkeypatch):
+  monkeypatch.setenv('VK_VAR_db_user', 'postgres')
+  inventory = Inventory(logger, HOSTS, GROUPS, {'username': 'admin', 'password': 'secret'})
+  hosts = dict(inventory.select())
+  assert hosts['web1'] == {'username': 'admin', 'password': 'secret', 'hostname': '10.0.0.1'}
+  # A host without a hostname uses its name
+  assert hosts['web2']['hostname'] == 'web2'
+  assert hosts['db']['username'] == 'postgres'
+
+def test_unknown_hosts_are_logged_and_skipped(logger, caplog):
+  inventory = Inventory(logger, HOSTS, {'web': ['web3']}, {})
+  assert 'Unknown hosts' in caplog.text
+  assert [name for name, vars in inventory.select('nope,db')] == ['db']
+  assert 'Unknown host or group nope' in caplog.text
+
+class Runner():
+  def __init__(self, label:str):
+    self.label = label
+    self.failed = False
+    self.summary = ''
+
+  def fail(self, summary:str) -> bool:
+    self.failed = True
+    self.summary = summary
+    return False
+
+def test_fan_out_runs_hosts_in_parallel_and_fails_only_the_host_that_raised(logger):
+  runners = [Runner('web1'), Runner('web2'), Runner('db')]
+  barrier = threading.Barrier(3, timeout=5)
+
+  def task(runner):
+    # Every host waits for the others, which only returns when all of them run at the same time
+    barrier.wait()
+    if runner.label == 'db':
+      raise ValueError('connection refused')
+    runner.summary = 'done'
+
+  fan_out(logger, runners, 3, task)
+  assert [runner.failed for runner in runners] == [False, False, True]
+  assert runners[2].summary == 'connection refused'
@@ -0,0 +1,44 @@
+from common.local_transport import LocalTransport
+from common.transport import is_local
+import time
+
+def transport() -> LocalTransport:
+  ssh = LocalTransport()
+  ssh.connect()
+  return ssh
+
+def test_run_returns_the_status_and_output():
+  assert transport().run('echo a; exit 3') == (3, 'a\n')
+
+def test_stderr_is_merged_without_a_stderr_sink():
+  assert transport().run('echo out; echo err >&2') == (0, 'out\nerr\n')
+
+def test_stderr_goes_to_its_own_sink():
+  out = []
+  err = []
+  status = transport().run_stream('echo out; echo err >&2', out.append, stderr_sink=err.append)
+  assert status == 0
+  assert b''.join(out) == b'out\n'
+  assert b''.join(err) == b'err\n'
+
+def test_input_data_is_written_to_stdin():
+  assert transport().run('read a; read b; echo "$b $a"', input_data='one\\ntwo') == (0, 'two one\n')
+
+def test_a_timeout_kills_the_command_and_its_children():
+  start = time.monotonic()
+  status, output = transport().run('sleep 30 & sleep 30', timeout=1)
+  assert status == -1
+  assert 'ERROR: timeout after 1 seconds' in output
+  assert time.monotonic() - start < 10
+
+def test_a_command_does_not_run_before_connect():
+  status, output = LocalTransport().run('echo a')
+  assert status == -1
+  assert 'not established' in output
+
+def test_is_local():
+  assert is_local({'hostname': 'localhost'})
+  assert not is_local({'hostname': 'localhost', 'port': 2222})
+  assert not is_local({'hostname': 'web1'})
+  assert is_local({'hostname': 'web1', 'transport': 'local'})
+  assert not is_local({'hostname': '127.0.0.1', 'transport': 'ssh'})
@@ -0,0 +1,66 @@
+from common.logger import ContextFormatter, Logger, listen
+import atexit, common.logger, io, logging, logging.handlers, pytest, threading
+
+class Counted:
+  def __init__(self):
+    self.count = 0
+
+  def __format__(self, spec):
+    self.count += 1
+    return 'counted'
+
+class Caller:
+  def __init__(self, logger):
+    self.log = logger
+
+  def connect(self):
+    self.log.info('connect {}', 'web1')
+
+def test_args_are_only_formatted_when_the_level_is_enabled():
+  logger = Logger('test', level=logging.WARNING)
+  try:
+    value = Counted()
+    logger.info('value {}', value)
+    assert value.count == 0
+    logger.warning('value {}', value)
+    assert value.count == 1
+  finally:
+    logging.getLogger().setLevel(logging.INFO)
+
+def test_a_message_without_args_is_not_formatted(logger, caplog):
+  logger.info('a {} in a message')
+  assert caplog.records[-1].getMessage() == 'a {} in a message'
+
+def test_fn_is_the_caller_of_each_thread(logger, caplog):
+  threads = [threading.Thread(target=Caller(logger).connect) for idx in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  logger.info('main')
+  fns = [record.fn for record in caplog.records]
+  assert fns == ['Caller.connect'] * 4 + ['test_fn_is_the_caller_of_each_thread']
+  assert caplog.records[0].getMessage() == 'connect web1'
+
+def test_error_raises_with_the_caller():
+  logger = Logger('test', id=3)
+  with pytest.raises(Exception, match=r'\[cid:3\]\[ERROR\]\[test_error_raises_with_the_caller\] bad'):
+    logger.error('bad', ValueError('bad'))
+
+def test_the_listener_writes_formatted_records(monkeypatch):
+  monkeypatch.setattr(common.logger, 'LISTENER', None)
+  root = logging.getLogger()
+  handlers = list(root.handlers)
+  stream = io.StringIO()
+  listener = listen(stream)
+  try:
+    Logger('test', id=2).info('hello {}', 'web1')
+  finally:
+    listener.stop()
+    atexit.unregister(listener.stop)
+    root.handlers = handlers
+  assert stream.getvalue() == '[cid:2][INFO][test_the_listener_writes_formatted_records] hello web1\n'
+
+def test_the_formatter_falls_back_to_the_function_of_the_record():
+  record = logging.LogRecord('viki', logging.INFO, __file__, 1, 'a', (), None, func='run')
+  assert ContextFormatter().format(record) == '[cid:0][INFO][viki.run] a'
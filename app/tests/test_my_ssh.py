@@ -0,0 +1,137 @@
+from common.my_ssh import MySSH
+from stand_in_server import StandInServer
+import pytest, socket, threading, time
+
+class Channel():
+  def __init__(self):
+    """One end of a socket pair in place of a paramiko channel, where the test writes the output of the command to the other end
+    """
+    self.sock, self.peer = socket.socketpair()
+    self.closed = False
+
+  def setblocking(self, blocking):
+    self.sock.setblocking(blocking)
+
+  def fileno(self) -> int:
+    return self.sock.fileno()
+
+  def recv(self, size:int) -> bytes:
+    try:
+      return self.sock.recv(size)
+    except BlockingIOError:
+      raise socket.timeout()
+
+  def recv_ready(self) -> bool:
+    try:
+      return self.sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b''
+    except BlockingIOError:
+      return False
+
+  def exit_status_ready(self) -> bool:
+    return False
+
+  def send_ready(self) -> bool:
+    return True
+
+  def send(self, data:str):
+    self.sock.send(data.encode('utf-8'))
+
+  def close(self):
+    self.closed = True
+
+def poll(channel:Channel, timeout:int) -> list:
+  chunks = []
+  MySSH()._run_poll(channel, timeout, chunks.append)
+  return chunks
+
+def test_poll_passes_each_chunk_to_the_sink():
+  channel = Channel()
+
+  def command():
+    for idx in range(3):
+      channel.peer.sendall(b'chunk %d\n' % idx)
+      time.sleep(0.05)
+    channel.peer.close()
+
+  threading.Thread(target=command).start()
+  chunks = poll(channel, 5)
+  # The output arrives as it is read, not as one buffer
+  assert len(chunks) == 3
+  assert b''.join(chunks) == b'chunk 0\nchunk 1\nchunk 2\n'
+
+def test_poll_returns_as_soon_as_the_command_ends():
+  channel = Channel()
+
+  def command():
+    time.sleep(0.05)
+    channel.peer.sendall(b'done\n')
+    channel.peer.close()
+
+  threading.Thread(target=command).start()
+  start = time.perf_counter()
+  # The channel never reports an exit status, so only EOF ends the poll before the timeout
+  assert poll(channel, 5) == [b'done\n']
+  assert time.perf_counter() - start < 1.0
+
+def test_poll_times_out():
+  channel = Channel()
+  channel.peer.sendall(b'partial')
+  start = time.perf_counter()
+  output = b''.join(poll(channel, 1))
+  assert 1.0 <= time.perf_counter() - start < 1.9
+  assert output == b'partial\nERROR: timeout after 1 seconds\n'
+  assert channel.closed
+
+@pytest.fixture(scope='module')
+def server():
+  server = StandInServer(output_size=64).start()
+  yield server
+  server.stop()
+
+@pytest.fixture
+def ssh(server):
+  ssh = MySSH(compress=False)
+  assert ssh.connect(server.host, 'test', 'test', port=server.port)
+  yield ssh
+  ssh.close()
+
+def test_run_returns_status_and_output(ssh):
+  status, output = ssh.run('uname -a')
+  assert status == 0
+  assert output == 'x' * 63 + '\n'
+
+def test_run_stream_passes_every_byte_to_the_sink(server):
+  server.output_size = 1 << 20
+  ssh = MySSH(compress=False)
+  ssh.connect(server.host, 'test', 'test', port=server.port)
+  try:
+    chunks = []
+    assert ssh.run_stream('cat big', chunks.append) == 0
+    assert sum(len(chunk) for chunk in chunks) == 1 << 20
+    # The output arrives as it is read, not as one buffer
+    assert len(chunks) > 1
+  finally:
+    server.output_size = 64
+    ssh.close()
+
+def test_run_returns_as_soon_as_the_command_ends(ssh):
+  # A fixed sleep of 200 ms between reads would take 4 seconds
+  start = time.perf_counter()
+  for _ in range(20):
+    assert ssh.run('true')[0] == 0
+  assert time.perf_counter() - start < 2.0
+
+def test_run_times_out(server, ssh):
+  server.latency = 2.0
+  try:
+    start = time.perf_counter()
+    status, output = ssh.run('sleep 2', timeout=1)
+    assert time.perf_counter() - start < 1.9
+    assert 'ERROR: timeout after 1 seconds' in output
+  finally:
+    server.latency = 0.0
+
+def test_run_without_connection_fails():
+  chunks = []
+  assert MySSH().run_stream('true', chunks.append) == -1
+  assert chunks == [b'ERROR: connection not established\n']
@@ -0,0 +1,75 @@
+from common.base_response import BaseResponse
+from common.blob_store import BlobStore
+from common.output_sink import OutputSink
+import hashlib, os
+
+class EchoSSH():
+  def run_stream(self, cmd:str, sink, input_data:str=None, timeout:int=180, pty:bool=False, stderr_sink=None) -> int:
+    """Streams 100 lines of the command in place of a host
+    """
+    for idx in range(100):
+      sink('{} {}\n'.format(cmd, idx).encode('utf-8'))
+    return 0
+
+def test_sink_streams_to_its_log_file_and_keeps_a_capped_tail(tmp_path):
+  path = str(tmp_path / 'logs' / 'mkdir' / 'a.log')
+  sink = OutputSink(path, tail=8)
+  for idx in range(1000):
+    sink(b'line %d\n' % idx)
+  sink.close()
+  with open(path, 'rb') as fp:
+    data = fp.read()
+  assert sink.size == len(data)
+  assert sink.digest() == hashlib.sha256(data).hexdigest()
+  assert sink.tail == data.decode('utf-8')[-8:]
+  assert sink.data is None
+
+def test_sink_decodes_characters_split_across_chunks():
+  sink = OutputSink(None, tail=16)
+  data = 'héllo wörld'.encode('utf-8')
+  for idx in range(len(data)):
+    sink.write(data[idx:idx + 1])
+  sink.close()
+  assert sink.tail == 'héllo wörld'
+  assert bytes(sink.data) == data
+
+def test_sink_without_output_creates_or_removes_its_log_file(tmp_path):
+  path = str(tmp_path / 'a.log')
+  OutputSink(path).close()
+  assert os.path.exists(path)
+  # An .err file of an earlier run is removed when the command wrote no stderr
+  OutputSink(path, empty=False).close()
+  assert not os.path.exists(path)
+
+def test_run_commands_stream_to_the_sinks_and_return_their_tails(logger, tmp_path):
+  response = BaseResponse(logger)
+  response.ssh = EchoSSH()
+  response.log_dir = str(tmp_path / 'logs')
+  response.tail = 16
+  sinks = response.output_sinks([('mkdir', 'a'), ('mkdir', 'b')])
+  results = response.run_commands(['mkdir a', 'mkdir b'], sinks)
+  assert results == [(0, 'a 98\nmkdir a 99\n'), (0, 'b 98\nmkdir b 99\n')]
+  with open(tmp_path / 'logs' / 'mkdir' / 'b.log') as fp:
+    assert fp.read().splitlines()[0] == 'mkdir b 0'
+  response.blobs = BlobStore(logger, str(tmp_path))
+  param = {'path': 'a'}
+  response.store_output(param, results[0][1], sinks[0])
+  # The state keeps the digest and size of the whole output, which is in the blob store
+  assert param == {'path': 'a', 'output_digest': sinks[0].digest(), 'output_size': sinks[0].size}
+  with open(tmp_path / 'logs' / 'mkdir' / 'a.log', 'rb') as fp:
+    assert response.blobs.get(param['output_digest']) == fp.read()
+
+def test_store_output_keeps_only_the_digest_in_state(logger, tmp_path):
+  response = BaseResponse(logger)
+  response.blobs = BlobStore(logger, str(tmp_path))
+  response.log_dir = str(tmp_path / 'logs')
+  sink, error = response.output_sinks([('mkdir', 'a')])[0], response.error_sinks([('mkdir', 'a')])[0]
+  sink(b'created\n')
+  error(b'warning\n')
+  sink.close()
+  error.close()
+  param = {'path': '/srv/a'}
+  response.store_output(param, sink.tail, sink, error)
+  assert param['output_size'] == 8
+  assert response.blobs.get(param['output_digest']) == b'created\n'
+  assert response.blobs.get(param['error_digest']) == b'warning\n'
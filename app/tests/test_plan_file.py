@@ -0,0 +1,58 @@
+from common.plan_file import PLAN_HEADER, PLAN_MAGIC, SavedPlan, read_plan, state_fingerprint, write_plan
+import hashlib, pytest, zlib
+
+HOSTS = {'web1': {
+  'insert': {'mkdir': {'a': {'path': '/srv/a'}}},
+  'replace': {'mkdir': {}},
+  'update': {'mkdir': {}},
+  'remove': {'mkdir': {'b': {'path': '/srv/b'}}},
+  'commands': {'insert': {'mkdir': {'a': 'mkdir -p /srv/a'}}, 'remove': {'mkdir': {'b': 'rm -rf /srv/b'}}},
+  'fingerprint': state_fingerprint({'mkdir': {'b': {'path': '/srv/b'}}})
+}}
+
+def test_plan_file_round_trip(tmp_path):
+  file = str(tmp_path / 'p.vkplan')
+  assert write_plan(file, HOSTS) == (tmp_path / 'p.vkplan').stat().st_size
+  hosts = read_plan(file)
+  assert hosts == HOSTS
+  plan = SavedPlan(hosts['web1'])
+  assert (plan.count_insert, plan.count_update, plan.count_replace, plan.count_remove) == (1, 0, 0, 1)
+
+def test_plan_file_rejects_a_changed_byte(tmp_path):
+  file = tmp_path / 'p.vkplan'
+  write_plan(str(file), HOSTS)
+  data = bytearray(file.read_bytes())
+  data[-1] ^= 0xff
+  file.write_bytes(bytes(data))
+  with pytest.raises(ValueError, match='checksum'):
+    read_plan(str(file))
+
+def test_plan_file_rejects_a_truncated_file(tmp_path):
+  file = tmp_path / 'p.vkplan'
+  write_plan(str(file), HOSTS)
+  file.write_bytes(file.read_bytes()[:-4])
+  with pytest.raises(ValueError, match='checksum'):
+    read_plan(str(file))
+
+def test_plan_file_rejects_another_version(tmp_path):
+  file = tmp_path / 'p.vkplan'
+  payload = zlib.compress(b'{"hosts": {}}')
+  file.write_bytes(PLAN_HEADER.pack(PLAN_MAGIC, 99, len(payload), hashlib.sha256(payload).digest()) + payload)
+  with pytest.raises(ValueError, match='plan version 99'):
+    read_plan(str(file))
+
+def test_plan_file_rejects_other_files(tmp_path):
+  file = tmp_path / 'p.vkplan'
+  file.write_text('viki:\n  mods: {}\n' * 10)
+  with pytest.raises(ValueError, match='not a viki plan'):
+    read_plan(str(file))
+
+def test_state_fingerprint_changes_with_the_state():
+  state = {'mkdir': {'a': {'path': '/srv/a'}}}
+  assert state_fingerprint(state) == state_fingerprint({'mkdir': {'a': {'path': '/srv/a'}}})
+  assert state_fingerprint(state) != state_fingerprint({'mkdir': {'a': {'path': '/srv/b'}}})
+
+def test_saved_plan_of_an_earlier_version_has_no_updates():
+  plan = dict(HOSTS['web1'])
+  del plan['update']
+  assert SavedPlan(plan).count_update == 0
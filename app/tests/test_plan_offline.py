@@ -0,0 +1,62 @@
+from common.host_runner import HostRunner
+from common.plan_response import PlanResponse
+from common.ssh_command import resource_fingerprint
+import sys, viki
+
+CONFIG = '''viki:
+  vars:
+    hostname: 192.0.2.1
+  mods:
+    mkdir:
+      a:
+        path: /srv/a
+      b:
+        path: /srv/b
+'''
+
+def test_plan_response_without_ssh_diffs_config_and_state(logger):
+  state = {'mkdir': {'b': {'path': '/srv/b'}, 'c': {'path': '/srv/c'}}}
+  config = {'mkdir': {'a': {'path': '/srv/a'}, 'b': {'path': '/srv/b'}}}
+  plan = PlanResponse(logger, None, config, state)
+  assert list(plan.delta_insert['mkdir'].keys()) == ['a']
+  assert list(plan.delta_remove['mkdir'].keys()) == ['c']
+  assert plan.count_replace == 0
+
+def test_plan_offline_never_connects(tmp_path, monkeypatch):
+  (tmp_path / 'a.vk.yaml').write_text(CONFIG)
+
+  def connect(runner):
+    raise AssertionError('plan --offline connected to {}'.format(runner.label))
+
+  monkeypatch.setattr(HostRunner, 'connect', connect)
+  # The host has no username or password, which plan --offline does not need
+  monkeypatch.setattr(sys, 'argv', ['viki', '-p', str(tmp_path), 'plan', '--offline'])
+  summaries = []
+  monkeypatch.setattr(HostRunner, 'report', lambda runner: summaries.append(runner.summary))
+  viki.main()
+  assert summaries == ['Plan 2 to add, 0 to update, 0 to replace, 0 to destroy.']
+
+def test_a_resource_whose_params_changed_is_replaced(logger):
+  param = {'path': '/srv/a'}
+  state = {'mkdir': {'a': {**param, 'fingerprint': resource_fingerprint('mkdir', param)}}}
+  plan = PlanResponse(logger, None, {'mkdir': {'a': {'path': '/srv/b'}}}, state)
+  assert plan.count_replace == 1
+  assert list(plan.delta_insert['mkdir'].keys()) == ['a']
+  assert list(plan.delta_remove['mkdir'].keys()) == ['a']
+  # A depends_on is not a placeholder of mkdir, so it does not replace the resource
+  plan = PlanResponse(logger, None, {'mkdir': {'a': {**param, 'depends_on': 'mkdir.b', 'path': '/srv/a'}, 'b': {'path': '/srv'}}}, state)
+  assert plan.count_replace == 0
+
+def test_a_legacy_state_is_not_replaced_for_its_captured_output(logger):
+  param = {'path': '/srv', 'output': 'a.tgz', 'url': 'http://192.0.2.1/a.tgz'}
+  # The state of a resource applied before fingerprints, with the output of its command
+  state = {'wget': {'a': {**param, 'output': 'Saving to: /srv/a.tgz\n'}}}
+  plan = PlanResponse(logger, None, {'wget': {'a': dict(param)}}, state)
+  assert plan.count_replace == 0
+  assert plan.delta_insert['wget'] == {}
+
+def test_a_legacy_state_is_replaced_when_a_param_changed(logger):
+  param = {'path': '/srv', 'output': 'a.tgz', 'url': 'http://192.0.2.1/a.tgz'}
+  state = {'wget': {'a': {**param, 'output': 'Saving to: /srv/a.tgz\n'}}}
+  plan = PlanResponse(logger, None, {'wget': {'a': {**param, 'url': 'http://192.0.2.1/b.tgz'}}}, state)
+  assert plan.count_replace == 1
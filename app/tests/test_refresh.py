@@ -0,0 +1,46 @@
+from common.local_transport import LocalTransport
+from common.refresh_response import RefreshResponse
+import pytest
+
+@pytest.fixture
+def ssh(tmp_path, monkeypatch):
+  # A host without docker, so the list probe of cloudflared fails
+  monkeypatch.setenv('PATH', str(tmp_path / 'bin') + ':/bin')
+  ssh = LocalTransport()
+  ssh.connect()
+  return ssh
+
+def test_refresh_finds_the_missing_resources(tmp_path, ssh, logger):
+  (tmp_path / 'a').mkdir()
+  state = {'mkdir': {'a': {'path': str(tmp_path / 'a')}, 'b': {'path': str(tmp_path / 'b')}}}
+  drift = RefreshResponse(logger, ssh, state, {}).refresh()
+  assert list(drift) == ['mkdir']
+  assert list(drift['mkdir']) == ['b']
+
+def test_refresh_keeps_the_time_that_a_resource_was_first_missing(tmp_path, ssh, logger):
+  state = {'mkdir': {'b': {'path': str(tmp_path / 'b')}}}
+  drift = RefreshResponse(logger, ssh, state, {}, drift={'mkdir': {'b': 1.0}}).refresh()
+  assert drift == {'mkdir': {'b': 1.0}}
+
+def test_a_resource_that_is_back_is_no_longer_drifted(tmp_path, ssh, logger):
+  (tmp_path / 'a').mkdir()
+  state = {'mkdir': {'a': {'path': str(tmp_path / 'a')}}}
+  assert RefreshResponse(logger, ssh, state, {}, drift={'mkdir': {'a': 1.0}}).refresh() == {}
+
+def test_a_mod_that_is_not_probed_keeps_its_drift(tmp_path, ssh, logger):
+  (tmp_path / 'a').mkdir()
+  state = {
+    'cloudflared': {'tunnel': {'name': 'tunnel', 'token': 'x'}, 'gone': {'name': 'gone', 'token': 'x'}},
+    'custom': {'c': {}},
+    'mkdir': {'a': {'path': str(tmp_path / 'a')}}
+  }
+  prior = {
+    'cloudflared': {'tunnel': 1.0, 'removed': 2.0},
+    'custom': {'c': 3.0},
+    'mkdir': {'a': 4.0}
+  }
+  response = RefreshResponse(logger, ssh, state, {}, drift=prior)
+  drift = response.refresh()
+  # The list probe failed and custom has no probe, so their drift is kept for the resources in the state
+  assert drift == {'cloudflared': {'tunnel': 1.0}, 'custom': {'c': 3.0}}
+  assert response.count == 1
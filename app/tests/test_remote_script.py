@@ -0,0 +1,39 @@
+from common.local_transport import LocalTransport
+from common.remote_script import SCRIPT_MISSING, ensure_script, script_command, script_path, script_source
+import sys
+
+def test_a_missing_script_exits_with_its_status(tmp_path):
+  ssh = LocalTransport()
+  ssh.connect()
+  path = str(tmp_path / 'delta.py')
+  assert ssh.run(script_command(path, sys.executable, 'a'))[0] == SCRIPT_MISSING
+  (tmp_path / 'delta.py').write_text('import sys; print(sys.argv[1])')
+  assert ssh.run(script_command(path, sys.executable, 'a')) == (0, 'a\n')
+
+def test_a_script_is_uploaded_once_and_launched_again():
+  uploads = []
+  files = set()
+
+  def launch(path:str) -> tuple:
+    return (0, 'ran') if path in files else (SCRIPT_MISSING, None)
+
+  def upload(path:str, source:bytes) -> int:
+    uploads.append(path)
+    files.add(path)
+    return 0
+
+  path = script_path('block_delta', 'delta')
+  assert path == '~/.cache/viki/delta-{}.py'.format(script_source('block_delta')[1])
+  assert ensure_script('block_delta', 'delta', launch, upload) == (0, 'ran')
+  assert ensure_script('block_delta', 'delta', launch, upload) == (0, 'ran')
+  assert uploads == [path]
+
+def test_a_failed_upload_is_not_launched_again():
+  launches = []
+
+  def launch(path:str) -> tuple:
+    launches.append(path)
+    return SCRIPT_MISSING, None
+
+  assert ensure_script('viki_agent', 'agent', launch, lambda path, source: 1) == (1, None)
+  assert len(launches) == 1
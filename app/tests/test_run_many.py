@@ -0,0 +1,49 @@
+from common.my_ssh import MySSH
+from stand_in_server import StandInServer
+import threading, time
+
+class SlowSSH(MySSH):
+  def __init__(self):
+    """A MySSH whose commands take 200 ms, which counts the commands that run at the same time
+    """
+    super().__init__()
+    self.lock = threading.Lock()
+    self.running = 0
+    self.peak = 0
+
+  def run(self, cmd, input_data=None, timeout=180):
+    with self.lock:
+      self.running += 1
+      self.peak = max(self.peak, self.running)
+    time.sleep(0.2)
+    with self.lock:
+      self.running -= 1
+    return 0, cmd + '\n'
+
+def test_run_many_runs_commands_on_parallel_channels_in_order():
+  ssh = SlowSSH()
+  start = time.perf_counter()
+  results = ssh.run_many([('cmd {}'.format(idx), None) for idx in range(8)], max_channels=8)
+  # One after the other, 8 commands take 1.6 seconds
+  assert time.perf_counter() - start < 1.0
+  assert results == [(0, 'cmd {}\n'.format(idx)) for idx in range(8)]
+  assert ssh.peak == 8
+
+def test_run_many_opens_at_most_max_channels():
+  ssh = SlowSSH()
+  ssh.run_many([('cmd {}'.format(idx), None) for idx in range(6)], max_channels=3)
+  assert ssh.peak == 3
+def test_run_many_runs_commands_on_parallel_channels_of_one_transport():
+  server = StandInServer(latency=0.3, output_size=8).start()
+  ssh = MySSH(compress=False)
+  try:
+    assert ssh.connect(server.host, 'test', 'test', port=server.port)
+    start = time.perf_counter()
+    results = ssh.run_many([('cmd {}'.format(idx), None) for idx in range(8)], max_channels=8)
+    # One after the other, 8 commands take 2.4 seconds
+    assert time.perf_counter() - start < 1.5
+    assert results == [(0, 'x' * 7 + '\n')] * 8
+    assert len(server.transports) == 1
+  finally:
+    ssh.close()
+    server.stop()
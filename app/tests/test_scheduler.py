@@ -0,0 +1,64 @@
+from common.scheduler import Scheduler
+import pytest
+
+CONFIG = {
+  'mkdir': {
+    'docker': {'path': '/srv/docker'},
+    'app': {'path': '/srv/docker/app', 'depends_on': 'mkdir.docker'},
+    'logs': {'path': '/var/log/app'}
+  },
+  'wget': {
+    'compose': {'path': '/srv/docker/app', 'output': 'docker-compose.yml', 'url': 'https://example.com/a.yml', 'depends_on': ['mkdir.app']}
+  },
+  'compose': {
+    'app': {'path': '/srv/docker/app/docker-compose.yml', 'depends_on': ['wget.compose', 'mkdir.logs']}
+  }
+}
+
+def test_levels_follow_depends_on_in_the_order_of_the_delta(logger):
+  levels = Scheduler(logger, CONFIG).levels(CONFIG)
+  assert levels == [
+    [('mkdir', 'docker'), ('mkdir', 'logs')],
+    [('mkdir', 'app')],
+    [('wget', 'compose')],
+    [('compose', 'app')]
+  ]
+
+def test_reverse_levels_destroy_dependents_first(logger):
+  levels = Scheduler(logger, CONFIG).levels(CONFIG, reverse=True)
+  assert levels[0] == [('compose', 'app')]
+  assert levels[-1] == [('mkdir', 'docker')]
+
+def test_levels_depend_through_resources_outside_the_delta(logger):
+  # mkdir.app is already applied, so wget.compose waits for mkdir.docker through it
+  delta = {'mkdir': {'docker': CONFIG['mkdir']['docker']}, 'wget': CONFIG['wget']}
+  assert Scheduler(logger, CONFIG).levels(delta) == [[('mkdir', 'docker')], [('wget', 'compose')]]
+
+def test_blocked_after_a_failed_dependency(logger):
+  scheduler = Scheduler(logger, CONFIG)
+  scheduler.levels(CONFIG)
+  assert scheduler.blocked(('mkdir', 'app'), {('mkdir', 'docker')})
+  assert not scheduler.blocked(('mkdir', 'logs'), {('mkdir', 'docker')})
+
+def test_check_finds_a_cycle(logger):
+  config = {'mkdir': {
+    'a': {'path': '/a', 'depends_on': 'mkdir.c'},
+    'b': {'path': '/b', 'depends_on': 'mkdir.a'},
+    'c': {'path': '/c', 'depends_on': 'mkdir.b'}
+  }}
+  with pytest.raises(Exception, match=r'Cycle found in depends_on: mkdir.a -> mkdir.c -> mkdir.b -> mkdir.a'):
+    Scheduler(logger, config).check()
+
+def test_levels_find_a_cycle(logger):
+  config = {'mkdir': {'a': {'depends_on': 'mkdir.b'}, 'b': {'depends_on': 'mkdir.a'}, 'c': {}}}
+  with pytest.raises(Exception, match='Cycle found'):
+    Scheduler(logger, config).levels(config)
+
+def test_check_finds_an_unknown_resource(logger):
+  config = {'mkdir': {'a': {'path': '/a', 'depends_on': 'mkdir.nope'}}}
+  with pytest.raises(Exception, match=r"Unknown resources \['mkdir.nope'\]"):
+    Scheduler(logger, config).check()
+
+def test_the_state_resolves_depends_on_of_removed_resources(logger):
+  state = {'mkdir': {'a': {'path': '/a'}, 'b': {'path': '/b', 'depends_on': 'mkdir.a'}}}
+  assert Scheduler(logger, {'mkdir': {}}, state).levels(state, reverse=True) == [[('mkdir', 'b')], [('mkdir', 'a')]]
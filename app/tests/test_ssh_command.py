@@ -0,0 +1,63 @@
+from common.ssh_command import CommandTemplate, MODS_TEMPLATE, quote_value, resource_fingerprint
+import pytest, subprocess
+
+VALUES = ['plain', 'a b', "it's", 'say "hi"', '$HOME', '`id`', 'back\\slash', '']
+
+def shell_echo(command:str) -> str:
+  return subprocess.run(['/bin/sh', '-c', command], capture_output=True, text=True).stdout
+
+@pytest.mark.parametrize('value', VALUES)
+def test_an_unquoted_placeholder_is_one_word(value):
+  template = CommandTemplate('printf %s ${value}')
+  assert shell_echo(template.render({'value': value})) == value
+
+@pytest.mark.parametrize('value', VALUES)
+def test_a_placeholder_in_single_quotes(value):
+  template = CommandTemplate("printf %s '${value}'")
+  assert shell_echo(template.render({'value': value})) == value
+
+@pytest.mark.parametrize('value', VALUES)
+def test_a_placeholder_in_double_quotes(value):
+  template = CommandTemplate('printf %s "${value}"')
+  assert shell_echo(template.render({'value': value})) == value
+
+def test_a_quote_in_a_literal_is_tracked():
+  template = CommandTemplate('echo "a\\" ${x}" ${y}')
+  assert template.parts[1] == ('x', '"')
+  assert template.parts[3] == ('y', '')
+
+def test_a_safe_value_is_not_quoted():
+  assert quote_value('/tmp/a-b_c.txt') == '/tmp/a-b_c.txt'
+  assert quote_value('') == "''"
+
+def test_a_leading_tilde_still_expands():
+  assert quote_value('~/a b') == "~/'a b'"
+  assert quote_value('~') == '~'
+
+def test_check_returns_missing_and_unknown_parameters():
+  template = CommandTemplate('mkdir -p ${path}')
+  assert template.check({'path': '/a'}) == ([], [])
+  assert template.check({'depends_on': 'mkdir.b'}) == (['path'], [])
+  assert template.check({'path': '/a', 'mode': '0700'}) == ([], ['mode'])
+
+def test_render_raises_on_a_missing_parameter():
+  with pytest.raises(ValueError, match='Missing parameters'):
+    CommandTemplate('mkdir -p ${path}').render({})
+
+def test_render_many_matches_render():
+  template = CommandTemplate('ln -s ${src} "${dest}"')
+  params = [{'src': '/a b', 'dest': '/c'}, {'src': "it's", 'dest': '$d'}]
+  assert template.render_many(params) == [template.render(param) for param in params]
+
+def test_render_many_checks_every_param_first():
+  template = CommandTemplate('mkdir -p ${path}')
+  with pytest.raises(ValueError, match='in 1: '):
+    template.render_many([{'path': '/a'}, {}])
+
+def test_a_fingerprint_ignores_parameters_that_are_not_placeholders():
+  param = {'path': '/tmp/a'}
+  assert resource_fingerprint('mkdir', param) == resource_fingerprint('mkdir', {**param, 'depends_on': 'mkdir.b'})
+  assert resource_fingerprint('mkdir', param) != resource_fingerprint('mkdir', {'path': '/tmp/b'})
+
+def test_the_sync_parameters_are_not_unknown():
+  assert MODS_TEMPLATE['sync']['insert'].check({'src': 'files', 'dest': '/tmp/a'}) == ([], [])
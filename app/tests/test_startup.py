@@ -0,0 +1,33 @@
+import os, subprocess, sys
+
+APP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG = '''viki:
+  vars:
+    hostname: 192.0.2.1
+  mods:
+    mkdir:
+      a:
+        path: /srv/a
+'''
+# Runs viki in a fresh interpreter and prints the heavy modules that it imported
+PROBE = '''import sys, viki
+sys.argv = ['viki'] + sys.argv[1:]
+try:
+  viki.main()
+except SystemExit:
+  pass
+print('LOADED', sorted(name for name in ('paramiko', 'yaml', 'multiprocessing') if name in sys.modules))
+'''
+
+def loaded(*args) -> str:
+  proc = subprocess.run([sys.executable, '-c', PROBE, *args], cwd=APP, capture_output=True, text=True, env=os.environ.copy())
+  return [line for line in proc.stdout.splitlines() if line.startswith('LOADED')][-1]
+
+def test_help_does_not_import_the_application():
+  assert loaded('--help') == 'LOADED []'
+
+def test_plan_offline_with_a_warm_cache_does_not_import_yaml(tmp_path):
+  (tmp_path / 'a.vk.yaml').write_text(CONFIG)
+  # The first run reads the YAML and fills the config cache
+  assert loaded('-p', str(tmp_path), 'plan', '--offline') == "LOADED ['yaml']"
+  assert loaded('-p', str(tmp_path), 'plan', '--offline') == 'LOADED []'
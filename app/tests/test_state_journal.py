@@ -0,0 +1,79 @@
+from common.cli_request import CliRequest
+from common.state_store import StateStore
+import json, os
+
+EMPTY = {'viki': {'data': {}, 'mods': {}}}
+
+def new_state() -> dict:
+  return json.loads(json.dumps(EMPTY))
+
+def test_journal_replays_changes_since_the_last_write(logger, tmp_path):
+  store = StateStore(logger, str(tmp_path))
+  state = store.load(new_state())
+  state['viki']['mods']['mkdir'] = {'a': {'path': '/a'}}
+  store.write(state)
+  store.set(['viki', 'mods', 'mkdir', 'b'], {'path': '/b'})
+  store.delete(['viki', 'mods', 'mkdir', 'a'])
+  store.set(['viki', 'mods', 'wget', 'c'], {'path': '/c'})
+  # A crash here keeps the journal, which the next run replays
+  state = StateStore(logger, str(tmp_path)).load(new_state())
+  assert dict(state['viki']['mods']['mkdir']) == {'b': {'path': '/b'}}
+  assert dict(state['viki']['mods']['wget']) == {'c': {'path': '/c'}}
+
+def test_a_truncated_record_is_ignored_and_compacted(logger, tmp_path):
+  store = StateStore(logger, str(tmp_path))
+  store.load(new_state())
+  store.set(['viki', 'mods', 'mkdir', 'a'], {'path': '/a'})
+  store.set(['viki', 'mods', 'mkdir', 'b'], {'path': '/b'})
+  with open(store.journal_file, 'rb+') as fp:
+    fp.truncate(os.path.getsize(store.journal_file) - 5)
+  store = StateStore(logger, str(tmp_path))
+  state = store.load(new_state())
+  assert dict(state['viki']['mods']['mkdir']) == {'a': {'path': '/a'}}
+  # The partial record is gone, so the next record is not appended to it
+  assert not os.path.exists(store.journal_file)
+  store.set(['viki', 'mods', 'mkdir', 'c'], {'path': '/c'})
+  state = StateStore(logger, str(tmp_path)).load(new_state())
+  assert sorted(state['viki']['mods']['mkdir'].keys()) == ['a', 'c']
+
+def test_write_removes_the_journal_and_migrates_a_state_file(logger, tmp_path):
+  (tmp_path / 'state.vk.json').write_text(json.dumps({'viki': {'data': {}, 'mods': {'mkdir': {'a': {'path': '/a'}}}}}))
+  store = StateStore(logger, str(tmp_path))
+  state = store.load(new_state())
+  state['viki']['mods']['mkdir']['b'] = {'path': '/b'}
+  store.set(['viki', 'mods', 'mkdir', 'b'], {'path': '/b'})
+  store.write(state)
+  assert not os.path.exists(store.journal_file)
+  assert os.path.exists(tmp_path / 'state.vk.json.migrated')
+  assert not any(name.endswith('.tmp') for root, dirs, files in os.walk(tmp_path) for name in files)
+  state = StateStore(logger, str(tmp_path)).load(new_state())
+  assert sorted(state['viki']['mods']['mkdir'].keys()) == ['a', 'b']
+
+def test_checkpoint_compacts_after_compact_every_records(logger, tmp_path):
+  store = StateStore(logger, str(tmp_path), compact_every=2)
+  state = store.load(new_state())
+  state['viki']['mods']['mkdir'] = {'a': {'path': '/a'}}
+  store.set(['viki', 'mods', 'mkdir', 'a'], {'path': '/a'})
+  store.checkpoint()
+  assert os.path.exists(store.journal_file)
+  store.set(['viki', 'mods', 'mkdir', 'a'], {'path': '/a'})
+  store.checkpoint()
+  assert not os.path.exists(store.journal_file)
+
+def test_cli_request_does_not_touch_the_state(logger, tmp_path):
+  (tmp_path / 'a.vk.yaml').write_text('viki:\n  mods: {}\n')
+  (tmp_path / 'state.vk.json').write_text(json.dumps(EMPTY))
+  (tmp_path / 'state.vk.json.journal').write_text('{"op":"set","path":["viki","mods","mkdir"],"value":{}}\n{"op":')
+  CliRequest(logger, path=str(tmp_path))
+  assert sorted(os.listdir(tmp_path)) == ['a.vk.yaml', 'state.vk.json', 'state.vk.json.journal']
+
+def test_write_flushes_the_folders_after_the_renames(logger, tmp_path, monkeypatch):
+  flushed = []
+  monkeypatch.setattr('common.state_store.fsync_dir', flushed.append)
+  store = StateStore(logger, str(tmp_path))
+  state = store.load(new_state())
+  store.set(['viki', 'mods', 'mkdir', 'a'], {'path': '/a'})
+  assert flushed == [str(tmp_path)]
+  state['viki']['mods']['mkdir'] = {'a': {'path': '/a'}}
+  store.write(state)
+  assert flushed[1:] == [os.path.join(store.dir, 'data'), os.path.join(store.dir, 'mods'), store.dir]
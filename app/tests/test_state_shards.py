@@ -0,0 +1,59 @@
+from common.plan_response import PlanResponse
+from common.ssh_command import resource_fingerprint
+from common.state_store import Shard, StateStore
+import json, os
+
+def write_state(logger, path:str) -> StateStore:
+  store = StateStore(logger, path)
+  state = store.load({'viki': {'data': {}, 'mods': {}}})
+  state['viki']['mods']['mkdir'] = {'a': {'path': '/a', 'fingerprint': 'f-a'}, 'b': {'path': '/b'}}
+  state['viki']['mods']['wget'] = {'c': {'path': '/c', 'output': 'c.tgz', 'url': 'https://example.com/c.tgz'}}
+  state['viki']['facts'] = {'which': {}}
+  store.write(state)
+  return store
+
+def test_each_mod_is_a_shard_behind_an_index(logger, tmp_path):
+  store = write_state(logger, str(tmp_path))
+  with open(store.index_file) as fp:
+    index = json.load(fp)
+  assert sorted(index['shards']['mods'].keys()) == ['mkdir', 'wget']
+  assert index['shards']['mods']['mkdir']['names'] == ['a', 'b']
+  assert index['shards']['mods']['mkdir']['fingerprints'] == {'a': 'f-a'}
+  # Sections other than data and mods stay in the index
+  assert index['viki'] == {'facts': {'which': {}}}
+
+def test_shards_are_read_on_first_use(logger, tmp_path):
+  write_state(logger, str(tmp_path))
+  state = StateStore(logger, str(tmp_path)).load({})
+  mkdir = state['viki']['mods']['mkdir']
+  assert isinstance(mkdir, Shard)
+  assert sorted(mkdir) == ['a', 'b'] and 'a' in mkdir
+  assert mkdir.resource_fingerprint('a') == 'f-a'
+  assert not mkdir.loaded()
+  assert mkdir['b'] == {'path': '/b'}
+  assert mkdir.loaded()
+
+def test_an_unchanged_plan_reads_no_shard(logger, tmp_path):
+  config = {'mkdir': {'a': {'path': '/a'}, 'b': {'path': '/b'}}}
+  store = StateStore(logger, str(tmp_path))
+  state = store.load({'viki': {'data': {}, 'mods': {}}})
+  state['viki']['mods']['mkdir'] = {name: dict(param, fingerprint=resource_fingerprint('mkdir', param)) for name, param in config['mkdir'].items()}
+  store.write(state)
+  state = StateStore(logger, str(tmp_path)).load({})
+  plan = PlanResponse(logger, None, config, state['viki']['mods'])
+  assert plan.count_insert + plan.count_remove == 0
+  # The fingerprints in the index are enough to compare the resources
+  assert not state['viki']['mods']['mkdir'].loaded()
+
+def test_write_keeps_unloaded_shards_and_removes_replaced_ones(logger, tmp_path):
+  write_state(logger, str(tmp_path))
+  store = StateStore(logger, str(tmp_path))
+  state = store.load({})
+  wget = state['viki']['mods']['wget'].file
+  state['viki']['mods']['mkdir']['d'] = {'path': '/d'}
+  store.write(state)
+  files = sorted(os.listdir(os.path.join(store.dir, 'mods')))
+  assert len(files) == 2
+  assert os.path.basename(wget) in files
+  state = StateStore(logger, str(tmp_path)).load({})
+  assert sorted(state['viki']['mods']['mkdir']) == ['a', 'b', 'd']
@@ -0,0 +1,67 @@
+from common.apply_response import ApplyResponse
+from common.base_response import BaseResponse
+from common.local_transport import LocalTransport
+from common.ssh_command import SUDO_PREFIX, exec_profile, needs_sudo_input, sudo_command
+import os, pytest
+
+@pytest.fixture
+def ssh(tmp_path, monkeypatch):
+  # A sudo that prints its arguments and the password that it reads from stdin
+  bin = tmp_path / 'bin'
+  bin.mkdir()
+  (bin / 'sudo').write_text('#!/bin/sh\nread password\necho "sudo $* as $password"\n')
+  os.chmod(bin / 'sudo', 0o755)
+  monkeypatch.setenv('PATH', '{}:{}'.format(bin, os.environ['PATH']))
+  ssh = LocalTransport()
+  ssh.connect()
+  return ssh
+
+def test_a_command_without_sudo_is_not_changed():
+  assert sudo_command('mkdir -p /a', 'secret') == 'mkdir -p /a'
+  assert sudo_command('echo pseudo x', 'secret') == 'echo pseudo x'
+
+def test_a_command_with_sudo_reads_the_password_from_stdin():
+  command = sudo_command('[ -d /a ] || sudo mkdir /a', 'secret')
+  assert command == SUDO_PREFIX + '[ -d /a ] || sudo mkdir /a'
+  assert needs_sudo_input(command)
+  assert not 'secret' in command
+  # A command is prefixed once, e.g. a command of a saved plan
+  assert sudo_command(command, 'secret') == command
+
+def test_without_a_password_sudo_is_not_changed():
+  assert sudo_command('sudo mkdir /a') == 'sudo mkdir /a'
+  assert sudo_command('sudo mkdir /a', '') == 'sudo mkdir /a'
+  assert not needs_sudo_input('sudo mkdir /a')
+
+def test_every_sudo_of_a_command_gets_the_password(ssh):
+  command = sudo_command('sudo echo a; false || sudo echo b', 'secret')
+  assert ssh.run(command, 'secret') == (0, 'sudo -S -p  echo a as secret\nsudo -S -p  echo b as secret\n')
+
+def test_only_a_command_with_sudo_gets_the_password_as_input(logger, ssh):
+  class Response(BaseResponse):
+    def __init__(self):
+      super().__init__(logger)
+      self.ssh = ssh
+      self.sudo_password = 'secret'
+      self.channels = 1
+      self.batch = False
+      self.timeout = 10
+
+  response = Response()
+  commands = [sudo_command('sudo true', 'secret'), 'read a; echo "[$a]"']
+  assert response.run_commands(commands) == [(0, 'sudo -S -p  true as secret\n'), (0, '[]\n')]
+
+def test_the_stderr_of_a_resource_is_kept_apart(logger, tmp_path):
+  ssh = LocalTransport()
+  ssh.connect()
+  insert = {'mkdir': {'a': {'path': str(tmp_path / 'a')}, 'b': {'path': '/dev/null/b'}}}
+  response = ApplyResponse(logger, ssh, insert, {}, {}, {}, log_dir=str(tmp_path / 'logs'))
+  response.apply_insert()
+  assert not 'error_digest' in response.state['mkdir']['a']
+  assert not (tmp_path / 'logs' / 'mkdir' / 'a.err').exists()
+  assert (tmp_path / 'logs' / 'mkdir' / 'b.err').read_text() != ''
+  assert (tmp_path / 'logs' / 'mkdir' / 'b.log').read_text() == ''
+
+def test_the_default_profile_has_no_pty():
+  assert exec_profile('mkdir') == {'pty': False}
+  assert exec_profile(None) == {'pty': False}
@@ -0,0 +1,71 @@
+from common.apply_response import ApplyResponse
+from common.local_transport import LocalTransport
+from common.tracer import TAGS, TRACER, Tracer
+import contextvars, json, pytest
+
+@pytest.fixture
+def tracer():
+  TRACER.enable()
+  yield TRACER
+  TRACER.enabled = False
+  TRACER.spans = []
+
+def test_a_nested_span_inherits_the_tags_of_its_parent():
+  tracer = Tracer()
+  tracer.enable()
+  with tracer.span('resource', mod='mkdir', name='a'):
+    with tracer.span('exec'):
+      pass
+  assert TAGS.get() == {}
+  tags = {name: tags for name, start, duration, tid, tags in tracer.spans}
+  assert tags['exec'] == {'mod': 'mkdir', 'name': 'a'}
+  assert tags['resource'] == {'mod': 'mkdir', 'name': 'a'}
+
+def test_the_transport_spans_of_a_resource_have_its_mod_and_name(tracer, tmp_path, logger):
+  ssh = LocalTransport()
+  ssh.connect()
+  insert = {'mkdir': {name: {'path': str(tmp_path / name)} for name in ('a', 'b')}}
+
+  def apply():
+    TRACER.tag(host='local')
+    ApplyResponse(logger, ssh, insert, {}, {}, {}, channels=2).apply_insert()
+
+  contextvars.copy_context().run(apply)
+  spans = [(name, tags) for name, start, duration, tid, tags in tracer.spans if name in ('session_open', 'exec')]
+  assert len(spans) == 4
+  for name, tags in spans:
+    assert tags['host'] == 'local'
+    assert tags['mod'] == 'mkdir'
+    assert tags['name'] in ('a', 'b')
+
+def test_a_disabled_tracer_records_nothing():
+  tracer = Tracer()
+  with tracer.span('exec'):
+    pass
+  tracer.record('first_byte', 0.0, 1.0)
+  assert tracer.spans == []
+
+def test_the_tags_of_a_host_are_added_to_its_spans(tracer):
+  def run():
+    TRACER.tag(host='web1')
+    with TRACER.span('exec', mod='mkdir'):
+      pass
+  contextvars.copy_context().run(run)
+  assert TAGS.get() == {}
+  assert [(name, tags) for name, start, duration, tid, tags in tracer.spans] == [('exec', {'host': 'web1', 'mod': 'mkdir'})]
+
+def test_the_exports_group_by_host_and_mod(tmp_path):
+  tracer = Tracer()
+  tracer.enable()
+  tracer.record('exec', 0.0, 0.5, {'host': 'web1', 'mod': 'mkdir', 'name': 'a'})
+  tracer.record('exec', 0.0, 1.5, {'host': 'web1', 'mod': 'mkdir', 'name': 'b'})
+  tracer.record('connect', 0.0, 0.1, {'host': 'web2'})
+  assert tracer.totals()['exec'] == (2, 2.0)
+  assert tracer.slowest('exec', 1) == [(1.5, {'host': 'web1', 'mod': 'mkdir', 'name': 'b'})]
+  assert tracer.write_prometheus(str(tmp_path / 'viki.prom')) == 2
+  text = (tmp_path / 'viki.prom').read_text()
+  assert 'viki_span_seconds_count{span="exec",host="web1",mod="mkdir"} 2' in text
+  assert 'viki_span_max_seconds{span="exec",host="web1",mod="mkdir"} 1.500000' in text
+  assert tracer.write_chrome_trace(str(tmp_path / 'trace.json')) == 3
+  events = json.loads((tmp_path / 'trace.json').read_text())['traceEvents']
+  assert [event['cat'] for event in events] == ['mkdir', 'mkdir', 'viki']
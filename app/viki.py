@@ -1,67 +1,148 @@
-from common.cli_request import CliRequest
-from common.logger import Logger
 from common.cli import Cli
-from common.my_ssh import MySSH
-from common.fetch_response import FetchResponse
-from common.plan_response import PlanResponse
-from common.apply_response import ApplyResponse
 import sys
 
+# ================================================================
+# FAN OUT
+# ================================================================
+def fan_out(logger, runners:list, workers:int, task):
+  """Runs a task for every host in a pool of workers
+    :param task: A function that takes a HostRunner
+    :type task: function
+  """
+  from concurrent.futures import ThreadPoolExecutor
+  from common.tracer import TRACER
+
+  def traced(runner):
+    TRACER.tag(host=runner.label)
+    return task(runner)
+
+  with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+    futures = [(runner, pool.submit(traced, runner)) for runner in runners]
+    for runner, future in futures:
+      try:
+        future.result()
+      except Exception as e:
+        logger.error('host {} failed: {}'.format(runner.label, str(e)))
+        runner.fail(str(e))
+
+# ================================================================
+# PROFILE
+# ================================================================
+def report_profile(logger, args):
+  """Logs the time of each span and the slowest resources, and exports the spans for --trace and --metrics
+  """
+  from common.tracer import TRACER
+  if args.profile:
+    for name, (count, seconds) in sorted(TRACER.totals().items(), key=lambda item: item[1][1], reverse=True):
+      logger.info('profile {}: {} spans, {:.3f}s'.format(name, count, seconds))
+    for duration, tags in TRACER.slowest('resource', 10):
+      logger.info('profile slowest {:.3f}s {} {}.{}'.format(duration, tags.get('host'), tags.get('mod'), tags.get('name')))
+  if args.trace is not None:
+    logger.info('Saved {} spans to {}.'.format(TRACER.write_chrome_trace(args.trace), args.trace))
+  if args.metrics is not None:
+    logger.info('Saved {} series to {}.'.format(TRACER.write_prometheus(args.metrics), args.metrics))
+
+# ================================================================
+# DAEMON
+# ================================================================
+def run_daemon(logger, args):
+  """Serves the connections of each host on a Unix socket, or logs the connections of a running daemon
+  """
+  from common.daemon_transport import DaemonTransport, socket_path
+  path = args.socket if args.socket is not None else socket_path()
+  if args.status:
+    daemon = DaemonTransport(path)
+    if not daemon.reachable():
+      logger.error('viki daemon not found on {}.'.format(path))
+      sys.exit(1)
+    for conn in daemon.status():
+      logger.info('{username}@{hostname}:{port} connected={connected} users={users} commands={commands} idle={idle}s'.format(**conn))
+    return
+  from common.daemon import serve
+  serve(logger, path, idle=args.idle, check=args.check)
+
 # ================================================================
 # MAIN
 # ================================================================
 def main():
-  logger = Logger(__name__)
   cli = Cli(
     app='viki',
     desc='CLI application that manages servers using a declarative configuration'
   )
-  request = CliRequest(logger, path=cli.args().path)
-  logger.fn = __name__
-  if not 'hostname' in request.vars or not 'username' in request.vars or not 'password' in request.vars or request.vars['hostname'] == '' or request.vars['username'] == '' or request.vars['password'] == '':
-    logger.error('SSH credentials not found.')
+  args = cli.args()
+  # Imported after the arguments are parsed, so that --help and argument errors do not load them
+  from common.cli_request import CliRequest
+  from common.logger import Logger
+  from common.inventory import Inventory
+  from common.host_runner import HostRunner
+  from common.plan_file import read_plan, write_plan
+  from common.tracer import TRACER
+  logger = Logger(__name__)
+  if args.command == 'daemon':
+    run_daemon(logger, args)
+    return
+  if args.profile or args.trace is not None or args.metrics is not None:
+    TRACER.enable()
+  request = CliRequest(logger, path=args.path)
+  inventory = Inventory(logger, request.hosts, request.groups, request.vars)
+  runners = []
+  # gc keeps the blobs of every host, so it ignores --limit
+  for name, vars in inventory.select(None if args.command == 'gc' else args.limit):
+    runners.append(HostRunner(Logger('viki', id=len(runners) + 1), request, name, vars, args))
+  if runners == []:
+    logger.error('No hosts found in inventory.')
     sys.exit(1)
+  offline = (args.command == 'plan' and args.offline) or args.command == 'gc'
+  for runner in runners:
+    if not offline and not runner.credentials():
+      # The other hosts still run, and the exit code reports this one
+      logger.error('SSH credentials not found for host {}.'.format(runner.label))
+      runner.fail('SSH credentials not found.')
+  active = [runner for runner in runners if not runner.failed]
 
-  # Create the SSH connection
-  ssh = MySSH()
-  ssh.set_verbosity(True)
-  ssh.connect(
-    hostname=request.vars['hostname'],
-    username=request.vars['username'],
-    password=request.vars['password'],
-    port=22
-  )
-  if ssh.connected() is False:
-    logger.error('SSH connection failed.')
-    sys.exit(1)
+  if args.command == 'fetch':
+    fan_out(logger, active, args.workers, HostRunner.run_fetch)
+  elif args.command == 'refresh':
+    fan_out(logger, active, args.workers, HostRunner.run_refresh)
+  elif args.command == 'gc':
+    digests = set()
+    for runner in runners:
+      runner.summary = '{} outputs referenced.'.format(len(runner.digests()))
+      digests |= runner.digests()
+    count, size = request.blob_store().gc(digests)
+    logger.info('GC complete! {} blobs removed, {} bytes freed.'.format(count, size))
+  elif args.command == 'apply' and args.plan_file is not None:
+    try:
+      hosts = read_plan(args.plan_file)
+    except (OSError, ValueError) as e:
+      logger.error('Saved plan not loaded: {}'.format(str(e)))
+      sys.exit(1)
+    fan_out(logger, active, args.workers, lambda runner: runner.run_saved(hosts))
+    for runner in active:
+      runner.report()
+    fan_out(logger, active, args.workers, HostRunner.run_apply)
+  elif args.command == 'plan' or args.command == 'apply':
+    fan_out(logger, active, args.workers, lambda runner: runner.run_plan(fetch=args.command == 'apply', offline=offline))
+    for runner in active:
+      runner.report()
+    changes = sum(runner.changes() for runner in active)
+    if args.command == 'plan' and args.out is not None:
+      hosts = {}
+      for runner in active:
+        if not runner.failed:
+          hosts[runner.name if runner.name is not None else ''] = runner.saved_plan()
+      size = write_plan(args.out, hosts)
+      logger.info('Saved plan to {} ({} bytes).'.format(args.out, size))
+    if args.command == 'apply' and changes > 0:
+      if request.approval():
+        fan_out(logger, active, args.workers, HostRunner.run_apply)
 
-  if cli.args().command == 'fetch':
-    fetch_response = FetchResponse(logger, ssh, request.data, request.vars)
-    fetch_response.fetch()
-    request.state['viki']['data'] = fetch_response.state
-    request.write_state(request.state)
-  elif cli.args().command == 'plan' or cli.args().command == 'apply':
-    plan_response = PlanResponse(logger, ssh, request.mods, request.state_mods)
-    logger.fn = __name__
-    if plan_response.count_insert == 0 and plan_response.count_remove == 0:
-      logger.info('No changes. Your server matches the configuration.')
-    else:
-      if plan_response.count_insert > 0:
-        logger.info('add:\n{}'.format(plan_response.pretty_json(plan_response.delta_insert)))
-      if plan_response.count_remove > 0:
-        logger.info('destroy:\n{}'.format(plan_response.pretty_json(plan_response.delta_remove)))
-      logger.info('Plan {} to add, {} to destroy.'.format(plan_response.count_insert, plan_response.count_remove))
-      if cli.args().command == 'apply':
-        fetch_response = FetchResponse(logger, ssh, request.data, request.vars)
-        fetch_response.fetch()
-        request.state['viki']['data'] = fetch_response.state
-        apply_response = ApplyResponse(logger, ssh, plan_response.delta_insert, plan_response.delta_remove, request.state_mods, request.vars)
-        if request.approval():
-          if plan_response.count_insert > 0: apply_response.apply_insert()
-          if plan_response.count_remove > 0: apply_response.apply_remove()
-          request.state['viki']['mods'] = apply_response.state
-          request.write_state(request.state)
-          logger.info('Apply complete! {} added, {} destroyed.'.format(plan_response.count_insert, plan_response.count_remove))
+  for runner in runners:
+    logger.info('{}: {}'.format(runner.label, runner.summary))
+  if TRACER.enabled:
+    report_profile(logger, args)
+  if any(runner.failed for runner in runners):
+    sys.exit(1)
 
 if __name__ == "__main__":
   main()